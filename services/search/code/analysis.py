@@ -0,0 +1,74 @@
+import re
+import unicodedata
+
+# Articles elided with an apostrophe (as in "l'uovo" or "all'amatriciana")
+ELISION_ARTICLES = ["c", "l", "all", "dall", "dell", "nell", "sull", "coll", "pell", "gl", "agl",
+                    "dagl", "degl", "negl", "sugl", "un", "m", "t", "s", "v", "d"]
+
+# Articles, prepositions and conjunctions. Not the full Italian stopwords list, which also has
+# words meaningful for foods (as "senza" or "non").
+STOPWORDS = ["a", "ad", "al", "allo", "ai", "agli", "all", "alla", "alle", "col", "coi", "con",
+             "da", "dal", "dallo", "dai", "dagli", "dall", "dalla", "dalle", "del", "dello", "dei",
+             "degli", "dell", "della", "delle", "di", "e", "ed", "gli", "i", "il", "in", "la", "le",
+             "lo", "nel", "nello", "nei", "negli", "nell", "nella", "nelle", "o", "per", "su", "sul",
+             "sullo", "sui", "sugli", "sull", "sulla", "sulle", "tra", "fra", "un", "uno", "una"]
+
+# The Elasticsearch analyzers for the descriptions: the Italian one for searching, and one with no
+# stopwords and stemming for the suggestions (to match on what is being typed)
+ANALYSIS = {
+    "filter": {
+        "italian_elision": {"type": "elision", "articles": ELISION_ARTICLES, "articles_case": True},
+        "italian_stop": {"type": "stop", "stopwords": STOPWORDS},
+        "italian_light_stemmer": {"type": "stemmer", "language": "light_italian"}
+    },
+    "analyzer": {
+        "italian_food": {"tokenizer": "standard",
+                         "filter": ["italian_elision", "lowercase", "italian_stop", "asciifolding", "italian_light_stemmer"]},
+        "italian_food_suggest": {"tokenizer": "standard",
+                                 "filter": ["italian_elision", "lowercase", "asciifolding"]}
+    }
+}
+
+# The same analysis in Python, for the embedded backend and the typo correction. Words can
+# have inner apostrophes or dots (as "all'uovo" or "v.m"), as for the standard tokenizer.
+TOKEN_REGEX = re.compile(r"\w+(?:['’.]\w+)*")
+STOPWORDS_SET = set(STOPWORDS)
+ELISION_ARTICLES_SET = set(ELISION_ARTICLES)
+
+
+def fold(term):
+    # To plain ASCII letters where possible (as "è" to "e")
+    return ''.join(char for char in unicodedata.normalize('NFKD', term) if not unicodedata.combining(char))
+
+
+def stem(term):
+    # As the Lucene Italian light stemmer: plural and gender suffixes off, for long enough terms
+    if len(term) < 6:
+        return term
+    if term[-1] == 'e':
+        return term[:-2] if term[-2] in 'ih' else term[:-1]
+    if term[-1] == 'i':
+        return term[:-2] if term[-2] in 'hi' else term[:-1]
+    if term[-1] in 'ao':
+        return term[:-2] if term[-2] == 'i' else term[:-1]
+    return term
+
+
+def tokenize(text):
+    # Folded terms with no elisions and stopwords
+    terms = []
+    for term in TOKEN_REGEX.findall(text.lower()):
+        for apostrophe in "'’":
+            if apostrophe in term:
+                article, _, rest = term.partition(apostrophe)
+                if article in ELISION_ARTICLES_SET:
+                    term = rest
+                break
+        if term not in STOPWORDS_SET:
+            terms.append(fold(term))
+    return terms
+
+
+def analyze(text):
+    # As the "italian_food" Elasticsearch analyzer
+    return [stem(term) for term in tokenize(text)]
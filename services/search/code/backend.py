@@ -0,0 +1,119 @@
+import os
+
+# Conf
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'elastic')
+
+# Fields returned for each hit
+SOURCE_FIELDS = ["uuid", "description", "ingredients", "index_name"]
+
+# Variants are flags on the items, used as (cacheable) filters
+VARIANT_FIELDS = {"servings": "has_servings", "pieces": "has_pieces"}
+
+
+class ItemNotFound(Exception):
+    pass
+
+
+class FoodIndex():
+    """The interface of the search backends. Food items are added to and deleted from indexes,
+    which can be aliases on generations built for reloads, and searched with fuzzy matching on
+    their description. Search results are Elasticsearch-like responses, with the hits (and
+    their "_id", "_score" and "_source") sorted by score, or None if the index does not exist."""
+
+    async def init_index(self, index_name):
+        raise NotImplementedError()
+
+    async def reset_index(self, index_name):
+        raise NotImplementedError()
+
+    async def delete_index(self, index_name):
+        raise NotImplementedError()
+
+    async def build_generation(self, alias):
+        raise NotImplementedError()
+
+    async def swap_generation(self, alias, generation, keep=1):
+        raise NotImplementedError()
+
+    async def collect_generations(self, alias, keep=1):
+        raise NotImplementedError()
+
+    # Writes take a refresh policy: "false" (visible to searches on the next periodic refresh),
+    # "wait_for" (return once visible) or "true" (make them visible right away).
+
+    async def add_item(self, item, index_name, refresh='false'):
+        raise NotImplementedError()
+
+    async def delete_item(self, uuid, index_name, refresh='false'):
+        # Raises ItemNotFound if there is no such item
+        raise NotImplementedError()
+
+    async def delete_items(self, uuids, index_name, refresh='false'):
+        # Delete all the items with the given uuids at once, skipping the ones which are not
+        # there (as the index itself). Returns how many were deleted.
+        raise NotImplementedError()
+
+    async def bulk_items(self, operations, refresh='false'):
+        # Each operation is a dict with an "action" ("index" or "delete"), an "index_name", a "uuid"
+        # and, for the "index" action, the "item" to index. Returns one result per operation, in order.
+        raise NotImplementedError()
+
+    def scan_items(self):
+        # Async iterator on all the items of all the indexes, as (index name, uuid, source), with
+        # the source fields and the variant flags in the source
+        raise NotImplementedError()
+
+    async def query(self, q, index_name, variant=None, min_score=None, size=10, fuzzy=True, alternatives=None):
+        # With fuzzy set to false, only the exact terms (as analyzed) are matched. Alternatives,
+        # as lists by term of the query, are other terms which can match instead of it.
+        raise NotImplementedError()
+
+    async def multi_query(self, searches):
+        # Searches are dicts with the query() arguments. Returns one result per search, in order.
+        raise NotImplementedError()
+
+    async def suggest(self, q, index_name, size=5):
+        # Completions for a partially typed description (the last word can be just its start), as
+        # a list of at most size distinct {"uuid", "description"} dicts, or None if there is no index.
+        raise NotImplementedError()
+
+    async def ping(self):
+        # Whether the backend can be reached
+        raise NotImplementedError()
+
+    async def index_exists(self, index_name):
+        # Whether an index (or an alias on a generation) exists
+        raise NotImplementedError()
+
+    async def get_aliases(self):
+        # The aliases and the physical index each one points to
+        raise NotImplementedError()
+
+    async def close(self):
+        pass
+
+
+def get_suggestions(hits, size):
+    # The distinct descriptions of the hits, best first
+    suggestions = []
+    descriptions = set()
+    for hit in hits:
+        description = hit["_source"]["description"]
+        if description.lower() not in descriptions:
+            descriptions.add(description.lower())
+            suggestions.append({"uuid": hit["_source"]["uuid"], "description": description})
+            if len(suggestions) >= size:
+                break
+    return suggestions
+
+
+def get_backend(name=SEARCH_BACKEND):
+    # Imported here so that a backend dependencies are only required when using it
+    if name == 'elastic':
+        from .elastic import ElasticFood
+        return ElasticFood.from_conf()
+    elif name == 'embedded':
+        from .embedded import EmbeddedFood
+        return EmbeddedFood.from_conf()
+    else:
+        raise ValueError('Unknown search backend "{}"'.format(name))
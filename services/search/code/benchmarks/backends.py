@@ -0,0 +1,97 @@
+"""Comparison benchmark of the search backends.
+
+Loads the examples in a dedicated index on both Elasticsearch and the embedded
+backend, runs the same searches (with some typos) on both and reports their
+latency and searches per second, and how often the filtered hits agree.
+
+Run it from the root of the search container:
+
+    python3 -m code.benchmarks.backends --searches 2000
+"""
+import time
+import random
+import asyncio
+import argparse
+from ..main import filter_hits
+from ..elastic import ElasticFood, ELASTIC_HOST
+from ..embedded import EmbeddedFood
+from .concurrency import load_examples, get_queries, run
+
+INDEX_NAME = 'bench_food'
+
+
+def add_typo(q, rng):
+    # Swap two adjacent letters of the longest word
+    word = max(q.split(' '), key=len)
+    if len(word) < 4:
+        return q
+    i = rng.randrange(len(word) - 1)
+    return q.replace(word, word[:i] + word[i+1] + word[i] + word[i+2:], 1)
+
+
+def get_ids(response):
+    return [hit['_id'] for hit in filter_hits(response)]
+
+
+async def load(backend, examples):
+    await backend.reset_index(INDEX_NAME)
+    await backend.bulk_items([{'action': 'index', 'index_name': INDEX_NAME, 'uuid': example['uuid'],
+                               'item': dict(example, index_name=INDEX_NAME)} for example in examples])
+
+
+async def main(host, concurrency, searches):
+
+    es = ElasticFood(host, connections_per_node=concurrency)
+    embedded = EmbeddedFood()
+
+    # Load the examples
+    examples = load_examples()
+    await load(es, examples)
+    await es.indices.refresh(index=INDEX_NAME)
+    await load(embedded, examples)
+
+    rng = random.Random(42)
+    queries = [add_typo(q, rng) if i % 2 else q for i, q in enumerate(get_queries(examples, searches))]
+
+    try:
+        # Agreement of the (filtered) results
+        same = 0
+        distinct_queries = sorted(set(queries))
+        for q in distinct_queries:
+            es_ids = get_ids(await es.query(q, INDEX_NAME))
+            embedded_ids = get_ids(await embedded.query(q, INDEX_NAME))
+            same += es_ids == embedded_ids
+
+        results = {}
+        for name, backend in [('Elasticsearch', es), ('Embedded', embedded)]:
+            latencies = []
+
+            async def search(q):
+                start = time.perf_counter()
+                await backend.query(q, INDEX_NAME)
+                latencies.append(time.perf_counter() - start)
+
+            # Warm up
+            await run(search, queries[0:100], concurrency)
+            latencies.clear()
+
+            qps = await run(search, queries, concurrency)
+            latencies.sort()
+            results[name] = (qps, latencies[len(latencies)//2], latencies[int(len(latencies)*0.99)])
+    finally:
+        await es.delete_index(INDEX_NAME)
+        await es.close()
+
+    print('Examples: {}, searches: {}, concurrency: {}'.format(len(examples), searches, concurrency))
+    for name, (qps, p50, p99) in results.items():
+        print('{:<14} {:>8.1f} searches/s, p50 {:.2f} ms, p99 {:.2f} ms'.format(name + ':', qps, p50*1000, p99*1000))
+    print('Same filtered hits on {} out of {} distinct queries'.format(same, len(distinct_queries)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search backends comparison benchmark')
+    parser.add_argument('--host', default=ELASTIC_HOST)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--searches', type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(main(args.host, args.concurrency, args.searches))
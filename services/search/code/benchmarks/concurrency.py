@@ -0,0 +1,90 @@
+"""Concurrency benchmark for the Elasticsearch client of the search service.
+
+Loads the examples in a dedicated index and runs the same searches with the
+blocking client called straight from the event loop (as the search handlers
+used to do) and with the async one, reporting the searches per second.
+
+Run it from the root of the search container:
+
+    python3 -m code.benchmarks.concurrency --concurrency 32 --searches 2000
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+from elasticsearch import Elasticsearch
+from ..elastic import ElasticFood, ELASTIC_HOST, build_query
+
+EXAMPLES_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'examples.json')
+INDEX_NAME = 'bench_food'
+
+
+def load_examples(path=EXAMPLES_PATH):
+    # One JSON item per line
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def get_queries(examples, how_many):
+    # The first two words of each description, in turn
+    base_queries = [' '.join(example['description'].split(' ')[0:2]) for example in examples]
+    return [base_queries[i % len(base_queries)] for i in range(how_many)]
+
+
+async def run(search, queries, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited_search(q):
+        async with semaphore:
+            await search(q)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[limited_search(q) for q in queries])
+    return len(queries) / (time.perf_counter() - start)
+
+
+async def main(host, concurrency, searches):
+
+    es = ElasticFood(host, connections_per_node=concurrency)
+    blocking_es = Elasticsearch(host)
+
+    # Load the examples
+    examples = load_examples()
+    await es.reset_index(INDEX_NAME)
+    await es.bulk_items([{'action': 'index', 'index_name': INDEX_NAME, 'uuid': example['uuid'],
+                          'item': dict(example, index_name=INDEX_NAME)} for example in examples])
+    await es.indices.refresh(index=INDEX_NAME)
+    queries = get_queries(examples, searches)
+
+    # Before: the blocking client serializes the searches on the event loop
+    async def blocking_search(q):
+        blocking_es.search(index=INDEX_NAME, body=build_query(q))
+
+    # After: the async client keeps up to "concurrency" searches in flight
+    async def async_search(q):
+        await es.query(q, INDEX_NAME)
+
+    try:
+        # Warm up
+        await run(async_search, queries[0:100], concurrency)
+
+        blocking_qps = await run(blocking_search, queries, concurrency)
+        async_qps = await run(async_search, queries, concurrency)
+    finally:
+        await es.delete_index(INDEX_NAME)
+        await es.close()
+        blocking_es.close()
+
+    print('Examples: {}, searches: {}, concurrency: {}'.format(len(examples), searches, concurrency))
+    print('Blocking client: {:.1f} searches/s'.format(blocking_qps))
+    print('Async client:    {:.1f} searches/s ({:.1f}x)'.format(async_qps, async_qps/blocking_qps))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search service concurrency benchmark')
+    parser.add_argument('--host', default=ELASTIC_HOST)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--searches', type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(main(args.host, args.concurrency, args.searches))
@@ -0,0 +1,78 @@
+"""Comparison benchmark of the hits grouping strategies.
+
+Searches the examples (on the embedded backend, so that no Elasticsearch is
+needed) and compares which hits the main ingredient and the clusters groupings
+keep as close, then times both on synthetic hits lists of growing size.
+
+Run it from the root of the search container:
+
+    python3 -m code.benchmarks.grouping
+"""
+import copy
+import time
+import random
+import asyncio
+import argparse
+from ..main import filter_hits
+from ..embedded import EmbeddedFood
+from .concurrency import load_examples
+
+INDEX_NAME = 'bench_food_grouping'
+GROUPINGS = ['main_ingredient', 'clusters']
+
+
+def get_close_ids(response, grouping, max_diff):
+    return [hit['_id'] for hit in filter_hits(copy.deepcopy(response), min_score=0, max_diff=max_diff, grouping=grouping)]
+
+
+def get_synthetic_hits(examples, how_many, rng):
+    hits = [{'_id': str(i), '_score': rng.uniform(1, 2), '_source': rng.choice(examples)} for i in range(how_many)]
+    hits.sort(key=lambda hit: hit['_score'], reverse=True)
+    return {'hits': {'hits': hits}}
+
+
+async def main(max_diff, sizes, repeats):
+
+    examples = load_examples()
+    backend = EmbeddedFood()
+    await backend.bulk_items([{'action': 'index', 'index_name': INDEX_NAME, 'uuid': example['uuid'],
+                               'item': dict(example, index_name=INDEX_NAME)} for example in examples])
+
+    # What the groupings keep, on the words of the descriptions
+    queries = sorted(set(word.lower() for example in examples for word in example['description'].split(' ') if len(word) >= 3))
+    same = 0
+    sizes_by_grouping = {grouping: 0 for grouping in GROUPINGS}
+    for q in queries:
+        response = await backend.query(q, INDEX_NAME, size=50)
+        ids = {grouping: get_close_ids(response, grouping, max_diff) for grouping in GROUPINGS}
+        same += ids['main_ingredient'] == ids['clusters']
+        for grouping in GROUPINGS:
+            sizes_by_grouping[grouping] += len(ids[grouping])
+    await backend.close()
+
+    print('Examples: {}, queries: {}, max_diff: {}'.format(len(examples), len(queries), max_diff))
+    print('Same close hits on {} out of {} queries'.format(same, len(queries)))
+    for grouping in GROUPINGS:
+        print('{:<16} {:.2f} close hits per query'.format(grouping + ':', sizes_by_grouping[grouping] / len(queries)))
+
+    # How long they take
+    rng = random.Random(42)
+    for size in sizes:
+        response = get_synthetic_hits(examples, size, rng)
+        timings = []
+        for grouping in GROUPINGS:
+            responses = [copy.deepcopy(response) for _ in range(repeats)]
+            start = time.perf_counter()
+            for response_copy in responses:
+                filter_hits(response_copy, min_score=0, max_diff=max_diff, see_also=True, grouping=grouping)
+            timings.append('{} {:.3f} ms'.format(grouping, (time.perf_counter() - start) / repeats * 1000))
+        print('{:>5} hits: {}'.format(size, ', '.join(timings)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hits grouping strategies comparison benchmark')
+    parser.add_argument('--max-diff', type=float, default=0.3)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50, 200, 500])
+    parser.add_argument('--repeats', type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(main(args.max_diff, args.sizes, args.repeats))
@@ -0,0 +1,209 @@
+"""Load benchmark of the search service endpoints.
+
+Loads the examples, scaled up to the given catalog size with synthetic variants,
+in a dedicated index through the search service itself. Then replays queries on
+each endpoint at the given concurrency: the example descriptions (some with
+synthetic typos) and the recorded ones, if given. Reports the latency
+percentiles and the requests per second for each endpoint, and writes them as
+JSON with --output, to keep track of regressions. Repeated queries can be served
+by the search service cache (run it with CACHE_MAX_ENTRIES=0 to avoid that).
+
+Export the recorded queries from the webapp container, with:
+
+    python3 manage.py core_export_queries --output /data/queries.txt
+
+and, once the file is copied over, run it from the root of the search container:
+
+    python3 -m code.benchmarks.load --catalog-size 10000 --queries /data/queries.txt --output /data/load.json
+"""
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import aiohttp
+from datetime import datetime, timezone
+from .concurrency import load_examples
+from .backends import add_typo
+from .suggest import get_percentile
+
+INDEX_NAME = 'bench_food_load'
+CONFIRMATION_CODE = 'DEADBEEF'
+ENDPOINTS = ['search', 'msearch', 'suggest']
+
+# Added to the example descriptions for the synthetic variants
+QUALIFIERS = ['fatto in casa', 'light', 'integrale', 'senza glutine', 'al forno', 'surgelato',
+              'della nonna', 'biologico', 'con panna', 'piccante', 'alla griglia', 'in brodo']
+
+
+def scale_examples(examples, catalog_size):
+    # The examples as they are, and then with one or two qualifiers (and their own uuids)
+    items = []
+    for i in range(catalog_size):
+        example = examples[i % len(examples)]
+        variant = i // len(examples)
+        if not variant:
+            items.append(example)
+            continue
+        qualifiers = [QUALIFIERS[(variant - 1) % len(QUALIFIERS)]]
+        if variant > len(QUALIFIERS) and QUALIFIERS[((variant - 1) // len(QUALIFIERS)) % len(QUALIFIERS)] not in qualifiers:
+            qualifiers.append(QUALIFIERS[((variant - 1) // len(QUALIFIERS)) % len(QUALIFIERS)])
+        items.append(dict(example,
+                          uuid=str(uuid.uuid5(uuid.NAMESPACE_URL, '{}/{}'.format(example['uuid'], variant))),
+                          description='{} {}'.format(example['description'], ' '.join(qualifiers))))
+    return items
+
+
+def load_queries(path):
+    # One query per line, as exported from the webapp
+    with open(path) as f:
+        return [' '.join(line.split()) for line in f if line.strip()]
+
+
+def get_queries(examples, recorded, how_many, typos, recorded_share, rng):
+    # The first two words of the descriptions (some with a typo), mixed with the recorded queries
+    synthetic = [' '.join(example['description'].split(' ')[0:2]) for example in examples]
+    recorded = [q for q in recorded if 3 <= len(q) <= 100]
+    queries = []
+    for _ in range(how_many):
+        if recorded and rng.random() < recorded_share:
+            queries.append(rng.choice(recorded))
+        else:
+            q = rng.choice(synthetic)
+            queries.append(add_typo(q, rng) if rng.random() < typos else q)
+    return queries
+
+
+async def load(session, host, items, chunk_size=500):
+    async with session.post('{}/api/v1/manage/'.format(host),
+                            json={'command': 'reset', 'index_name': INDEX_NAME, 'confirmation_code': CONFIRMATION_CODE}) as response:
+        response.raise_for_status()
+    for start in range(0, len(items), chunk_size):
+        operations = [{'action': 'index', 'index_name': INDEX_NAME, 'uuid': item['uuid'], 'description': item['description'],
+                       'ingredients': item['ingredients']} for item in items[start:start+chunk_size]]
+        last = start + chunk_size >= len(items)
+        async with session.post('{}/api/v1/bulk/'.format(host), json={'operations': operations},
+                                params={'refresh': 'wait_for' if last else 'false'}) as response:
+            response.raise_for_status()
+            errors = (await response.json())['errors']
+        if errors:
+            raise Exception('Could not load {} items, first error: {}'.format(len(errors), errors[0]))
+
+
+def get_requests(endpoint, host, queries, batch_size, format, rng):
+    # The (method, url, params, json) of each request to an endpoint
+    if endpoint == 'search':
+        return [('GET', '{}/api/v1/search'.format(host), {'q': q, 'index_name': INDEX_NAME, 'format': format}, None) for q in queries]
+    elif endpoint == 'msearch':
+        return [('POST', '{}/api/v1/msearch/'.format(host), None,
+                 {'searches': [{'q': q, 'index_name': INDEX_NAME} for q in queries[i:i+batch_size]], 'format': format})
+                for i in range(0, len(queries), batch_size)]
+    elif endpoint == 'suggest':
+        return [('GET', '{}/api/v1/suggest'.format(host), {'q': q[0:rng.randint(2, len(q))], 'index_name': INDEX_NAME}, None) for q in queries]
+    raise ValueError('Unknown endpoint "{}"'.format(endpoint))
+
+
+async def run(session, requests, concurrency):
+    # Latencies of the successful requests, the number of errors and the requests per second
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = []
+
+    async def perform(method, url, params, payload):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                async with session.request(method, url, params=params, json=payload) as response:
+                    await response.read()
+                    if response.status != 200:
+                        errors.append(response.status)
+                        return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                errors.append(str(e))
+                return
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[perform(*request) for request in requests])
+    return latencies, len(errors), len(requests) / (time.perf_counter() - start)
+
+
+def get_stats(latencies, errors, qps, requests, searches_per_request=1):
+    latencies = sorted(latencies)
+    stats = {'requests': requests, 'errors': errors, 'qps': round(qps, 1), 'searches_per_second': round(qps * searches_per_request, 1)}
+    for percentile in [50, 95, 99]:
+        stats['p{}_ms'.format(percentile)] = round(get_percentile(latencies, percentile) * 1000, 3) if latencies else None
+    stats['mean_ms'] = round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None
+    return stats
+
+
+async def main(args):
+
+    rng = random.Random(args.seed)
+    examples = load_examples()
+    items = scale_examples(examples, args.catalog_size)
+    recorded = load_queries(args.queries) if args.queries else []
+    queries = get_queries(examples, recorded, args.requests, args.typos, args.recorded_share, rng)
+
+    results = {'timestamp': datetime.now(timezone.utc).isoformat(),
+               'host': args.host,
+               'catalog_size': len(items),
+               'concurrency': args.concurrency,
+               'recorded_queries': len(recorded),
+               'endpoints': {}}
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=args.timeout)) as session:
+        start = time.perf_counter()
+        await load(session, args.host, items)
+        results['load_seconds'] = round(time.perf_counter() - start, 3)
+        try:
+            for endpoint in args.endpoints:
+                requests = get_requests(endpoint, args.host, queries, args.batch_size, args.format, rng)
+
+                # Warm up
+                await run(session, requests[0:args.warmup], args.concurrency)
+
+                latencies, errors, qps = await run(session, requests, args.concurrency)
+                results['endpoints'][endpoint] = get_stats(latencies, errors, qps, len(requests),
+                                                           args.batch_size if endpoint == 'msearch' else 1)
+        finally:
+            if not args.keep:
+                async with session.post('{}/api/v1/manage/'.format(args.host),
+                                        json={'command': 'delete', 'index_name': INDEX_NAME, 'confirmation_code': CONFIRMATION_CODE}):
+                    pass
+
+    print('Catalog: {} items (loaded in {:.1f} s), recorded queries: {}, concurrency: {}'.format(
+          len(items), results['load_seconds'], len(recorded), args.concurrency), file=sys.stderr)
+    for endpoint, stats in results['endpoints'].items():
+        print('{:<8} {:>8.1f} requests/s, p50 {} ms, p95 {} ms, p99 {} ms, {} errors'.format(
+              endpoint + ':', stats['qps'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['errors']), file=sys.stderr)
+
+    if args.output == '-':
+        print(json.dumps(results, indent=2))
+    elif args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search service load benchmark')
+    parser.add_argument('--host', default='http://localhost:80', help='The search service (not Elasticsearch)')
+    parser.add_argument('--catalog-size', type=int, default=1000)
+    parser.add_argument('--queries', default=None, help='Recorded queries, one per line')
+    parser.add_argument('--recorded-share', type=float, default=0.5, help='Share of recorded queries, if any')
+    parser.add_argument('--typos', type=float, default=0.3, help='Share of synthetic queries with a typo')
+    parser.add_argument('--endpoints', nargs='+', default=ENDPOINTS, choices=ENDPOINTS)
+    parser.add_argument('--requests', type=int, default=2000, help='Queries per endpoint')
+    parser.add_argument('--batch-size', type=int, default=10, help='Searches per msearch request')
+    parser.add_argument('--format', default='compact', choices=['full', 'compact'])
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keep', action='store_true', help='Keep the benchmark index')
+    parser.add_argument('--output', default=None, help='JSON results file ("-" for the standard output)')
+    asyncio.run(main(parser.parse_args()))
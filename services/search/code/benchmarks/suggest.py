@@ -0,0 +1,78 @@
+"""Latency benchmark for the suggestions (prefix autocomplete).
+
+Loads the examples in a dedicated index and asks for suggestions as if the
+descriptions were typed one character at a time, reporting the latency
+percentiles and checking the 99th one against a target.
+
+Run it from the root of the search container:
+
+    python3 -m code.benchmarks.suggest --backend elastic --target 10
+"""
+import sys
+import time
+import asyncio
+import argparse
+from ..backend import get_backend
+from .concurrency import load_examples, run
+
+INDEX_NAME = 'bench_food_suggest'
+
+
+def get_prefixes(examples, how_many, min_length=2):
+    # What gets typed, from the first characters to the whole description
+    base_prefixes = [example['description'][0:i] for example in examples
+                     for i in range(min_length, len(example['description']) + 1)]
+    return [base_prefixes[i % len(base_prefixes)] for i in range(how_many)]
+
+
+def get_percentile(sorted_values, percentile):
+    return sorted_values[min(int(len(sorted_values) * percentile / 100), len(sorted_values) - 1)]
+
+
+async def main(backend_name, concurrency, suggestions, target):
+
+    backend = get_backend(backend_name)
+
+    # Load the examples
+    examples = load_examples()
+    await backend.reset_index(INDEX_NAME)
+    await backend.bulk_items([{'action': 'index', 'index_name': INDEX_NAME, 'uuid': example['uuid'],
+                               'item': dict(example, index_name=INDEX_NAME)} for example in examples], refresh='true')
+    prefixes = get_prefixes(examples, suggestions)
+
+    latencies = []
+
+    async def suggest(q):
+        start = time.perf_counter()
+        await backend.suggest(q, INDEX_NAME)
+        latencies.append(time.perf_counter() - start)
+
+    try:
+        # Warm up
+        await run(suggest, prefixes[0:100], concurrency)
+        latencies.clear()
+
+        qps = await run(suggest, prefixes, concurrency)
+    finally:
+        await backend.delete_index(INDEX_NAME)
+        await backend.close()
+
+    latencies.sort()
+    p50, p95, p99 = [get_percentile(latencies, percentile) * 1000 for percentile in [50, 95, 99]]
+    print('Backend: {}, examples: {}, suggestions: {}, concurrency: {}'.format(backend_name, len(examples), suggestions, concurrency))
+    print('{:.1f} suggestions/s, p50 {:.2f} ms, p95 {:.2f} ms, p99 {:.2f} ms'.format(qps, p50, p95, p99))
+    if p99 > target:
+        print('Above the {} ms target'.format(target))
+        return False
+    print('Within the {} ms target'.format(target))
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search service suggestions benchmark')
+    parser.add_argument('--backend', default='elastic', choices=['elastic', 'embedded'])
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--suggestions', type=int, default=2000)
+    parser.add_argument('--target', type=float, default=10, help='99th percentile latency target, in ms')
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(main(args.backend, args.concurrency, args.suggestions, args.target)) else 1)
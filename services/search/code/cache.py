@@ -0,0 +1,159 @@
+import os
+import time
+import fcntl
+from urllib.parse import quote
+from collections import OrderedDict
+
+import logging
+logger = logging.getLogger('uvicorn')
+
+# Name of the version entry for all the indexes together
+ALL_INDEXES = '_all'
+
+
+class IndexVersions():
+    """Versions of the indexes, bumped on every write, with the time of their last write not
+    refreshed yet (if any). Searches with no index name go on all the indexes, which have a
+    version of their own, bumped on any write (and settling on any write not refreshed yet)."""
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, index_name):
+        # As a (version, updated at) pair
+        return self.entries.get(ALL_INDEXES if index_name is None else index_name, (0, None))
+
+    def bump(self, index_name, refreshed=False):
+        # Returns the previous and the new version of all the indexes
+        return self.update(index_name, refreshed, time.time())
+
+    def update(self, index_name, refreshed, now):
+        # Writes already made visible by a refresh need no settle time, and neither
+        # do the previous ones on the same index (refreshes are for the whole index)
+        if index_name is not None:
+            version, _ = self.get(index_name)
+            self.entries[index_name] = (version + 1, None if refreshed else now)
+        all_version, all_updated_at = self.get(None)
+        self.entries[ALL_INDEXES] = (all_version + 1, all_updated_at if refreshed else now)
+        return all_version, all_version + 1
+
+
+class SharedIndexVersions(IndexVersions):
+    """Index versions shared by all the worker processes on a host, as small files in a directory
+    (one per index, never removed so that versions never go back), so that a write through any
+    worker invalidates the cached results and settles the cache on all of them."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def get_file_path(self, index_name):
+        return os.path.join(self.path, quote(ALL_INDEXES if index_name is None else index_name, safe=''))
+
+    def read(self, f):
+        version, _, updated_at = f.read().partition(b' ')
+        return (int(version or 0), float(updated_at) if updated_at.strip() else None)
+
+    def get(self, index_name):
+        try:
+            with open(self.get_file_path(index_name), 'rb') as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                return self.read(f)
+        except FileNotFoundError:
+            return (0, None)
+
+    def write(self, index_name, entry_update):
+        # Update an entry in place, under an exclusive lock
+        with open(os.open(self.get_file_path(index_name), os.O_RDWR | os.O_CREAT, 0o644), 'r+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            version, updated_at = entry_update(*self.read(f))
+            f.seek(0)
+            f.truncate()
+            f.write('{} {}'.format(version, '' if updated_at is None else repr(updated_at)).encode())
+        return version
+
+    def update(self, index_name, refreshed, now):
+        if index_name is not None:
+            self.write(index_name, lambda version, updated_at: (version + 1, None if refreshed else now))
+        all_version = self.write(None, lambda version, updated_at: (version + 1, updated_at if refreshed else now))
+        return all_version - 1, all_version
+
+
+class SearchCache():
+    """In-process LRU cache with TTL for the search results. Keys embed the version of the
+    index at lookup time, and writes on an index bump its version, so stale entries are
+    never hit again and just age out. With shared versions (see SharedIndexVersions),
+    writes through any worker process invalidate the entries of all of them."""
+
+    def __init__(self, max_entries=1000, ttl=300, settle_time=1.0, versions=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # Writes become visible to searches only after an index refresh, so do
+        # not cache results for an index which was written less than this ago.
+        self.settle_time = settle_time
+        self.versions = versions if versions is not None else IndexVersions()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def version(self, index_name):
+        # Searches with no index name go on all the indexes
+        return self.versions.get(index_name)[0]
+
+    def bump(self, index_name, refreshed=False):
+        # Returns the previous and the new version of all the indexes
+        versions = self.versions.bump(index_name, refreshed=refreshed)
+        logger.debug('SearchCache: index "{}" written, all the indexes now at version {}'.format(index_name, versions[1]))
+        return versions
+
+    def key(self, q, index_name, **params):
+        # Searches are case insensitive and split on whitespaces
+        q = ' '.join(q.lower().split())
+        return (index_name, self.version(index_name), q, tuple(sorted(params.items())))
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        try:
+            expires_at, value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        _, updated_at = self.versions.get(key[0])
+        if updated_at is not None and time.time() - updated_at < self.settle_time:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {"entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations}
@@ -1,74 +1,267 @@
-from elasticsearch import Elasticsearch
+import os
+from datetime import datetime
+from elasticsearch import AsyncElasticsearch
 from elasticsearch.exceptions import NotFoundError
+from elasticsearch.helpers import async_streaming_bulk, async_scan
+from .analysis import ANALYSIS
+from .backend import FoodIndex, ItemNotFound, SOURCE_FIELDS, VARIANT_FIELDS, get_suggestions
 
 import logging
 logger = logging.getLogger('uvicorn') # TODO: meh...
 
-class ElasticFood(Elasticsearch):
+# Conf
+ELASTIC_HOST = os.environ.get('ELASTIC_HOST', 'http://elastic:9200')
+ELASTIC_CONNECTIONS = int(os.environ.get('ELASTIC_CONNECTIONS', 20))
+ELASTIC_TIMEOUT = float(os.environ.get('ELASTIC_TIMEOUT', 10))
+
+
+def build_query(q, variant=None, min_score=None, size=10, fuzzy=True, alternatives=None, source=SOURCE_FIELDS):
+    #search_query = {"query": {"fuzzy": {"description": q}}}
+    # Exact terms only (with fuzzy set to false), much cheaper
+    fuzziness = {"fuzziness": "AUTO"} if fuzzy else {}
+    # All the terms must match, the ones with alternatives on any of them (scores add up the same)
+    alternatives = alternatives or {}
+    terms = ' '.join(term for term in q.split() if term not in alternatives) if alternatives else q
+    must = [{"match": {"description": dict({"query": ' '.join([term] + alternatives[term])}, **fuzziness)}}
+            for term in q.split() if term in alternatives]
+    if terms or not must:
+        must.insert(0, {"multi_match": dict({"query": terms, "fields": ["description"], "operator": "and"}, **fuzziness)})
+    search_query = {
+                     "query": {
+                       "bool": {
+                         "must": must[0] if len(must) == 1 else must
+                       }
+                     },
+                     "size": size,
+                     "_source": source,
+                     "track_total_hits": False
+                   }
+    # Only search on a given variant
+    if variant:
+        search_query["query"]["bool"]["filter"] = [{"term": {VARIANT_FIELDS[variant]: True}}]
+    # Let Elasticsearch drop the low scoring hits
+    if min_score:
+        search_query["min_score"] = min_score
+    return search_query
+
+
+class ElasticFood(AsyncElasticsearch, FoodIndex):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    def init_index(self, index_name):
-        self.create_index(index_name)
+    @classmethod
+    def from_conf(cls):
+        # One client (and one connection pool) per worker, able to keep up to
+        # ELASTIC_CONNECTIONS requests in flight towards Elasticsearch
+        return cls(ELASTIC_HOST,
+                   connections_per_node=ELASTIC_CONNECTIONS,
+                   request_timeout=ELASTIC_TIMEOUT)
+
+    async def init_index(self, index_name):
+        await self.create_index(index_name)
+
+    async def reset_index(self, index_name):
+        for index in await self.get_indexes(index_name):
+            await self.indices.delete(index=index)
+        await self.create_index(index_name)
+
+    async def delete_index(self, index_name):
+        index_name = self.default_index_name if not index_name else index_name
+        for index in await self.get_indexes(index_name) or [index_name]:
+            await self.indices.delete(index=index)
+
+    async def get_indexes(self, index_name):
+        # All the physical indexes for an index name, which can be an alias (plus all its generations)
+        indexes = []
+        if await self.indices.exists_alias(name=index_name):
+            indexes += list((await self.indices.get_alias(name=index_name)).keys())
+        elif await self.indices.exists(index=index_name):
+            indexes.append(index_name)
+        indexes += [generation for generation in await self.get_generations(index_name) if generation not in indexes]
+        return indexes
 
-    def reset_index(self, index_name):
-        if self.indices.exists(index=index_name):
-            self.indices.delete(index=index_name)
-        self.create_index(index_name)
+    async def get_generations(self, alias):
+        # The physical indexes built for an alias, oldest first
+        return sorted((await self.indices.get_alias(index='{}-gen-*'.format(alias))).keys())
 
-    def delete_index(self, index_name):
-        self.indices.delete(index=self.default_index_name if not index_name else index_name)
+    async def index_exists(self, index_name):
+        # Aliases count as well (ping() comes from the client)
+        return bool(await self.indices.exists(index=index_name))
 
-    def create_index(self, index_name):
+    async def get_aliases(self):
+        return {alias: index for index, index_aliases in (await self.indices.get_alias()).items()
+                for alias in index_aliases.get("aliases", {})}
+
+    async def build_generation(self, alias):
+        # A new physical index for the alias, tuned for bulk loading until swapped in
+        generation = '{}-gen-{}'.format(alias, datetime.utcnow().strftime('%Y%m%d%H%M%S%f'))
+        await self.create_index(generation, settings={"number_of_replicas": 0, "refresh_interval": "-1"})
+        logger.debug('ElasticFood: built generation "{}" for "{}"'.format(generation, alias))
+        return generation
+
+    async def swap_generation(self, alias, generation, keep=1):
+
+        # Restore the search settings and make everything searchable
+        await self.indices.put_settings(index=generation, settings={"number_of_replicas": 1, "refresh_interval": None})
+        await self.indices.refresh(index=generation)
+
+        # Atomically move the alias on the new generation
+        actions = []
+        if await self.indices.exists_alias(name=alias):
+            for index in (await self.indices.get_alias(name=alias)).keys():
+                actions.append({"remove": {"index": index, "alias": alias}})
+        elif await self.indices.exists(index=alias):
+            # A plain index from before using aliases, replace it
+            actions.append({"remove_index": {"index": alias}})
+        actions.append({"add": {"index": generation, "alias": alias}})
+        await self.indices.update_aliases(actions=actions)
+        logger.debug('ElasticFood: swapped "{}" on generation "{}"'.format(alias, generation))
+
+        return await self.collect_generations(alias, keep=keep)
+
+    async def collect_generations(self, alias, keep=1):
+        # Delete the generations older than the current one, but the last "keep" ones
+        if not await self.indices.exists_alias(name=alias):
+            return []
+        current = list((await self.indices.get_alias(name=alias)).keys())
+        older = [generation for generation in await self.get_generations(alias)
+                 if generation not in current and generation < max(current)]
+        collected = older[:-keep] if keep else older
+        for generation in collected:
+            await self.indices.delete(index=generation)
+        logger.debug('ElasticFood: collected generations "{}" for "{}"'.format(collected, alias))
+        return collected
+
+    async def create_index(self, index_name, settings=None):
         try:
-            if not self.indices.exists(index=index_name):
+            if not await self.indices.exists(index=index_name):
                 # Define the index mapping
                 mapping = {
-                    "settings": {"number_of_shards": 1, "number_of_replicas": 1},
+                    "settings": dict({"number_of_shards": 1, "number_of_replicas": 1, "analysis": ANALYSIS}, **(settings or {})),
                     "mappings": {
                         "properties": {
                             "uuid": {"type": "keyword"},
-                            "description": {"type": "text"},
+                            "description": {"type": "text",
+                                            "analyzer": "italian_food",
+                                            # Edge n-grams (and shingles) for the prefix suggestions
+                                            "fields": {"suggest": {"type": "search_as_you_type",
+                                                                   "analyzer": "italian_food_suggest"}}},
                             "ingredients": {"type": "keyword"},
+                            "has_servings": {"type": "boolean"},
+                            "has_pieces": {"type": "boolean"},
                         }
                     },
                 }
                 # Create the index with the mapping
-                self.indices.create(index=index_name, body=mapping)
+                await self.indices.create(index=index_name, body=mapping)
                 print(f"Index '{index_name}' created.")
             else:
                 print(f"Index '{index_name}' already exists.")
         except NotFoundError as e:
             print(f"Error checking/creating index: {e}")
 
-    def add_item(self, item, index_name):
+    async def add_item(self, item, index_name, refresh='false'):
         logger.debug('ElasticFood: adding "{}" on index "{}"'.format(str(item["uuid"]), index_name))
-        return self.index(index=index_name, id=str(item["uuid"]), body=item)
+        return await self.index(index=index_name, id=str(item["uuid"]), body=item, refresh=refresh)
 
-    def delete_item(self, uuid, index_name):
+    async def delete_item(self, uuid, index_name, refresh='false'):
         logger.debug('ElasticFood: deleting "{}" on index "{}"'.format(uuid, index_name))
-        return self.delete(index=index_name, id=uuid)
-
-    def query(self, q, index_name):
-        #search_query = {"query": {"fuzzy": {"description": q}}}
-        search_query = {
-                          "query": {
-                            "multi_match": {
-                              "query": q,
-                              "fields": ["description"],
-                              "fuzziness": "AUTO",
-                              "operator": "and"
-                            }
-                          }
-                        }
-        logger.debug('ElasticFood: searching for "{}" on index "{}"'.format(q, index_name))
         try:
-            results = self.search(index=index_name, body=search_query)
+            return await self.delete(index=index_name, id=uuid, refresh=refresh)
+        except NotFoundError as e:
+            raise ItemNotFound(str(e))
+
+    async def delete_items(self, uuids, index_name, refresh='false'):
+        # A single delete by query on the ids (which can only refresh right away, also for "wait_for")
+        logger.debug('ElasticFood: deleting {} items on index "{}"'.format(len(uuids), index_name))
+        if not uuids:
+            return 0
+        response = await self.delete_by_query(index=index_name, query={"ids": {"values": [str(uuid) for uuid in uuids]}},
+                                              refresh=refresh != 'false', conflicts='proceed', ignore_unavailable=True)
+        return response["deleted"]
+
+    async def bulk_items(self, operations, refresh='false', chunk_size=500):
+        # Each operation is a dict with an "action" ("index" or "delete"), an "index_name", a "uuid"
+        # and, for the "index" action, the "item" to index. Returns one result per operation, in order.
+        # The refresh is not done on every chunk, but once at the end (for both "true" and "wait_for").
+        actions = []
+        for operation in operations:
+            action = {"_op_type": operation["action"],
+                      "_index": operation["index_name"],
+                      "_id": str(operation["uuid"])}
+            if operation["action"] == "index":
+                action["_source"] = operation["item"]
+            actions.append(action)
+        logger.debug('ElasticFood: bulk of {} operations'.format(len(actions)))
+
+        results = []
+        async for ok, info in async_streaming_bulk(self, actions, chunk_size=chunk_size,
+                                                   raise_on_error=False, raise_on_exception=False):
+            op_type, outcome = next(iter(info.items()))
+            # Deleting something which is not there is not an error (as for the single delete)
+            if not ok and op_type == "delete" and outcome.get("status") == 404:
+                ok = True
+            results.append({"ok": ok,
+                            "status": outcome.get("status"),
+                            "error": None if ok else str(outcome.get("error"))})
+
+        if refresh != 'false' and operations:
+            await self.indices.refresh(index=','.join(sorted(set(operation["index_name"] for operation in operations))))
+        return results
+
+    async def scan_items(self):
+        async for hit in async_scan(self, index='_all', query={"_source": SOURCE_FIELDS + list(VARIANT_FIELDS.values())}):
+            if "description" in hit["_source"]:
+                yield hit["_index"], hit["_id"], hit["_source"]
+
+    async def query(self, q, index_name, variant=None, min_score=None, size=10, fuzzy=True, alternatives=None):
+        search_query = build_query(q, variant=variant, min_score=min_score, size=size, fuzzy=fuzzy, alternatives=alternatives)
+        logger.debug('ElasticFood: searching for "{}" on index "{}" (variant "{}")'.format(q, index_name, variant))
+        try:
+            results = await self.search(index=index_name, body=search_query)
         except NotFoundError:
             return None
         logger.debug('ElasticFood: got results: "%s"', results)
         return results
 
+    async def suggest(self, q, index_name, size=5):
+        # Prefix matching on the words of the description, last word as a prefix
+        search_query = {"query": {"multi_match": {"query": q,
+                                                  "type": "bool_prefix",
+                                                  "operator": "and",
+                                                  "fields": ["description.suggest",
+                                                             "description.suggest._2gram",
+                                                             "description.suggest._3gram"]}},
+                        # Some more, as the same description can be there more than once
+                        "size": size * 2,
+                        "_source": ["uuid", "description"],
+                        "track_total_hits": False}
+        try:
+            results = await self.search(index=index_name, body=search_query)
+        except NotFoundError:
+            return None
+        return get_suggestions(results["hits"]["hits"], size)
 
-es = ElasticFood("http://elastic:9200")
+    async def multi_query(self, searches):
+        # Searches are dicts with the query() arguments, all performed in a single _msearch
+        # round trip. Returns one result per search, in order (None if its index does not exist).
+        body = []
+        for search in searches:
+            body.append({"index": search["index_name"]} if search["index_name"] else {})
+            body.append(build_query(search["q"], variant=search.get("variant"),
+                                    min_score=search.get("min_score"), size=search.get("size", 10),
+                                    fuzzy=search.get("fuzzy", True), alternatives=search.get("alternatives")))
+        logger.debug('ElasticFood: multi-searching for "{}"'.format(searches))
+        responses = (await self.msearch(searches=body))["responses"]
+
+        results = []
+        for response in responses:
+            if "error" in response:
+                if response["error"].get("type") == "index_not_found_exception":
+                    results.append(None)
+                    continue
+                raise Exception(response["error"])
+            results.append(response)
+        logger.debug('ElasticFood: got results: "%s"', results)
+        return results
@@ -0,0 +1,445 @@
+import os
+import json
+import math
+import time
+import struct
+import asyncio
+from datetime import datetime
+from bisect import bisect_left
+from .backend import FoodIndex, ItemNotFound, SOURCE_FIELDS, VARIANT_FIELDS, get_suggestions
+from .analysis import analyze, tokenize, stem
+
+import logging
+logger = logging.getLogger('uvicorn')
+
+# Conf
+EMBEDDED_PATH = os.environ.get('EMBEDDED_PATH', '/data/embedded.json')
+EMBEDDED_SAVE_DELAY = float(os.environ.get('EMBEDDED_SAVE_DELAY', 1.0))
+
+# Scoring and fuzzy matching parameters, as the Elasticsearch defaults
+K1 = 1.2
+B = 0.75
+MAX_EXPANSIONS = 50
+MAX_CACHED_EXPANSIONS = 10000
+
+def get_max_edits(term):
+    # As the Elasticsearch "AUTO" fuzziness
+    if len(term) <= 2:
+        return 0
+    elif len(term) <= 5:
+        return 1
+    else:
+        return 2
+
+
+def edit_distance(a, b, max_distance):
+    # Damerau-Levenshtein (optimal string alignment) distance, or max_distance+1 if above it
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i-1] == b[j-1] else 1
+            current[j] = min(previous[j] + 1, current[j-1] + 1, previous[j-1] + cost)
+            if i > 1 and j > 1 and a[i-1] == b[j-2] and a[i-2] == b[j-1]:
+                current[j] = min(current[j], previous_previous[j-2] + 1)
+        # No way to get back below the max distance
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+
+def to_float32(value):
+    # Scores as Elasticsearch returns them (single precision, shortest representation)
+    value32 = struct.unpack('f', struct.pack('f', value))[0]
+    for precision in range(6, 10):
+        shortest = float('{:.{}g}'.format(value32, precision))
+        if struct.unpack('f', struct.pack('f', shortest))[0] == value32:
+            return shortest
+    return value32
+
+
+def write_json(path, data):
+    # Write on a temporary file and then move it, so that the file is never left half-written
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+class EmbeddedIndex():
+    """Inverted index on the (analyzed) food descriptions, scored with BM25 and with typo-tolerant
+    matching mimicking the Elasticsearch fuzzy "multi_match" with the "and" operator."""
+
+    def __init__(self):
+        self.docs = {}
+        self.positions = {}
+        self.lengths = {}
+        self.postings = {}
+        self.terms_by_length = {}
+        self.total_length = 0
+        self.counter = 0
+        self.expansions = {}
+        self.sorted_terms = None
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, id, source):
+        result = 'created'
+        if id in self.docs:
+            self.remove(id)
+            result = 'updated'
+        terms = analyze(source.get('description', ''))
+        self.docs[id] = source
+        self.positions[id] = self.counter
+        self.counter += 1
+        self.lengths[id] = len(terms)
+        self.total_length += len(terms)
+        for term in terms:
+            if term not in self.postings:
+                self.postings[term] = {}
+                self.terms_by_length.setdefault(len(term), set()).add(term)
+                self.vocabulary_changed()
+            self.postings[term][id] = self.postings[term].get(id, 0) + 1
+        return result
+
+    def remove(self, id):
+        if id not in self.docs:
+            return False
+        for term in set(analyze(self.docs[id].get('description', ''))):
+            del self.postings[term][id]
+            if not self.postings[term]:
+                del self.postings[term]
+                self.terms_by_length[len(term)].discard(term)
+                self.vocabulary_changed()
+        self.total_length -= self.lengths.pop(id)
+        del self.positions[id]
+        del self.docs[id]
+        return True
+
+    def vocabulary_changed(self):
+        self.expansions = {}
+        self.sorted_terms = None
+
+    def expand_prefix(self, prefix):
+        # The terms in the index starting with the prefix, all with the same boost
+        if self.sorted_terms is None:
+            self.sorted_terms = sorted(self.postings)
+        expansions = []
+        for term in self.sorted_terms[bisect_left(self.sorted_terms, prefix):]:
+            if not term.startswith(prefix) or len(expansions) >= MAX_EXPANSIONS:
+                break
+            expansions.append((term, 1.0))
+        return expansions
+
+    def expand(self, term, fuzzy=True):
+        # The terms in the index within the max edits from the term, with their boost
+        # (one minus the edits over the length of the shortest), the best ones first.
+        if not fuzzy:
+            return [(term, 1.0)] if term in self.postings else []
+        try:
+            return self.expansions[term]
+        except KeyError:
+            pass
+        max_edits = get_max_edits(term)
+        expansions = []
+        for length in range(len(term) - max_edits, len(term) + max_edits + 1):
+            for candidate in self.terms_by_length.get(length, ()):
+                edits = 0 if candidate == term else edit_distance(term, candidate, max_edits)
+                if edits <= max_edits:
+                    expansions.append((candidate, 1.0 - edits / min(len(candidate), len(term))))
+        expansions.sort(key=lambda expansion: (-expansion[1], expansion[0]))
+        expansions = expansions[0:MAX_EXPANSIONS]
+        if len(self.expansions) >= MAX_CACHED_EXPANSIONS:
+            self.expansions = {}
+        self.expansions[term] = expansions
+        return expansions
+
+    def search(self, q, variant=None, min_score=None, size=10, fuzzy=True, prefix=False, alternatives=None):
+        # Returns the top (id, score) pairs. With prefix set, the last term is matched as a prefix.
+        # Alternatives, as lists by term of the query, are other terms which can match instead of it.
+        text_terms = tokenize(q)
+        terms = [stem(term) for term in text_terms]
+        if not terms or not self.docs:
+            return []
+        doc_count = len(self.docs)
+        average_length = self.total_length / doc_count
+
+        # All the terms must match (on any of their expansions, or of their alternatives), and their scores add up
+        scores = None
+        for i, term in enumerate(terms):
+            if prefix and i == len(terms) - 1:
+                expansions = self.expand_prefix(term)
+            else:
+                expansions = self.expand(term, fuzzy=fuzzy)
+            alternative_expansions = [self.expand(stem(alternative), fuzzy=fuzzy) for alternative in (alternatives or {}).get(text_terms[i], [])]
+            if not expansions and not any(alternative_expansions):
+                return []
+            term_scores = {}
+            for group in [expansions] + alternative_expansions:
+                if not group:
+                    continue
+                # Expansions share the same (blended) document frequency
+                document_frequency = max(len(self.postings[expansion]) for expansion, _ in group)
+                idf = math.log(1 + (doc_count - document_frequency + 0.5) / (document_frequency + 0.5))
+                for expansion, boost in group:
+                    for id, frequency in self.postings[expansion].items():
+                        norm = K1 * (1 - B + B * self.lengths[id] / average_length)
+                        term_scores[id] = term_scores.get(id, 0) + boost * idf * frequency * (K1 + 1) / (frequency + norm)
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {id: score + term_scores[id] for id, score in scores.items() if id in term_scores}
+            if not scores:
+                return []
+
+        # Filter, and sort by score (and then by insertion, as Elasticsearch does for ties)
+        results = []
+        for id, score in scores.items():
+            if variant and not self.docs[id].get(VARIANT_FIELDS[variant]):
+                continue
+            score = to_float32(score)
+            if min_score and score < min_score:
+                continue
+            results.append((id, score))
+        results.sort(key=lambda result: (-result[1], self.positions[result[0]]))
+        return results[0:size]
+
+
+class EmbeddedFood(FoodIndex):
+    """In-process search backend, for small deployments not needing Elasticsearch. Indexes
+    are kept in memory and saved to a local file (if any) shortly after any change."""
+
+    def __init__(self, path=None, save_delay=1.0):
+        self.path = path
+        self.save_delay = save_delay
+        self.indexes = {}
+        self.aliases = {}
+        self.save_handle = None
+        self.save_lock = None
+        if self.path and os.path.exists(self.path):
+            self.load()
+
+    @classmethod
+    def from_conf(cls):
+        return cls(EMBEDDED_PATH, EMBEDDED_SAVE_DELAY)
+
+    #------------------
+    #  Persistence
+    #------------------
+
+    def dump(self):
+        return {"indexes": {name: list(index.docs.items()) for name, index in self.indexes.items()},
+                "aliases": dict(self.aliases)}
+
+    def load(self):
+        with open(self.path) as f:
+            data = json.load(f)
+        for name, docs in data["indexes"].items():
+            self.indexes[name] = EmbeddedIndex()
+            for id, source in docs:
+                self.indexes[name].add(id, source)
+        self.aliases = data["aliases"]
+        logger.info('EmbeddedFood: loaded {} indexes from "{}"'.format(len(self.indexes), self.path))
+
+    def changed(self):
+        # Save in the background, at most once every save_delay seconds
+        if not self.path or self.save_handle:
+            return
+        loop = asyncio.get_running_loop()
+        self.save_handle = loop.call_later(self.save_delay, lambda: asyncio.ensure_future(self.save()))
+
+    async def save(self):
+        self.save_handle = None
+        if not self.save_lock:
+            self.save_lock = asyncio.Lock()
+        async with self.save_lock:
+            await asyncio.to_thread(write_json, self.path, self.dump())
+        logger.debug('EmbeddedFood: saved to "{}"'.format(self.path))
+
+    async def close(self):
+        if self.save_handle:
+            self.save_handle.cancel()
+            await self.save()
+
+    #------------------
+    #  Indexes
+    #------------------
+
+    def resolve(self, index_name):
+        return self.aliases.get(index_name, index_name)
+
+    async def ping(self):
+        # In process, always there
+        return True
+
+    async def index_exists(self, index_name):
+        return self.resolve(index_name) in self.indexes
+
+    async def get_aliases(self):
+        return dict(self.aliases)
+
+    def get_index(self, index_name, create=False):
+        index_name = self.resolve(index_name)
+        if index_name not in self.indexes:
+            if not create:
+                raise ItemNotFound('No such index "{}"'.format(index_name))
+            self.indexes[index_name] = EmbeddedIndex()
+        return index_name, self.indexes[index_name]
+
+    async def init_index(self, index_name):
+        if self.resolve(index_name) not in self.indexes:
+            self.indexes[index_name] = EmbeddedIndex()
+            self.changed()
+
+    async def reset_index(self, index_name):
+        for index in await self.get_indexes(index_name):
+            del self.indexes[index]
+        self.aliases.pop(index_name, None)
+        self.indexes[index_name] = EmbeddedIndex()
+        self.changed()
+
+    async def delete_index(self, index_name):
+        indexes = await self.get_indexes(index_name)
+        if not indexes:
+            raise ItemNotFound('No such index "{}"'.format(index_name))
+        for index in indexes:
+            del self.indexes[index]
+        self.aliases.pop(index_name, None)
+        self.changed()
+
+    async def get_indexes(self, index_name):
+        # All the physical indexes for an index name, which can be an alias (plus all its generations)
+        indexes = [self.resolve(index_name)] if self.resolve(index_name) in self.indexes else []
+        indexes += [generation for generation in await self.get_generations(index_name) if generation not in indexes]
+        return indexes
+
+    async def get_generations(self, alias):
+        return sorted(index for index in self.indexes if index.startswith('{}-gen-'.format(alias)))
+
+    async def build_generation(self, alias):
+        generation = '{}-gen-{}'.format(alias, datetime.utcnow().strftime('%Y%m%d%H%M%S%f'))
+        self.indexes[generation] = EmbeddedIndex()
+        self.changed()
+        return generation
+
+    async def swap_generation(self, alias, generation, keep=1):
+        if generation not in self.indexes:
+            raise ItemNotFound('No such index "{}"'.format(generation))
+        # A plain index from before using aliases is replaced
+        if alias not in self.aliases:
+            self.indexes.pop(alias, None)
+        self.aliases[alias] = generation
+        self.changed()
+        return await self.collect_generations(alias, keep=keep)
+
+    async def collect_generations(self, alias, keep=1):
+        if alias not in self.aliases:
+            return []
+        current = self.aliases[alias]
+        older = [generation for generation in await self.get_generations(alias) if generation < current]
+        collected = older[:-keep] if keep else older
+        for generation in collected:
+            del self.indexes[generation]
+        self.changed()
+        return collected
+
+    #------------------
+    #  Items
+    #------------------
+
+    # Writes are visible to searches right away, whatever the refresh policy
+
+    async def add_item(self, item, index_name, refresh='false'):
+        index_name, index = self.get_index(index_name, create=True)
+        result = index.add(str(item["uuid"]), dict(item))
+        self.changed()
+        return {"_index": index_name, "_type": "_doc", "_id": str(item["uuid"]), "result": result}
+
+    async def delete_item(self, uuid, index_name, refresh='false'):
+        index_name, index = self.get_index(index_name)
+        if not index.remove(str(uuid)):
+            raise ItemNotFound('No item "{}" in index "{}"'.format(uuid, index_name))
+        self.changed()
+        return {"_index": index_name, "_type": "_doc", "_id": str(uuid), "result": "deleted"}
+
+    async def delete_items(self, uuids, index_name, refresh='false'):
+        try:
+            index_name, index = self.get_index(index_name)
+        except ItemNotFound:
+            return 0
+        deleted = sum(1 for uuid in uuids if index.remove(str(uuid)))
+        self.changed()
+        return deleted
+
+    async def bulk_items(self, operations, refresh='false'):
+        results = []
+        for operation in operations:
+            if operation["action"] == "index":
+                index_name, index = self.get_index(operation["index_name"], create=True)
+                result = index.add(str(operation["uuid"]), dict(operation["item"]))
+                results.append({"ok": True, "status": 201 if result == 'created' else 200, "error": None})
+            else:
+                # Deleting something which is not there is not an error (as for Elasticsearch)
+                try:
+                    index_name, index = self.get_index(operation["index_name"])
+                    found = index.remove(str(operation["uuid"]))
+                except ItemNotFound:
+                    found = False
+                results.append({"ok": True, "status": 200 if found else 404, "error": None})
+        self.changed()
+        return results
+
+    #------------------
+    #  Search
+    #------------------
+
+    async def scan_items(self):
+        for index_name, index in list(self.indexes.items()):
+            for id, source in list(index.docs.items()):
+                yield index_name, id, source
+
+    async def query(self, q, index_name, variant=None, min_score=None, size=10, fuzzy=True, alternatives=None):
+        if index_name:
+            index_name = self.resolve(index_name)
+            if index_name not in self.indexes:
+                return None
+            index_names = [index_name]
+        else:
+            index_names = list(self.indexes)
+
+        start = time.perf_counter()
+        hits = []
+        for index_name in index_names:
+            index = self.indexes[index_name]
+            for id, score in index.search(q, variant=variant, min_score=min_score, size=size, fuzzy=fuzzy, alternatives=alternatives):
+                hits.append({"_index": index_name,
+                             "_type": "_doc",
+                             "_id": id,
+                             "_score": score,
+                             "_source": {field: index.docs[id][field] for field in SOURCE_FIELDS if field in index.docs[id]}})
+        hits.sort(key=lambda hit: -hit["_score"])
+        hits = hits[0:size]
+        return {"took": int((time.perf_counter() - start) * 1000),
+                "hits": {"max_score": hits[0]["_score"] if hits else None, "hits": hits}}
+
+    async def multi_query(self, searches):
+        return [await self.query(**search) for search in searches]
+
+    async def suggest(self, q, index_name, size=5):
+        if index_name:
+            index_name = self.resolve(index_name)
+            if index_name not in self.indexes:
+                return None
+            indexes = [self.indexes[index_name]]
+        else:
+            indexes = list(self.indexes.values())
+        hits = []
+        for index in indexes:
+            hits += [{"_score": score, "_source": index.docs[id]} for id, score in index.search(q, size=size * 2, fuzzy=False, prefix=True)]
+        hits.sort(key=lambda hit: -hit["_score"])
+        return get_suggestions(hits, size)
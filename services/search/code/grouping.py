@@ -0,0 +1,54 @@
+import os
+import numpy as np
+
+# Conf
+GROUPING_MAX_HITS = int(os.environ.get('GROUPING_MAX_HITS', 200))
+GROUPING_MAX_GAP = float(os.environ.get('GROUPING_MAX_GAP', 0.1))
+GROUPING_MIN_OVERLAP = float(os.environ.get('GROUPING_MIN_OVERLAP', 0.5))
+
+
+def get_incidence(ingredients):
+    # Hits by distinct ingredients matrix, with ones where a hit has an ingredient
+    ingredient_sets = [set(ingredient.strip().lower() for ingredient in hit_ingredients) for hit_ingredients in ingredients]
+    columns = {}
+    column_indexes = [columns.setdefault(ingredient, len(columns)) for ingredient_set in ingredient_sets for ingredient in ingredient_set]
+    row_indexes = np.repeat(np.arange(len(ingredient_sets)), [len(ingredient_set) for ingredient_set in ingredient_sets])
+    incidence = np.zeros((len(ingredient_sets), max(len(columns), 1)), dtype=np.float32)
+    incidence[row_indexes, column_indexes] = 1
+    return incidence
+
+
+def group_hits(scores, ingredients, max_diff, max_gap=GROUPING_MAX_GAP, min_overlap=GROUPING_MIN_OVERLAP, max_hits=GROUPING_MAX_HITS):
+    """Split the hits (sorted by score) in the close group and the others, on their scores and
+    ingredients at once. The score candidates are the hits within max_diff of the top one and
+    before the first relative score gap larger than max_gap. Each candidate then gets the score
+    weighted average of its ingredients overlap (Jaccard) with the other candidates, and the close
+    hits are the ones overlapping at least min_overlap times as much as the best candidate does,
+    so that an outlier on top does not drive the group. Only the first max_hits hits are
+    considered, which bounds the cost. Returns the relative scores, the candidates and the close
+    hits, as arrays."""
+
+    considered = min(len(scores), max_hits)
+    relative_scores = np.asarray(scores, dtype=np.float64) / scores[0]
+    candidates = np.zeros(len(scores), dtype=bool)
+    close = np.zeros(len(scores), dtype=bool)
+
+    # Score candidates, up to the first large gap
+    relative = relative_scores[:considered]
+    gaps = np.flatnonzero(relative[:-1] - relative[1:] > max_gap)
+    end = gaps[0] + 1 if len(gaps) else considered
+    candidates[:end] = relative[:end] >= 1 - max_diff
+
+    # Ingredients overlap of all the pairs of hits
+    incidence = get_incidence(ingredients[:considered])
+    sizes = incidence.sum(axis=1)
+    shared = incidence @ incidence.T
+    overlaps = shared / np.maximum(sizes[:, None] + sizes[None, :] - shared, 1)
+    np.fill_diagonal(overlaps, 0)
+
+    # Average overlap with the other candidates (full for a lone one)
+    weights = np.where(candidates[:considered], relative, 0)
+    others = weights.sum() - weights
+    support = np.divide(overlaps @ weights, others, out=np.ones(considered), where=others > 0)
+    close[:considered] = candidates[:considered] & (support >= min_overlap * support[candidates[:considered]].max())
+    return relative_scores, candidates, close
@@ -1,15 +1,43 @@
 import os
+import time
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Query, HTTPException, status
-from pydantic import BaseModel, validator
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse
+from pydantic import BaseModel, Field, ValidationError, validator
 from uuid import UUID
 from typing import List, Optional
 from enum import Enum
-from .elastic import es, NotFoundError
+from .backend import get_backend, ItemNotFound
+from .cache import SearchCache, SharedIndexVersions
+from .spelling import SpellingIndex
+from .analysis import stem
+from .vectors import VectorIndex
+from .metrics import Counter, Gauge, Histogram, SharedMetrics, get_values, render
+from .grouping import group_hits
 
 # Conf
 MIN_SCORE = float(os.environ.get('MIN_SCORE', 0.5))
 MAX_DIFF = float(os.environ.get('MAX_DIFF', 0.3))
+SEARCH_SIZE = int(os.environ.get('SEARCH_SIZE', 10))
 LOG_LEVEL = os.environ.get('LOG_LEVEL', 'ERROR')
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 1000))
+CACHE_TTL = float(os.environ.get('CACHE_TTL', 300))
+CACHE_SETTLE_TIME = float(os.environ.get('CACHE_SETTLE_TIME', 1.0))
+CACHE_VERSIONS_PATH = os.environ.get('CACHE_VERSIONS_PATH', '/tmp/search_versions')
+METRICS_PATH = os.environ.get('METRICS_PATH', '/tmp/search_metrics')
+METRICS_SAVE_INTERVAL = float(os.environ.get('METRICS_SAVE_INTERVAL', 5))
+KEEP_GENERATIONS = int(os.environ.get('KEEP_GENERATIONS', 1))
+TYPO_CORRECTION = os.environ.get('TYPO_CORRECTION', 'true').lower() == 'true'
+TYPO_RELOAD_INTERVAL = float(os.environ.get('TYPO_RELOAD_INTERVAL', 300))
+GROUPING = os.environ.get('GROUPING', 'main_ingredient')
+RETRIEVAL = os.environ.get('RETRIEVAL', 'text')
+VECTORS = os.environ.get('VECTORS', str(RETRIEVAL != 'text')).lower() == 'true'
+VECTOR_MIN_SCORE = float(os.environ.get('VECTOR_MIN_SCORE', 0.3))
+VECTOR_RELOAD_INTERVAL = float(os.environ.get('VECTOR_RELOAD_INTERVAL', 300))
+BATCH_MAX_QUERIES = int(os.environ.get('BATCH_MAX_QUERIES', 100))
+DELETE_MAX_UUIDS = int(os.environ.get('DELETE_MAX_UUIDS', 10000))
+READY_INDEXES = [index_name for index_name in os.environ.get('READY_INDEXES', 'food').split(',') if index_name]
 
 
 # Setup logging
@@ -17,30 +45,156 @@ import logging
 logger = logging.getLogger('uvicorn')
 logger.setLevel(LOG_LEVEL)
 
+# Search backend (Elasticsearch client by default), set up (and torn down) by the app lifespan,
+# so that each worker process has its own client and connection pool
+backend = None
+
+async def reload_spelling():
+    # Load the typo correction dictionary, which is then kept up to date by the writes through
+    # this worker, and check every so often whether to reload it, for the writes through the others
+    while True:
+        try:
+            version = cache.version(None)
+            if not spelling.fresh(version):
+                await spelling.load(backend, version=version)
+        except Exception as e:
+            logger.warning('Could not load the typo correction dictionary: {}'.format(e))
+        await asyncio.sleep(TYPO_RELOAD_INTERVAL)
+
+async def reload_vectors():
+    # Load the vectors, which are then kept up to date by the writes through this worker,
+    # and check every so often whether to reload them, for the writes through the others
+    while True:
+        try:
+            version = cache.version(None)
+            if not vectors.fresh(version):
+                await vectors.load(backend, version=version)
+        except Exception as e:
+            logger.warning('Could not load the vectors: {}'.format(e))
+        await asyncio.sleep(VECTOR_RELOAD_INTERVAL)
+
+async def save_metrics():
+    # Save the metrics of this worker every so often, for the scrapes served by the others
+    while True:
+        try:
+            update_stats_gauges()
+            shared_metrics.save()
+        except Exception as e:
+            logger.warning('Could not save the metrics: {}'.format(e))
+        await asyncio.sleep(METRICS_SAVE_INTERVAL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global backend
+    backend = get_backend()
+    spelling_task = asyncio.create_task(reload_spelling()) if TYPO_CORRECTION else None
+    vectors_task = asyncio.create_task(reload_vectors()) if VECTORS else None
+    metrics_task = asyncio.create_task(save_metrics()) if shared_metrics else None
+    yield
+    if spelling_task:
+        spelling_task.cancel()
+    if vectors_task:
+        vectors_task.cancel()
+    if metrics_task:
+        metrics_task.cancel()
+        shared_metrics.remove()
+    await backend.close()
+
 # Get main App
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# Search results cache, with the index versions shared by all the workers (unless disabled)
+cache = SearchCache(max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL, settle_time=CACHE_SETTLE_TIME,
+                    versions=SharedIndexVersions(CACHE_VERSIONS_PATH) if CACHE_VERSIONS_PATH else None)
+
+# Typo correction dictionary
+spelling = SpellingIndex()
+
+def bump_index(index_name, refreshed=False):
+    # Invalidate the cached results for an index (on all the workers), keeping track of whether
+    # the typo correction dictionary and the vectors are still up to date with all the writes
+    versions = cache.bump(index_name, refreshed=refreshed)
+    spelling.sync(*versions)
+    if vectors:
+        vectors.sync(*versions)
+
+# Character n-grams vectors, sparse
+vectors = VectorIndex() if VECTORS else None
+
+# Metrics (per worker, with a worker label), by index name ("_all" for searches on all the indexes),
+# saved in files shared by all the workers (unless disabled), so that any of them can serve the scrapes
+backend_seconds = Histogram('search_backend_seconds', 'Search round trip time to the backend, by search mode (exact or fuzzy)', ['index', 'mode'])
+backend_took_seconds = Histogram('search_backend_took_seconds', 'Search time reported by the backend', ['index', 'mode'])
+filter_seconds = Histogram('search_filter_seconds', 'Hits filtering time', ['index'])
+serialization_seconds = Histogram('search_serialization_seconds', 'Search response serialization time', ['index'])
+vectors_seconds = Histogram('search_vectors_seconds', 'Vector searches time', ['index'])
+suggest_seconds = Histogram('search_suggest_seconds', 'Suggestions round trip time to the backend', ['index'])
+hits_received = Counter('search_hits_received_total', 'Hits received from the backend', ['index'])
+hits_dropped = Counter('search_hits_dropped_total', 'Hits dropped by the filtering, by stage', ['index', 'stage'])
+hits_returned = Counter('search_hits_returned_total', 'Hits returned (see also ones included)', ['index'])
+cache_stats_gauge = Gauge('search_cache', 'Search cache counters', ['stat'])
+vectors_stats_gauge = Gauge('search_vectors', 'Vectors counters', ['stat'])
+spelling_stats_gauge = Gauge('search_spelling', 'Typo correction dictionary counters', ['stat'])
+shared_metrics = SharedMetrics(METRICS_PATH, max_age=3 * METRICS_SAVE_INTERVAL) if METRICS_PATH else None
 
 logger.info('Using MIN_SCORE=%s', MIN_SCORE)
 logger.info('Using MAX_DIFF=%s', MAX_DIFF)
+logger.info('Using SEARCH_SIZE=%s', SEARCH_SIZE)
+logger.info('Using CACHE_MAX_ENTRIES=%s', CACHE_MAX_ENTRIES)
+logger.info('Using CACHE_VERSIONS_PATH=%s', CACHE_VERSIONS_PATH)
+logger.info('Using METRICS_PATH=%s', METRICS_PATH)
+logger.info('Using TYPO_CORRECTION=%s', TYPO_CORRECTION)
+logger.info('Using GROUPING=%s', GROUPING)
+logger.info('Using RETRIEVAL=%s', RETRIEVAL)
+logger.info('Using VECTORS=%s', VECTORS)
+logger.info('Using READY_INDEXES=%s', READY_INDEXES)
 
 
 class CommandEnum(str, Enum):
     init = "init"
     reset = "reset"
     delete = "delete"
+    build = "build"
+    swap = "swap"
+    collect = "collect"
 
 
 class Command(BaseModel):
     command: CommandEnum
     index_name: str
+    generation: Optional[str] = None
     confirmation_code: str = None
 
 
+class RefreshEnum(str, Enum):
+    false = "false"
+    wait_for = "wait_for"
+    true = "true"
+
+
+class VariantEnum(str, Enum):
+    servings = "servings"
+    pieces = "pieces"
+
+
+class GroupingEnum(str, Enum):
+    main_ingredient = "main_ingredient"
+    clusters = "clusters"
+
+
+class RetrievalEnum(str, Enum):
+    text = "text"
+    vectors = "vectors"
+    fallback = "fallback"
+
+
 class Item(BaseModel):
     uuid: UUID
     description: str
     ingredients: List[str]
     index_name: str
+    has_servings: bool = False
+    has_pieces: bool = False
 
     @validator("ingredients")
     def check_ingredients_length(cls, v):
@@ -49,6 +203,161 @@ class Item(BaseModel):
         return v
 
 
+class BulkActionEnum(str, Enum):
+    index = "index"
+    delete = "delete"
+
+
+class BulkOperation(BaseModel):
+    action: BulkActionEnum = BulkActionEnum.index
+    uuid: UUID
+    index_name: str
+    description: Optional[str] = None
+    ingredients: Optional[List[str]] = None
+    has_servings: bool = False
+    has_pieces: bool = False
+
+
+class Bulk(BaseModel):
+    operations: List[BulkOperation]
+
+
+class DeleteMany(BaseModel):
+    index_name: str
+    uuids: List[UUID]
+
+
+class Search(BaseModel):
+    q: str = Field(..., min_length=3, max_length=100)
+    index_name: Optional[str] = None
+    variant: Optional[VariantEnum] = None
+    min_score: Optional[float] = None
+    max_diff: Optional[float] = None
+    see_also: Optional[bool] = False
+    size: Optional[int] = Field(None, ge=1, le=1000)
+    grouping: Optional[GroupingEnum] = None
+    retrieval: Optional[RetrievalEnum] = None
+
+
+class FormatEnum(str, Enum):
+    full = "full"
+    compact = "compact"
+
+
+class MultiSearch(BaseModel):
+    searches: List[Search]
+    format: FormatEnum = FormatEnum.full
+
+
+class Batch(BaseModel):
+    queries: List[str]
+    index_name: Optional[str] = None
+    variant: Optional[VariantEnum] = None
+    min_score: Optional[float] = None
+    max_diff: Optional[float] = None
+    see_also: Optional[bool] = False
+    size: Optional[int] = Field(None, ge=1, le=1000)
+    grouping: Optional[GroupingEnum] = None
+    retrieval: Optional[RetrievalEnum] = None
+    format: FormatEnum = FormatEnum.full
+
+
+def get_index_label(index_name):
+    return index_name if index_name else '_all'
+
+
+def filter_hits(elastic_response, min_score=None, max_diff=None, see_also=False, counts=None, grouping=None):
+
+    # If a counts dict is given, it gets how many hits were received, dropped at each
+    # stage ("min_score", then "main_ingredient" and "relative_score" or "score_gap"
+    # and "ingredients", depending on the grouping) and returned.
+
+    # This is when there is no index at all
+    if not elastic_response:
+        return []
+
+    # Shortcut
+    hits = elastic_response["hits"]["hits"]
+
+    # Ensure we have some hits
+    if not hits:
+        return []
+
+    # Set the boundaries
+    min_score = MIN_SCORE if min_score is None else min_score
+    max_diff = MAX_DIFF if max_diff is None else max_diff
+    grouping = GROUPING if grouping is None else grouping
+
+    # Only keep the high scoring hits (Elasticsearch already dropped the others,
+    # this just makes sure that the boundary is applied in the same way).
+    # Hits come sorted by score, so the first one has the max score.
+    max_score = hits[0]["_score"]
+    high_score_hits = [hit for hit in hits if hit["_score"] >= min_score]
+    if counts is not None:
+        counts["received"] = len(hits)
+        counts["min_score"] = len(hits) - len(high_score_hits)
+    if not high_score_hits:
+        return []
+    logger.debug('high_score_hits={}'.format(high_score_hits))
+
+    if grouping == GroupingEnum.clusters:
+
+        # Group on the scores and the ingredients overlap (vectorized)
+        relative_scores, candidates, close = group_hits([hit["_score"] for hit in high_score_hits],
+                                                        [hit['_source']['ingredients'] for hit in high_score_hits], max_diff)
+        close_hits = []
+        for hit, relative_score, is_close in zip(high_score_hits, relative_scores.tolist(), close.tolist()):
+            if is_close:
+                hit['_relative_score'] = relative_score
+                close_hits.append(hit)
+        logger.debug('close_hits={}'.format(close_hits))
+        if counts is not None:
+            counts["score_gap"] = len(high_score_hits) - int(candidates.sum())
+            counts["ingredients"] = int(candidates.sum()) - len(close_hits)
+
+    else:
+
+        # Set the reference main ingredient
+        reference_main_ingredient = high_score_hits[0]['_source']['ingredients'][0]
+
+        # Filter based on the main ingredient
+        filtered_high_score_hits = []
+        for hit in high_score_hits:
+            if hit['_source']['ingredients'][0] == reference_main_ingredient:
+                filtered_high_score_hits.append(hit)
+        logger.debug('filtered_high_score_hits={}'.format(filtered_high_score_hits))
+
+        # Compute the relative score
+        for hit in filtered_high_score_hits:
+            hit['_relative_score'] = hit["_score"] / max_score
+
+        # Get now only the close hits based on the relative score
+        close_hits = [
+            hit for hit in filtered_high_score_hits if hit["_relative_score"] >= (1-max_diff)
+        ]
+        logger.debug('close_hits={}'.format(close_hits))
+        if counts is not None:
+            counts["main_ingredient"] = len(high_score_hits) - len(filtered_high_score_hits)
+            counts["relative_score"] = len(filtered_high_score_hits) - len(close_hits)
+
+    # Assign results
+    results = close_hits
+
+    # Compose the "see also" (by identity, as the same id can come from different indexes)
+    if see_also:
+        close_hits_ids = set(id(hit) for hit in close_hits)
+        see_also_hits = []
+        for hit in high_score_hits:
+            if id(hit) not in close_hits_ids:
+                hit['see_also'] = True
+                see_also_hits.append(hit)
+        results += see_also_hits
+
+    if counts is not None:
+        counts["returned"] = len(results)
+    return results
+
+
 @app.post("/api/v1/manage/")
 async def manage(command: Command):
 
@@ -58,10 +367,11 @@ async def manage(command: Command):
             status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid confirmation code"
         )
 
-    # Handle command
+    # Handle command (their effects are visible to searches right away)
     if command.command == "init":
         try:
-            es.init_index(index_name=command.index_name)
+            await backend.init_index(index_name=command.index_name)
+            bump_index(command.index_name, refreshed=True)
         except Exception as e:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -70,7 +380,11 @@ async def manage(command: Command):
         return {"message": "Init successfully executed"}
     elif command.command == "reset":
         try:
-            es.reset_index(index_name=command.index_name)
+            await backend.reset_index(index_name=command.index_name)
+            bump_index(command.index_name, refreshed=True)
+            spelling.delete_index(command.index_name)
+            if vectors:
+                vectors.delete_index(command.index_name)
         except Exception as e:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -79,22 +393,72 @@ async def manage(command: Command):
         return {"message": "Reset successfully executed"}
     elif command.command == "delete":
         try:
-            es.delete_index(index_name=command.index_name)
+            await backend.delete_index(index_name=command.index_name)
+            bump_index(command.index_name, refreshed=True)
+            spelling.delete_index(command.index_name)
+            if vectors:
+                vectors.delete_index(command.index_name)
         except Exception as e:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail="Error during delete: {}".format(e),
             )
         return {"message": "Delete successfully executed"}
+    elif command.command == "build":
+        try:
+            generation = await backend.build_generation(alias=command.index_name)
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Error during build: {}".format(e),
+            )
+        return {"message": "Build successfully executed", "generation": generation}
+    elif command.command == "swap":
+        if not command.generation or not command.generation.startswith('{}-gen-'.format(command.index_name)):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid generation"
+            )
+        try:
+            collected = await backend.swap_generation(alias=command.index_name, generation=command.generation, keep=KEEP_GENERATIONS)
+            bump_index(command.index_name, refreshed=True)
+            for generation in collected:
+                spelling.delete_index(generation)
+            if vectors:
+                vectors.aliases[command.index_name] = command.generation
+                for generation in collected:
+                    vectors.delete_index(generation)
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Error during swap: {}".format(e),
+            )
+        return {"message": "Swap successfully executed", "collected": collected}
+    elif command.command == "collect":
+        try:
+            collected = await backend.collect_generations(alias=command.index_name, keep=KEEP_GENERATIONS)
+            for generation in collected:
+                spelling.delete_index(generation)
+                if vectors:
+                    vectors.delete_index(generation)
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Error during collect: {}".format(e),
+            )
+        return {"message": "Collect successfully executed", "collected": collected}
 
 
 @app.post("/api/v1/add/")
-async def add_item(item: Item):
+async def add_item(item: Item, refresh: RefreshEnum = RefreshEnum.false):
     try:
         item_dict = item.dict()
         item_dict["uuid"] = str(item_dict["uuid"])
         index_name = item_dict.get('index_name', None)
-        response = es.add_item(item_dict, index_name=index_name)
+        response = await backend.add_item(item_dict, index_name=index_name, refresh=refresh.value)
+        bump_index(index_name, refreshed=refresh != RefreshEnum.false)
+        spelling.add(index_name, item_dict["uuid"], item_dict["description"])
+        if vectors:
+            vectors.add(index_name, item_dict["uuid"], item_dict)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -104,13 +468,17 @@ async def add_item(item: Item):
     return response
 
 @app.post("/api/v1/delete/")
-async def delete_item(item: Item):
+async def delete_item(item: Item, refresh: RefreshEnum = RefreshEnum.false):
     try:
         item_dict = item.dict()
         item_dict["uuid"] = str(item_dict["uuid"])
         index_name = item_dict.get('index_name', None)
-        response = es.delete_item(uuid=item_dict["uuid"], index_name=index_name)
-    except NotFoundError as e:
+        response = await backend.delete_item(uuid=item_dict["uuid"], index_name=index_name, refresh=refresh.value)
+        bump_index(index_name, refreshed=refresh != RefreshEnum.false)
+        spelling.delete(index_name, item_dict["uuid"])
+        if vectors:
+            vectors.delete(index_name, item_dict["uuid"])
+    except ItemNotFound as e:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=str(e),
@@ -124,76 +492,362 @@ async def delete_item(item: Item):
     return response
 
 
+@app.post("/api/v1/delete_many/")
+async def delete_many(delete_many: DeleteMany, refresh: RefreshEnum = RefreshEnum.false):
+
+    # All at once, whatever their number (up to DELETE_MAX_UUIDS), and skipping the ones not there
+    if len(delete_many.uuids) > DELETE_MAX_UUIDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Too many uuids (at most {})".format(DELETE_MAX_UUIDS),
+        )
+    uuids = [str(uuid) for uuid in delete_many.uuids]
+    index_name = delete_many.index_name
+    try:
+        deleted = await backend.delete_items(uuids, index_name=index_name, refresh=refresh.value)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Error during delete many: {}".format(e),
+        )
+    bump_index(index_name, refreshed=refresh != RefreshEnum.false)
+    for uuid in uuids:
+        spelling.delete(index_name, uuid)
+        if vectors:
+            vectors.delete(index_name, uuid)
+    logger.info('Deleted {} out of {} items'.format(deleted, len(uuids)))
+    return {"total": len(uuids), "deleted": deleted}
+
+
+@app.post("/api/v1/bulk/")
+async def bulk(bulk: Bulk, refresh: RefreshEnum = RefreshEnum.false):
+
+    # Validate the operations one by one, so that a bad one does not fail the whole bulk
+    results = [None] * len(bulk.operations)
+    operations = []
+    positions = []
+    for i, operation in enumerate(bulk.operations):
+        uuid = str(operation.uuid)
+        if operation.action == "index":
+            if not operation.description or not operation.ingredients:
+                results[i] = {"uuid": uuid, "index_name": operation.index_name, "ok": False, "status": 400,
+                              "error": '"description" and "ingredients" (at least one) are required for indexing'}
+                continue
+            item = {"uuid": uuid,
+                    "description": operation.description,
+                    "ingredients": operation.ingredients,
+                    "index_name": operation.index_name,
+                    "has_servings": operation.has_servings,
+                    "has_pieces": operation.has_pieces}
+            operations.append({"action": "index", "index_name": operation.index_name, "uuid": uuid, "item": item})
+        else:
+            operations.append({"action": "delete", "index_name": operation.index_name, "uuid": uuid})
+        positions.append(i)
+
+    # Perform the bulk
+    if operations:
+        try:
+            bulk_results = await backend.bulk_items(operations, refresh=refresh.value)
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Error during bulk: {}".format(e),
+            )
+        for index_name in set(operation["index_name"] for operation in operations):
+            bump_index(index_name, refreshed=refresh != RefreshEnum.false)
+        for i, operation, result in zip(positions, operations, bulk_results):
+            result.update({"uuid": operation["uuid"], "index_name": operation["index_name"]})
+            results[i] = result
+            if result["ok"] and operation["action"] == "index":
+                spelling.add(operation["index_name"], operation["uuid"], operation["item"]["description"])
+                if vectors:
+                    vectors.add(operation["index_name"], operation["uuid"], operation["item"])
+            elif result["ok"]:
+                spelling.delete(operation["index_name"], operation["uuid"])
+                if vectors:
+                    vectors.delete(operation["index_name"], operation["uuid"])
+
+    # Report per-item errors
+    errors = [dict(result, position=i) for i, result in enumerate(results) if not result["ok"]]
+    logger.info('Bulk of {} operations, {} errors'.format(len(results), len(errors)))
+    return {"total": len(results), "succeeded": len(results) - len(errors), "errors": errors}
+
+
+async def perform_searches(searches):
+    # All in a single round trip
+    start = time.perf_counter()
+    if len(searches) == 1:
+        elastic_responses = [await backend.query(**searches[0])]
+    else:
+        elastic_responses = await backend.multi_query(searches)
+    elapsed = time.perf_counter() - start
+
+    for search, elastic_response in zip(searches, elastic_responses):
+        index_label = get_index_label(search["index_name"])
+        mode = 'fuzzy' if search.get("fuzzy", True) else 'exact'
+        backend_seconds.observe(elapsed, index_label, mode)
+        if elastic_response and "took" in elastic_response:
+            backend_took_seconds.observe(elastic_response["took"] / 1000, index_label, mode)
+    return elastic_responses
+
+
+async def run_searches(searches):
+
+    # Set the boundaries
+    searches = [{"q": search.q,
+                 "index_name": search.index_name,
+                 "variant": search.variant.value if search.variant else None,
+                 "min_score": MIN_SCORE if search.min_score is None else search.min_score,
+                 "max_diff": MAX_DIFF if search.max_diff is None else search.max_diff,
+                 "see_also": bool(search.see_also),
+                 "size": SEARCH_SIZE if search.size is None else search.size,
+                 "grouping": GROUPING if search.grouping is None else search.grouping.value,
+                 "retrieval": RETRIEVAL if search.retrieval is None else search.retrieval.value,
+                 "vector_min_score": VECTOR_MIN_SCORE if search.min_score is None else search.min_score} for search in searches]
+
+    # Vector searches need the vectors
+    if not vectors and any(search["retrieval"] != RetrievalEnum.text for search in searches):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Vector retrieval is disabled"
+        )
+
+    # Do we have the results already?
+    cache_keys = [cache.key(**search) for search in searches]
+    results = [cache.get(cache_key) for cache_key in cache_keys]
+
+    # Same searches (as in a batch) are performed once
+    missing = []
+    first_positions = {}
+    for i, result in enumerate(results):
+        if result is None and cache_keys[i] not in first_positions:
+            first_positions[cache_keys[i]] = i
+            missing.append(i)
+    if not missing:
+        return results
+
+    # Perform the missing searches
+    missing_searches = [{"q": searches[i]["q"],
+                         "index_name": searches[i]["index_name"],
+                         "variant": searches[i]["variant"],
+                         "min_score": searches[i]["min_score"],
+                         "size": searches[i]["size"]} for i in missing]
+    elastic_responses = [None] * len(missing_searches)
+    min_scores = [searches[i]["min_score"] for i in missing]
+
+    # Text searches go to the backend
+    text = [j for j, i in enumerate(missing) if searches[i]["retrieval"] != RetrievalEnum.vectors]
+
+    # First on the exact terms, with the typos corrected on the dictionary (much cheaper)
+    if TYPO_CORRECTION and spelling.loaded and text:
+        corrected_searches = {}
+        fresh = spelling.fresh(cache.version(None))
+        for j in text:
+            corrections = spelling.corrections(missing_searches[j]["q"])
+            if not corrections:
+                continue
+            # The original terms are searched as well, not to miss what a wrong correction would
+            alternatives = {}
+            for term, corrected_term in corrections:
+                if stem(term) != stem(corrected_term):
+                    alternatives.setdefault(corrected_term, []).append(term)
+            # With writes through other workers since the dictionary was loaded, the corrections
+            # may be to old terms while closer ones were added, so they are left to fuzzy matching
+            if alternatives and not fresh:
+                continue
+            corrected_searches[j] = dict(missing_searches[j], q=' '.join(corrected_term for _, corrected_term in corrections),
+                                         fuzzy=False, alternatives=alternatives or None)
+        if corrected_searches:
+            for j, elastic_response in zip(corrected_searches, await perform_searches(list(corrected_searches.values()))):
+                elastic_responses[j] = elastic_response
+
+    # And then with fuzzy matching for the ones with no correction, or no hits
+    fuzzy = [j for j in text if not elastic_responses[j] or not elastic_responses[j]["hits"]["hits"]]
+    if fuzzy:
+        for j, elastic_response in zip(fuzzy, await perform_searches([missing_searches[j] for j in fuzzy])):
+            elastic_responses[j] = elastic_response
+
+    # Vector searches (top-k cosine similarity), also for the text ones with no hits if falling back
+    for j, i in enumerate(missing):
+        retrieval = searches[i]["retrieval"]
+        if retrieval == RetrievalEnum.vectors or (retrieval == RetrievalEnum.fallback and
+                                                  (not elastic_responses[j] or not elastic_responses[j]["hits"]["hits"])):
+            start = time.perf_counter()
+            elastic_responses[j] = vectors.query(missing_searches[j]["q"], missing_searches[j]["index_name"], missing_searches[j]["variant"],
+                                                 min_score=searches[i]["vector_min_score"], size=missing_searches[j]["size"])
+            vectors_seconds.observe(time.perf_counter() - start, get_index_label(searches[i]["index_name"]))
+            min_scores[j] = searches[i]["vector_min_score"]
+
+    # Filter the hits of each search on its own
+    for i, elastic_response, min_score in zip(missing, elastic_responses, min_scores):
+        index_label = get_index_label(searches[i]["index_name"])
+        counts = {}
+        start = time.perf_counter()
+        results[i] = filter_hits(elastic_response, min_score, searches[i]["max_diff"], searches[i]["see_also"],
+                                 counts=counts, grouping=searches[i]["grouping"])
+        filter_seconds.observe(time.perf_counter() - start, index_label)
+        if counts:
+            hits_received.inc(index_label, value=counts["received"])
+            for stage, value in counts.items():
+                if stage not in ["received", "returned"]:
+                    hits_dropped.inc(index_label, stage, value=value)
+            hits_returned.inc(index_label, value=counts.get("returned", 0))
+        cache.set(cache_keys[i], results[i])
+
+    for i, result in enumerate(results):
+        if result is None:
+            results[i] = results[first_positions[cache_keys[i]]]
+    return results
+
+
+def compact_hit(hit):
+    return {"_id": hit["_id"],
+            "_score": hit["_score"],
+            "_relative_score": hit.get("_relative_score"),
+            "see_also": hit.get("see_also", False)}
+
+
+def serialize(results, searches, format=FormatEnum.full, single=False):
+    # Results are plain JSON data, so they are serialized straight away (and timed). The compact
+    # format only has the hits ids, scores and see also flags, and uses a faster encoder.
+    index_names = set(search.index_name for search in searches)
+    index_label = get_index_label(index_names.pop()) if len(index_names) == 1 else '_multiple'
+    start = time.perf_counter()
+    if format == FormatEnum.compact:
+        results = [[compact_hit(hit) for hit in hits] for hits in results]
+        response = ORJSONResponse(content=results[0] if single else results)
+    else:
+        response = JSONResponse(content=results[0] if single else results)
+    serialization_seconds.observe(time.perf_counter() - start, index_label)
+    return response
+
+
 @app.get("/api/v1/search")
 async def search(q: str = Query(..., min_length=3, max_length=100),
                  index_name: Optional[str] = None,
+                 variant: Optional[VariantEnum] = None,
                  min_score: Optional[float] = None,
                  max_diff: Optional[float] = None,
-                 see_also: Optional[bool] = False):
+                 see_also: Optional[bool] = False,
+                 size: Optional[int] = Query(None, ge=1, le=1000),
+                 grouping: Optional[GroupingEnum] = None,
+                 retrieval: Optional[RetrievalEnum] = None,
+                 format: FormatEnum = FormatEnum.full):
 
+    search = Search(q=q, index_name=index_name, variant=variant, min_score=min_score,
+                    max_diff=max_diff, see_also=see_also, size=size, grouping=grouping, retrieval=retrieval)
+    return serialize(await run_searches([search]), [search], format=format, single=True)
 
-    # Perform the search
-    elastic_response = es.query(q,index_name)
 
-    # ------------------
-    # Filter hits
-    # ------------------
-    # TODO:  maybe use k-means with _score and 1 ingredient as an enum
+@app.post("/api/v1/msearch/")
+async def msearch(multi_search: MultiSearch):
+    return serialize(await run_searches(multi_search.searches), multi_search.searches, format=multi_search.format)
 
-    # This is when there is no index at all
-    if not elastic_response:
-        return []
 
-    # Shortcut
-    hits = elastic_response["hits"]["hits"]
+@app.post("/api/v1/batch/")
+async def batch(batch: Batch):
 
-    # Ensure we have some hits
-    if not hits:
-        return []
+    # Many queries with the same parameters (as the foods of a meal), all searched together.
+    # A bad query gets its own error, without failing the others.
+    if len(batch.queries) > BATCH_MAX_QUERIES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Too many queries (at most {})".format(BATCH_MAX_QUERIES),
+        )
+    entries = [{"q": q} for q in batch.queries]
+    searches = []
+    positions = []
+    for i, q in enumerate(batch.queries):
+        try:
+            searches.append(Search(q=q, index_name=batch.index_name, variant=batch.variant, min_score=batch.min_score,
+                                   max_diff=batch.max_diff, see_also=batch.see_also, size=batch.size,
+                                   grouping=batch.grouping, retrieval=batch.retrieval))
+            positions.append(i)
+        except ValidationError as e:
+            entries[i]["error"] = '; '.join(error["msg"] for error in e.errors())
+
+    if searches:
+        for i, hits in zip(positions, await run_searches(searches)):
+            entries[i]["hits"] = [compact_hit(hit) for hit in hits] if batch.format == FormatEnum.compact else hits
+
+    start = time.perf_counter()
+    response = ORJSONResponse(content=entries) if batch.format == FormatEnum.compact else JSONResponse(content=entries)
+    serialization_seconds.observe(time.perf_counter() - start, get_index_label(batch.index_name))
+    return response
 
-    # Set the boundaries
-    min_score = MIN_SCORE if min_score is None else min_score
-    max_diff = MAX_DIFF if max_diff is None else max_diff
 
-    # Only keep the high scoring hits
-    max_score = elastic_response["hits"]["max_score"]
-    high_score_hits = [hit for hit in hits if hit["_score"] >= min_score]
-    if not high_score_hits:
-        return []
-    logger.debug('high_score_hits={}'.format(high_score_hits))
+@app.get("/api/v1/suggest")
+async def suggest(q: str = Query(..., min_length=1, max_length=100),
+                  index_name: Optional[str] = None,
+                  size: int = Query(5, ge=1, le=50)):
+
+    # Suggestions are cached as the search results (with their own keys)
+    cache_key = cache.key(q, index_name, suggest=True, size=size)
+    suggestions = cache.get(cache_key)
+    if suggestions is None:
+        start = time.perf_counter()
+        try:
+            suggestions = await backend.suggest(q, index_name, size=size) or []
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Error during suggest: {}".format(e),
+            )
+        suggest_seconds.observe(time.perf_counter() - start, get_index_label(index_name))
+        cache.set(cache_key, suggestions)
+    return ORJSONResponse(content=suggestions)
 
 
-    # Set the reference main ingredient
-    reference_main_ingredient = high_score_hits[0]['_source']['ingredients'][0]
+@app.get("/api/v1/cache/")
+async def cache_stats():
+    return cache.stats()
 
-    # Filter based on the main ingredient
-    filtered_high_score_hits = []
-    for hit in high_score_hits:
-        if hit['_source']['ingredients'][0] == reference_main_ingredient:
-            filtered_high_score_hits.append(hit)
-    logger.debug('filtered_high_score_hits={}'.format(filtered_high_score_hits))
 
-    # Compute the relative score
-    for hit in filtered_high_score_hits:
-        hit['_relative_score'] = hit["_score"] / max_score
+@app.get("/api/v1/spelling/")
+async def spelling_stats():
+    return spelling.stats()
 
-    # Get now only the close hits based on the relative score
-    close_hits = [
-        hit for hit in filtered_high_score_hits if hit["_relative_score"] >= (1-max_diff)
-    ]
-    logger.debug('close_hits={}'.format(close_hits))
 
-    # Assign results
-    results = close_hits
+@app.get("/api/v1/vectors/")
+async def vectors_stats():
+    return vectors.stats() if vectors else {"loaded": False}
 
-    # Compose the "see also"
-    if see_also:
-        see_also_hits = []
-        for hit in high_score_hits:
-            if hit not in close_hits:
-                hit['see_also'] = True
-                see_also_hits.append(hit)
-        results += see_also_hits
 
-    return results
+def update_stats_gauges():
+    for stat, value in cache.stats().items():
+        cache_stats_gauge.set(value, stat)
+    for stat, value in spelling.stats().items():
+        spelling_stats_gauge.set(int(value), stat)
+    if vectors:
+        for stat, value in vectors.stats().items():
+            vectors_stats_gauge.set(int(value), stat)
+
+
+@app.get("/metrics")
+async def metrics():
+    # The series of all the workers, whichever serves the scrape
+    update_stats_gauges()
+    content = shared_metrics.render() if shared_metrics else render(workers={str(os.getpid()): get_values()})
+    return PlainTextResponse(content, media_type='text/plain; version=0.0.4')
 
+
+@app.get("/health/live")
+async def liveness():
+    # The worker is up and serving requests
+    return {"status": "ok"}
+
+
+@app.get("/health/ready")
+async def readiness(indexes: Optional[str] = None):
+    # The backend can be reached and the indexes to be served (or the given ones) exist
+    index_names = READY_INDEXES if indexes is None else [index_name for index_name in indexes.split(',') if index_name]
+    checks = {"backend": False, "indexes": {index_name: False for index_name in index_names}}
+    try:
+        if backend and await backend.ping():
+            checks["backend"] = True
+            for index_name in index_names:
+                checks["indexes"][index_name] = await backend.index_exists(index_name)
+    except Exception as e:
+        logger.warning('Readiness check failed: {}'.format(e))
+    ready = checks["backend"] and all(checks["indexes"].values())
+    return JSONResponse(content=dict(checks, status="ready" if ready else "not ready"),
+                        status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE)
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+from bisect import bisect_left
+
+# Latencies here go from sub-millisecond (cache, filtering) to seconds (slow searches)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# All the metrics, in order of creation
+REGISTRY = []
+
+# Label of the series of each worker process (its pid)
+WORKER_LABEL = 'worker'
+
+
+def format_labels(label_names, label_values, extra=''):
+    labels = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+              for name, value in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    return '{{{}}}'.format(','.join(labels)) if labels else ''
+
+
+class Metric():
+    """Minimal in-process metric in the Prometheus text format. Label values are given
+    positionally, in the order of the label names, to keep the updates cheap."""
+
+    type = None
+
+    def __init__(self, name, documentation, label_names=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}
+        if registry is not None:
+            registry.append(self)
+
+    def render(self, workers=None):
+        # Own values, or the given ones of each worker (by pid), with a worker label
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        if workers is None:
+            for label_values, value in sorted(self.values.items()):
+                lines += self.render_value(self.label_names, label_values, value)
+        else:
+            for worker, values in sorted(workers.items(), key=lambda item: int(item[0])):
+                for label_values, value in sorted(values.get(self.name, {}).items()):
+                    lines += self.render_value(self.label_names + (WORKER_LABEL,), label_values + (worker,), value)
+        return lines
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, *label_values, value=1):
+        self.values[label_values] = self.values.get(label_values, 0) + value
+
+    def render_value(self, label_names, label_values, value):
+        return ['{}{} {}'.format(self.name, format_labels(label_names, label_values), value)]
+
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+    def render_value(self, label_names, label_values, value):
+        return ['{}{} {}'.format(self.name, format_labels(label_names, label_values), value)]
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, label_names, registry=registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        try:
+            counts = self.values[label_values]
+        except KeyError:
+            # One count per bucket (plus +Inf), then the sum and the total count
+            counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def render_value(self, label_names, label_values, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(self.name, format_labels(label_names, label_values, 'le="{}"'.format(bound)), cumulative))
+        lines.append('{}_sum{} {}'.format(self.name, format_labels(label_names, label_values), counts[-2]))
+        lines.append('{}_count{} {}'.format(self.name, format_labels(label_names, label_values), counts[-1]))
+        return lines
+
+
+def get_values(registry=REGISTRY):
+    return {metric.name: metric.values for metric in registry}
+
+
+def render(registry=REGISTRY, workers=None):
+    lines = []
+    for metric in registry:
+        lines += metric.render(workers)
+    return '\n'.join(lines) + '\n'
+
+
+class SharedMetrics():
+    """Metrics of all the worker processes on a host, as a small file per worker in a directory,
+    saved by each worker every so often, so that whichever worker serves a scrape can return the
+    series of all of them (each with its worker label, as they are counted separately). The files
+    not saved for max_age seconds are of exited workers, and are removed."""
+
+    def __init__(self, path, max_age, registry=REGISTRY):
+        self.path = path
+        self.max_age = max_age
+        self.registry = registry
+        self.worker = str(os.getpid())
+        os.makedirs(path, exist_ok=True)
+
+    def get_file_path(self, worker):
+        return os.path.join(self.path, '{}.json'.format(worker))
+
+    def save(self):
+        # Written aside and then renamed, so that it is never read half written
+        file_path = self.get_file_path(self.worker)
+        with open(file_path + '.tmp', 'w') as f:
+            json.dump({name: [[list(label_values), value] for label_values, value in values.items()]
+                       for name, values in get_values(self.registry).items()}, f)
+        os.replace(file_path + '.tmp', file_path)
+
+    def remove(self):
+        try:
+            os.remove(self.get_file_path(self.worker))
+        except FileNotFoundError:
+            pass
+
+    def get_workers(self):
+        # Values by worker: the current ones of this worker, and the saved ones of the others
+        workers = {}
+        for file_name in os.listdir(self.path):
+            worker, extension = os.path.splitext(file_name)
+            if extension != '.json' or worker == self.worker:
+                continue
+            file_path = os.path.join(self.path, file_name)
+            try:
+                if time.time() - os.path.getmtime(file_path) > self.max_age:
+                    os.remove(file_path)
+                    continue
+                with open(file_path) as f:
+                    workers[worker] = {name: {tuple(label_values): value for label_values, value in values}
+                                       for name, values in json.load(f).items()}
+            except (OSError, ValueError):
+                # Removed meanwhile
+                continue
+        workers[self.worker] = get_values(self.registry)
+        return workers
+
+    def render(self):
+        return render(self.registry, self.get_workers())
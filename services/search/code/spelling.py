@@ -0,0 +1,161 @@
+import asyncio
+from .analysis import tokenize
+from .embedded import get_max_edits, edit_distance
+
+import logging
+logger = logging.getLogger('uvicorn')
+
+# Deletes are only computed on the start of the terms, which keeps the dictionary small
+PREFIX_LENGTH = 7
+MAX_DISTANCE = 2
+MAX_CACHED_LOOKUPS = 10000
+
+# Items added between yields to the other tasks, when loading
+LOAD_YIELD_ITEMS = 1000
+
+
+def get_deletes(term, max_distance=MAX_DISTANCE):
+    # All the strings obtained by deleting up to max_distance characters from the term
+    deletes = {term}
+    edge = {term}
+    for _ in range(max_distance):
+        edge = {string[:i] + string[i+1:] for string in edge for i in range(len(string))} - deletes
+        deletes |= edge
+    return deletes
+
+
+class SpellingIndex():
+    """Typo correction dictionary for the words of the food descriptions, with the SymSpell
+    approach: the deletes of every term are precomputed, so that the candidate corrections for
+    a query term are just the terms sharing a delete with it. Kept up to date on every add and
+    delete, and on all the indexes (a correction to a term which is not in the searched index
+    just finds nothing, and the search falls back on fuzzy matching). With more workers, the
+    writes through the others are only picked up on reloads: the version of all the indexes
+    it is up to date with (see SearchCache) tells whether it is still fresh."""
+
+    def __init__(self):
+        self.items = {}
+        self.counts = {}
+        self.deletes = {}
+        self.lookups = {}
+        self.loaded = False
+        self.version = None
+        self.exact = 0
+        self.corrected = 0
+        self.failed = 0
+
+    def add(self, index_name, uuid, description):
+        self.delete(index_name, uuid)
+        terms = set(tokenize(description))
+        self.items[(index_name, uuid)] = terms
+        for term in terms:
+            if term not in self.counts:
+                self.counts[term] = 0
+                self.lookups = {}
+                for delete in get_deletes(term[:PREFIX_LENGTH]):
+                    self.deletes.setdefault(delete, set()).add(term)
+            self.counts[term] += 1
+
+    def delete(self, index_name, uuid):
+        for term in self.items.pop((index_name, uuid), ()):
+            self.counts[term] -= 1
+            if not self.counts[term]:
+                del self.counts[term]
+                self.lookups = {}
+                for delete in get_deletes(term[:PREFIX_LENGTH]):
+                    self.deletes[delete].discard(term)
+                    if not self.deletes[delete]:
+                        del self.deletes[delete]
+
+    def delete_index(self, index_name):
+        # Also for all its generations
+        prefix = '{}-gen-'.format(index_name)
+        for key in [key for key in self.items if key[0] == index_name or key[0].startswith(prefix)]:
+            self.delete(*key)
+
+    def lookup(self, term):
+        # The closest term (and the most frequent among the closest ones), within the same
+        # edits as the fuzzy matching (so the same typos are fixed), or None if there is none.
+        if term in self.counts:
+            return term
+        try:
+            return self.lookups[term]
+        except KeyError:
+            pass
+        max_edits = get_max_edits(term)
+        if not max_edits:
+            return None
+        candidates = set()
+        for delete in get_deletes(term[:PREFIX_LENGTH], max_edits):
+            candidates.update(self.deletes.get(delete, ()))
+        best = None
+        best_rank = (max_edits + 1,)
+        for candidate in candidates:
+            if abs(len(candidate) - len(term)) > max_edits:
+                continue
+            rank = (edit_distance(term, candidate, max_edits), -self.counts[candidate], candidate)
+            if rank < best_rank:
+                best = candidate
+                best_rank = rank
+        if len(self.lookups) >= MAX_CACHED_LOOKUPS:
+            self.lookups = {}
+        self.lookups[term] = best
+        return best
+
+    def corrections(self, q):
+        # The (term, corrected term) pairs of the query, or None if some term has no correction
+        corrections = []
+        for term in tokenize(q):
+            corrected_term = self.lookup(term)
+            if corrected_term is None:
+                self.failed += 1
+                return None
+            corrections.append((term, corrected_term))
+        if not corrections:
+            self.failed += 1
+            return None
+        if all(term == corrected_term for term, corrected_term in corrections):
+            self.exact += 1
+        else:
+            self.corrected += 1
+        return corrections
+
+    def correct(self, q):
+        # The query with all of its terms corrected, or None if some of them have no correction
+        corrections = self.corrections(q)
+        if corrections is None:
+            return None
+        return ' '.join(corrected_term for _, corrected_term in corrections)
+
+    def sync(self, previous_version, version):
+        # Writes through this worker keep the dictionary up to date, if it already was
+        if self.version is not None and self.version == previous_version:
+            self.version = version
+
+    def fresh(self, version):
+        # Up to date with all the writes up to the given version (of all the indexes)
+        return self.version is not None and self.version == version
+
+    async def load(self, backend, version=None):
+        # (Re)build the dictionary from all the items in the backend, and then swap it in. The
+        # version (of all the indexes) is to be taken before, as the writes during the scan
+        # may be missed. The other tasks run every so often, as the scan does not wait on the
+        # embedded backend.
+        spelling = SpellingIndex()
+        async for index_name, uuid, source in backend.scan_items():
+            spelling.add(index_name, uuid, source.get("description", ""))
+            if not len(spelling.items) % LOAD_YIELD_ITEMS:
+                await asyncio.sleep(0)
+        self.items, self.counts, self.deletes, self.lookups = spelling.items, spelling.counts, spelling.deletes, {}
+        self.loaded = True
+        self.version = version
+        logger.info('SpellingIndex: loaded {} terms from {} items'.format(len(self.counts), len(self.items)))
+
+    def stats(self):
+        return {"loaded": self.loaded,
+                "items": len(self.items),
+                "terms": len(self.counts),
+                "deletes": len(self.deletes),
+                "exact": self.exact,
+                "corrected": self.corrected,
+                "failed": self.failed}
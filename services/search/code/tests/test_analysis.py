@@ -0,0 +1,21 @@
+import unittest
+from ..analysis import tokenize, analyze, stem
+
+
+class TestAnalysis(unittest.TestCase):
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize("Pasta all'Amatriciana con il guanciale"), ['pasta', 'amatriciana', 'guanciale'])
+        self.assertEqual(tokenize("Uova all’occhio di bue"), ['uova', 'occhio', 'bue'])
+        self.assertEqual(tokenize("Tiramisù senza caffè"), ['tiramisu', 'senza', 'caffe'])
+
+    def test_stem(self):
+        self.assertEqual(stem('pomodori'), 'pomodor')
+        self.assertEqual(stem('pomodoro'), 'pomodor')
+        self.assertEqual(stem('bianche'), 'bianc')
+        self.assertEqual(stem('bianchi'), 'bianc')
+        self.assertEqual(stem('arancia'), 'aranc')
+        self.assertEqual(stem('pesce'), 'pesce')
+
+    def test_analyze(self):
+        self.assertEqual(analyze("Insalata di pomodori"), analyze("insalate con pomodoro"))
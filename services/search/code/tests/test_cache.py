@@ -0,0 +1,72 @@
+import tempfile
+import unittest
+from ..cache import SearchCache, SharedIndexVersions
+
+TEST_INDEX_NAME = 'test_food_cache'
+
+
+class TestSearchCache(unittest.TestCase):
+
+    def setUp(self):
+        # A settle time long enough not to elapse during the tests
+        self.cache = SearchCache(max_entries=10, ttl=300, settle_time=60)
+
+    def test_get_set(self):
+        key = self.cache.key(' Insalata  CAPRESE', TEST_INDEX_NAME, size=10)
+        self.assertEqual(key, self.cache.key('insalata caprese', TEST_INDEX_NAME, size=10))
+        self.assertIsNone(self.cache.get(key))
+        self.cache.set(key, ['hit'])
+        self.assertEqual(self.cache.get(key), ['hit'])
+
+        # Writes invalidate the cached results, by a new version of the index
+        self.cache.bump(TEST_INDEX_NAME, refreshed=True)
+        self.assertIsNone(self.cache.get(self.cache.key('insalata caprese', TEST_INDEX_NAME, size=10)))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_settle_time(self):
+
+        # Not caching after a write not refreshed yet, on that index only
+        self.cache.bump(TEST_INDEX_NAME)
+        key = self.cache.key('caprese', TEST_INDEX_NAME)
+        self.cache.set(key, ['hit'])
+        self.assertIsNone(self.cache.get(key))
+        self.cache.set(self.cache.key('caprese', 'test_food_other'), ['hit'])
+        self.assertEqual(self.cache.get(self.cache.key('caprese', 'test_food_other')), ['hit'])
+        self.cache.set(self.cache.key('caprese', None), ['hit'])
+        self.assertIsNone(self.cache.get(self.cache.key('caprese', None)))
+
+        # Until a refreshed write, which makes the previous ones visible as well (on that
+        # index only, so not for the searches on all the indexes)
+        self.cache.bump(TEST_INDEX_NAME, refreshed=True)
+        key = self.cache.key('caprese', TEST_INDEX_NAME)
+        self.cache.set(key, ['hit'])
+        self.assertEqual(self.cache.get(key), ['hit'])
+        self.cache.set(self.cache.key('caprese', None), ['hit'])
+        self.assertIsNone(self.cache.get(self.cache.key('caprese', None)))
+
+    def test_shared_versions(self):
+        with tempfile.TemporaryDirectory() as path:
+
+            # Two workers, with their own entries but the same versions
+            cache = SearchCache(settle_time=60, versions=SharedIndexVersions(path))
+            other_cache = SearchCache(settle_time=60, versions=SharedIndexVersions(path))
+            key = cache.key('caprese', TEST_INDEX_NAME)
+            self.assertEqual(key, other_cache.key('caprese', TEST_INDEX_NAME))
+            other_cache.set(key, ['hit'])
+
+            # Writes through one invalidate the entries of the other
+            self.assertEqual(cache.bump(TEST_INDEX_NAME, refreshed=True), (0, 1))
+            self.assertIsNone(other_cache.get(other_cache.key('caprese', TEST_INDEX_NAME)))
+            self.assertEqual(other_cache.version(TEST_INDEX_NAME), 1)
+            self.assertEqual(other_cache.version(None), 1)
+
+            # And settle them
+            cache.bump(TEST_INDEX_NAME)
+            key = other_cache.key('caprese', TEST_INDEX_NAME)
+            other_cache.set(key, ['hit'])
+            self.assertIsNone(other_cache.get(key))
+            self.assertEqual(other_cache.bump(TEST_INDEX_NAME, refreshed=True), (2, 3))
+            key = cache.key('caprese', TEST_INDEX_NAME)
+            cache.set(key, ['hit'])
+            self.assertEqual(cache.get(key), ['hit'])
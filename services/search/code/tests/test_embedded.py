@@ -0,0 +1,120 @@
+import os
+import tempfile
+import unittest
+from ..main import filter_hits
+from ..backend import ItemNotFound
+from ..embedded import EmbeddedFood, edit_distance
+from ..benchmarks.concurrency import load_examples
+
+TEST_INDEX_NAME = 'test_food_embedded'
+
+
+class TestEditDistance(unittest.TestCase):
+
+    def test_edit_distance(self):
+        self.assertEqual(edit_distance('pasta', 'pasta', 2), 0)
+        self.assertEqual(edit_distance('pasta', 'pasto', 2), 1)
+        self.assertEqual(edit_distance('pasta', 'psata', 2), 1)
+        self.assertEqual(edit_distance('pasta', 'pastasciutta', 2), 3)
+        self.assertEqual(edit_distance('riso', 'fiso', 1), 1)
+
+
+class TestEmbeddedFood(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.backend = EmbeddedFood()
+        await self.backend.reset_index(TEST_INDEX_NAME)
+        await self.backend.bulk_items([{'action': 'index', 'index_name': TEST_INDEX_NAME, 'uuid': example['uuid'],
+                                        'item': dict(example, index_name=TEST_INDEX_NAME)} for example in load_examples()])
+
+    async def test_query(self):
+
+        response = await self.backend.query('riso', TEST_INDEX_NAME)
+        self.assertEqual(response['hits']['hits'][0]['_source']['description'], 'Arancini di riso')
+        score = response['hits']['hits'][0]['_score']
+
+        # Typos, scored down by the edits over the term length
+        response = await self.backend.query('fiso', TEST_INDEX_NAME)
+        self.assertEqual(response['hits']['hits'][0]['_source']['description'], 'Arancini di riso')
+        self.assertAlmostEqual(response['hits']['hits'][0]['_score'], score * 0.75, places=5)
+
+        # All the terms must match
+        response = await self.backend.query('riso xyzxyzxyz', TEST_INDEX_NAME)
+        self.assertEqual(response['hits']['hits'], [])
+
+        # Min score and size
+        response = await self.backend.query('insalata', TEST_INDEX_NAME, size=2)
+        self.assertEqual(len(response['hits']['hits']), 2)
+        response = await self.backend.query('insalata', TEST_INDEX_NAME, min_score=100)
+        self.assertEqual(response['hits']['hits'], [])
+
+        # Filtering works the same
+        self.assertTrue(filter_hits(await self.backend.query('insalata', TEST_INDEX_NAME)))
+
+        # Missing index
+        self.assertIsNone(await self.backend.query('pasta', 'test_food_missing'))
+
+    async def test_scores(self):
+        # Same scores as Elasticsearch
+        backend = EmbeddedFood()
+        await backend.add_item({'uuid': 'f', 'description': 'Insalata caprese', 'ingredients': ['mozzarella']}, TEST_INDEX_NAME)
+        response = await backend.query('caprese', TEST_INDEX_NAME)
+        self.assertEqual(response['hits']['max_score'], 0.2876821)
+
+    async def test_suggest(self):
+        suggestions = await self.backend.suggest('arancini di r', TEST_INDEX_NAME)
+        self.assertEqual([suggestion['description'] for suggestion in suggestions], ['Arancini di riso', 'Arancini di riso classici'])
+        self.assertEqual(len(await self.backend.suggest('ara', TEST_INDEX_NAME, size=3)), 3)
+        self.assertEqual(await self.backend.suggest('xyz', TEST_INDEX_NAME), [])
+        self.assertIsNone(await self.backend.suggest('ara', 'test_food_missing'))
+
+    async def test_variants(self):
+        await self.backend.add_item({'uuid': 'a', 'description': 'Pizza margherita', 'ingredients': ['pizza'],
+                                     'has_servings': True, 'has_pieces': False}, TEST_INDEX_NAME)
+        await self.backend.add_item({'uuid': 'b', 'description': 'Pizza margherita', 'ingredients': ['pizza'],
+                                     'has_servings': False, 'has_pieces': True}, TEST_INDEX_NAME)
+        response = await self.backend.query('pizza margherita', TEST_INDEX_NAME, variant='pieces')
+        self.assertEqual([hit['_id'] for hit in response['hits']['hits']], ['b'])
+
+    async def test_add_delete(self):
+        await self.backend.add_item({'uuid': 'c', 'description': 'Zuppa inglese', 'ingredients': ['zuppa']}, TEST_INDEX_NAME)
+        response = await self.backend.query('zuppa inglese', TEST_INDEX_NAME)
+        self.assertEqual(response['hits']['hits'][0]['_id'], 'c')
+        await self.backend.delete_item('c', TEST_INDEX_NAME)
+        response = await self.backend.query('zuppa inglese', TEST_INDEX_NAME)
+        self.assertEqual(response['hits']['hits'], [])
+        with self.assertRaises(ItemNotFound):
+            await self.backend.delete_item('c', TEST_INDEX_NAME)
+
+    async def test_delete_items(self):
+        examples = load_examples()
+        uuids = [example['uuid'] for example in examples if 'riso' in example['description'].lower()]
+        self.assertTrue(uuids)
+
+        # Missing items (and indexes) are skipped
+        self.assertEqual(await self.backend.delete_items(uuids + ['missing'], TEST_INDEX_NAME), len(uuids))
+        response = await self.backend.query('riso', TEST_INDEX_NAME, size=100)
+        self.assertFalse(set(hit['_id'] for hit in response['hits']['hits']) & set(uuids))
+        response = await self.backend.query('insalata', TEST_INDEX_NAME)
+        self.assertTrue(response['hits']['hits'])
+        self.assertEqual(await self.backend.delete_items(uuids, TEST_INDEX_NAME), 0)
+        self.assertEqual(await self.backend.delete_items(uuids, 'test_food_missing'), 0)
+
+    async def test_generations(self):
+        generation = await self.backend.build_generation(TEST_INDEX_NAME)
+        await self.backend.add_item({'uuid': 'd', 'description': 'Torta della nonna', 'ingredients': ['torta']}, generation)
+        self.assertEqual(await self.backend.swap_generation(TEST_INDEX_NAME, generation), [])
+        response = await self.backend.query('torta', TEST_INDEX_NAME)
+        self.assertEqual([hit['_id'] for hit in response['hits']['hits']], ['d'])
+        self.assertEqual(response['hits']['hits'][0]['_index'], generation)
+        self.assertTrue(await self.backend.index_exists(TEST_INDEX_NAME))
+        self.assertTrue(await self.backend.index_exists(generation))
+        self.assertFalse(await self.backend.index_exists('test_food_missing'))
+
+    async def test_persistence(self):
+        with tempfile.TemporaryDirectory() as path:
+            backend = EmbeddedFood(os.path.join(path, 'embedded.json'), save_delay=0)
+            await backend.add_item({'uuid': 'e', 'description': 'Tiramisù', 'ingredients': ['tiramisù']}, TEST_INDEX_NAME)
+            await backend.close()
+            response = await EmbeddedFood(os.path.join(path, 'embedded.json')).query('tiramisu', TEST_INDEX_NAME)
+            self.assertEqual([hit['_id'] for hit in response['hits']['hits']], ['e'])
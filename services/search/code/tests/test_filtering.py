@@ -0,0 +1,128 @@
+import copy
+import random
+import unittest
+from ..main import filter_hits
+from ..elastic import ElasticFood, ELASTIC_HOST, build_query
+from ..benchmarks.concurrency import load_examples
+
+# Note: the end-to-end tests need the elastic service, and are skipped if it is not there.
+
+TEST_INDEX_NAME = 'test_food_filtering'
+BOUNDARIES = [(0, 1), (0.1, 0.3), (0.5, 0.3), (0.5, 0), (1, 0.05), (2, 0.2)]
+
+
+def legacy_query(q):
+    # The search query as it was before pushing the filtering down into Elasticsearch
+    return {"query": {"multi_match": {"query": q, "fields": ["description"], "fuzziness": "AUTO", "operator": "and"}}}
+
+
+def legacy_filter_hits(elastic_response, min_score, max_diff, see_also):
+    # The hits filtering as it was before pushing it down into Elasticsearch
+    if not elastic_response:
+        return []
+    hits = elastic_response["hits"]["hits"]
+    if not hits:
+        return []
+    max_score = elastic_response["hits"]["max_score"]
+    high_score_hits = [hit for hit in hits if hit["_score"] >= min_score]
+    if not high_score_hits:
+        return []
+    reference_main_ingredient = high_score_hits[0]['_source']['ingredients'][0]
+    filtered_high_score_hits = []
+    for hit in high_score_hits:
+        if hit['_source']['ingredients'][0] == reference_main_ingredient:
+            filtered_high_score_hits.append(hit)
+    for hit in filtered_high_score_hits:
+        hit['_relative_score'] = hit["_score"] / max_score
+    close_hits = [hit for hit in filtered_high_score_hits if hit["_relative_score"] >= (1-max_diff)]
+    results = close_hits
+    if see_also:
+        see_also_hits = []
+        for hit in high_score_hits:
+            if hit not in close_hits:
+                hit['see_also'] = True
+                see_also_hits.append(hit)
+        results += see_also_hits
+    return results
+
+
+def get_queries(examples):
+    queries = set()
+    for example in examples:
+        words = example['description'].split(' ')
+        queries.add(words[0])
+        queries.add(' '.join(words[0:2]))
+        queries.add(words[-1])
+        queries.add(example['ingredients'][0])
+    return sorted(query for query in queries if len(query) >= 3)
+
+
+class TestFilterHits(unittest.TestCase):
+
+    def test_filter_hits_same_as_legacy(self):
+
+        examples = load_examples()
+        rand = random.Random(42)
+
+        for _ in range(500):
+
+            # Some random scored hits, sorted by score as they come from Elasticsearch
+            hits = []
+            for example in rand.sample(examples, rand.randint(1, 30)):
+                hits.append({'_index': TEST_INDEX_NAME, '_id': example['uuid'],
+                             '_score': round(rand.choice([0.2, 0.5, 1, 2, 4]) * rand.random(), 3),
+                             '_source': example})
+            hits.sort(key=lambda hit: hit['_score'], reverse=True)
+
+            for min_score, max_diff in BOUNDARIES:
+                for see_also in [False, True]:
+
+                    # Before: the first ten hits, whatever their score
+                    legacy_response = {'hits': {'max_score': hits[0]['_score'], 'hits': copy.deepcopy(hits[0:10])}}
+                    expected = legacy_filter_hits(legacy_response, min_score, max_diff, see_also)
+
+                    # After: the first ten hits with at least min_score (the Elasticsearch min_score)
+                    response = {'hits': {'hits': copy.deepcopy([hit for hit in hits if hit['_score'] >= min_score][0:10])}}
+                    self.assertEqual(filter_hits(response, min_score, max_diff, see_also), expected)
+
+
+class TestBuildQuery(unittest.TestCase):
+
+    def test_build_query(self):
+        self.assertEqual(build_query('insalata caprese')['query']['bool']['must'], legacy_query('insalata caprese')['query'])
+        self.assertNotIn('fuzziness', build_query('insalata caprese', fuzzy=False)['query']['bool']['must']['multi_match'])
+
+        # The terms with alternatives match on any of them, the others as before
+        must = build_query('insalata caprese', fuzzy=False, alternatives={'insalata': ['insalta']})['query']['bool']['must']
+        self.assertEqual(must, [{'multi_match': {'query': 'caprese', 'fields': ['description'], 'operator': 'and'}},
+                                {'match': {'description': {'query': 'insalata insalta'}}}])
+
+
+class TestFilterHitsEndToEnd(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.es = ElasticFood(ELASTIC_HOST)
+        try:
+            await self.es.info()
+        except Exception:
+            await self.es.close()
+            self.skipTest('Elasticsearch is not reachable')
+        self.examples = load_examples()
+        await self.es.reset_index(TEST_INDEX_NAME)
+        await self.es.bulk_items([{'action': 'index', 'index_name': TEST_INDEX_NAME, 'uuid': example['uuid'],
+                                   'item': dict(example, index_name=TEST_INDEX_NAME)} for example in self.examples])
+        await self.es.indices.refresh(index=TEST_INDEX_NAME)
+
+    async def asyncTearDown(self):
+        await self.es.delete_index(TEST_INDEX_NAME)
+        await self.es.close()
+
+    async def test_filter_hits_same_as_legacy_on_examples(self):
+        for q in get_queries(self.examples):
+            legacy_response = (await self.es.search(index=TEST_INDEX_NAME, body=legacy_query(q))).body
+            for min_score, max_diff in BOUNDARIES:
+                for see_also in [False, True]:
+                    expected = legacy_filter_hits(copy.deepcopy(legacy_response), min_score, max_diff, see_also)
+                    response = (await self.es.query(q, TEST_INDEX_NAME, min_score=min_score)).body
+                    self.assertEqual(filter_hits(response, min_score, max_diff, see_also), expected,
+                                     msg='q="{}", min_score={}, max_diff={}, see_also={}'.format(q, min_score, max_diff, see_also))
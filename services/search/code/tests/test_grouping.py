@@ -0,0 +1,64 @@
+import time
+import random
+import unittest
+from ..main import filter_hits
+from ..grouping import group_hits
+
+
+def get_hits(scores_and_ingredients):
+    return {"hits": {"hits": [{"_id": str(i), "_score": score, "_source": {"ingredients": ingredients}}
+                              for i, (score, ingredients) in enumerate(scores_and_ingredients)]}}
+
+
+class TestGroupHits(unittest.TestCase):
+
+    def test_outlier_on_top(self):
+        scores = [2.0, 1.9, 1.9, 1.85]
+        ingredients = [['pomodoro', 'basilico'], ['riso', 'pollo'], ['riso', 'piselli'], ['riso', 'carote']]
+        relative_scores, candidates, close = group_hits(scores, ingredients, max_diff=0.3)
+        self.assertEqual(relative_scores.tolist(), [1.0, 0.95, 0.95, 0.925])
+        self.assertEqual(candidates.tolist(), [True, True, True, True])
+        self.assertEqual(close.tolist(), [False, True, True, True])
+
+    def test_score_gap(self):
+        scores = [2.0, 1.95, 1.5, 1.45]
+        ingredients = [['riso'], ['riso'], ['riso'], ['riso']]
+        _, candidates, close = group_hits(scores, ingredients, max_diff=0.3)
+        self.assertEqual(candidates.tolist(), [True, True, False, False])
+        self.assertEqual(close.tolist(), [True, True, False, False])
+
+    def test_no_overlap(self):
+        # A lone hit, or hits with nothing in common, are all close
+        self.assertEqual(group_hits([2.0], [['riso']], max_diff=0.3)[2].tolist(), [True])
+        self.assertEqual(group_hits([2.0, 2.0], [['riso'], ['pollo']], max_diff=0.3)[2].tolist(), [True, True])
+
+    def test_max_hits(self):
+        rand = random.Random(42)
+        ingredients = ['riso', 'pollo', 'pomodoro', 'basilico', 'mozzarella', 'piselli', 'carote', 'olio']
+        scores = sorted((rand.uniform(1, 2) for _ in range(1000)), reverse=True)
+        hits_ingredients = [rand.sample(ingredients, 3) for _ in scores]
+        start = time.perf_counter()
+        _, candidates, close = group_hits(scores, hits_ingredients, max_diff=1, max_gap=1, max_hits=300)
+        self.assertLess(time.perf_counter() - start, 1)
+        self.assertFalse(candidates[300:].any())
+        self.assertFalse(close[300:].any())
+        self.assertTrue(close[0:300].any())
+
+
+class TestFilterHitsClusters(unittest.TestCase):
+
+    def test_filter_hits_clusters(self):
+        response = get_hits([(2.0, ['pomodoro']), (1.9, ['riso', 'pollo']), (1.9, ['riso', 'piselli']), (0.2, ['riso'])])
+
+        # The main ingredient keeps the outlier only
+        results = filter_hits(response, min_score=0.5, max_diff=0.3, see_also=True, grouping='main_ingredient')
+        self.assertEqual([(hit['_id'], hit.get('see_also', False)) for hit in results], [('0', False), ('1', True), ('2', True)])
+
+        # The clusters keep the others
+        counts = {}
+        results = filter_hits(get_hits([(2.0, ['pomodoro']), (1.9, ['riso', 'pollo']), (1.9, ['riso', 'piselli']), (0.2, ['riso'])]),
+                              min_score=0.5, max_diff=0.3, see_also=True, counts=counts, grouping='clusters')
+        self.assertEqual([(hit['_id'], hit.get('see_also', False)) for hit in results], [('1', False), ('2', False), ('0', True)])
+        self.assertAlmostEqual(results[0]['_relative_score'], 0.95)
+        self.assertNotIn('_relative_score', results[2])
+        self.assertEqual(counts, {"received": 4, "min_score": 1, "score_gap": 0, "ingredients": 1, "returned": 3})
@@ -0,0 +1,79 @@
+import os
+import time
+import tempfile
+import unittest
+from ..main import filter_hits
+from ..metrics import Counter, Histogram, SharedMetrics, render
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counter(self):
+        registry = []
+        counter = Counter('test_total', 'A test counter', ['index', 'stage'], registry=registry)
+        counter.inc('food', 'min_score')
+        counter.inc('food', 'min_score', value=2)
+        counter.inc('my "food"', 'main_ingredient')
+        self.assertEqual(render(registry), '# HELP test_total A test counter\n'
+                                           '# TYPE test_total counter\n'
+                                           'test_total{index="food",stage="min_score"} 3\n'
+                                           'test_total{index="my \\"food\\"",stage="main_ingredient"} 1\n')
+
+    def test_histogram(self):
+        registry = []
+        histogram = Histogram('test_seconds', 'A test histogram', ['index'], buckets=(0.1, 1), registry=registry)
+        histogram.observe(0.05, 'food')
+        histogram.observe(0.1, 'food')
+        histogram.observe(5, 'food')
+        self.assertEqual(render(registry), '# HELP test_seconds A test histogram\n'
+                                           '# TYPE test_seconds histogram\n'
+                                           'test_seconds_bucket{index="food",le="0.1"} 2\n'
+                                           'test_seconds_bucket{index="food",le="1"} 2\n'
+                                           'test_seconds_bucket{index="food",le="+Inf"} 3\n'
+                                           'test_seconds_sum{index="food"} 5.15\n'
+                                           'test_seconds_count{index="food"} 3\n')
+
+    def test_shared_metrics(self):
+        with tempfile.TemporaryDirectory() as path:
+            registry = []
+            counter = Counter('test_total', 'A test counter', ['index'], registry=registry)
+            histogram = Histogram('test_seconds', 'A test histogram', ['index'], buckets=(1,), registry=registry)
+            shared_metrics = SharedMetrics(path, max_age=60, registry=registry)
+            worker = str(os.getpid())
+
+            # The series of the other workers as last saved, and the current ones of this worker
+            counter.inc('food', value=2)
+            histogram.observe(0.5, 'food')
+            shared_metrics.worker = '1'
+            shared_metrics.save()
+            shared_metrics.worker = worker
+            counter.inc('food')
+            self.assertEqual(shared_metrics.render(), '# HELP test_total A test counter\n'
+                                                      '# TYPE test_total counter\n'
+                                                      'test_total{index="food",worker="1"} 2\n'
+                                                      'test_total{index="food",worker="' + worker + '"} 3\n'
+                                                      '# HELP test_seconds A test histogram\n'
+                                                      '# TYPE test_seconds histogram\n'
+                                                      'test_seconds_bucket{index="food",worker="1",le="1"} 1\n'
+                                                      'test_seconds_bucket{index="food",worker="1",le="+Inf"} 1\n'
+                                                      'test_seconds_sum{index="food",worker="1"} 0.5\n'
+                                                      'test_seconds_count{index="food",worker="1"} 1\n'
+                                                      'test_seconds_bucket{index="food",worker="' + worker + '",le="1"} 1\n'
+                                                      'test_seconds_bucket{index="food",worker="' + worker + '",le="+Inf"} 1\n'
+                                                      'test_seconds_sum{index="food",worker="' + worker + '"} 0.5\n'
+                                                      'test_seconds_count{index="food",worker="' + worker + '"} 1\n')
+
+            # Until they are not saved for too long, as of exited workers
+            os.utime(shared_metrics.get_file_path('1'), (time.time() - 120, time.time() - 120))
+            self.assertNotIn('worker="1"', shared_metrics.render())
+            self.assertEqual(os.listdir(path), [])
+
+    def test_filter_hits_counts(self):
+        hits = [{"_score": 2.0, "_source": {"ingredients": ["riso"]}},
+                {"_score": 1.9, "_source": {"ingredients": ["pollo"]}},
+                {"_score": 1.0, "_source": {"ingredients": ["riso"]}},
+                {"_score": 0.1, "_source": {"ingredients": ["riso"]}}]
+        counts = {}
+        results = filter_hits({"hits": {"hits": hits}}, min_score=0.5, max_diff=0.3, see_also=True, counts=counts)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(counts, {"received": 4, "min_score": 1, "main_ingredient": 1, "relative_score": 1, "returned": 3})
@@ -0,0 +1,85 @@
+import unittest
+from ..spelling import SpellingIndex
+from ..embedded import EmbeddedFood
+from ..benchmarks.concurrency import load_examples
+
+TEST_INDEX_NAME = 'test_food_spelling'
+
+
+class TestSpellingIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.spelling = SpellingIndex()
+        for example in load_examples():
+            self.spelling.add(TEST_INDEX_NAME, example['uuid'], example['description'])
+
+    def test_correct(self):
+        # Stopwords are dropped (as they are by the analyzer)
+        self.assertEqual(self.spelling.correct('Arancini di riso'), 'arancini riso')
+        self.assertEqual(self.spelling.correct('arancni di rsio'), 'arancini riso')
+        self.assertEqual(self.spelling.correct('insalta caprese'), 'insalata caprese')
+
+        # Too far (or too short) to be corrected
+        self.assertIsNone(self.spelling.correct('arancini xyzxyzxyz'))
+        self.assertIsNone(self.spelling.correct('zz riso'))
+
+        self.assertEqual(self.spelling.stats()['exact'], 1)
+        self.assertEqual(self.spelling.stats()['corrected'], 2)
+        self.assertEqual(self.spelling.stats()['failed'], 2)
+
+    def test_add_delete(self):
+        self.spelling = SpellingIndex()
+        self.assertIsNone(self.spelling.correct('panettone'))
+        self.spelling.add(TEST_INDEX_NAME, 'a', 'Panettone')
+        self.spelling.add(TEST_INDEX_NAME + '-gen-1', 'a', 'Panettone')
+        self.assertEqual(self.spelling.correct('panetotne'), 'panettone')
+        self.spelling.delete(TEST_INDEX_NAME, 'a')
+        self.assertEqual(self.spelling.correct('panetotne'), 'panettone')
+        self.spelling.delete_index(TEST_INDEX_NAME)
+        self.assertIsNone(self.spelling.correct('panetotne'))
+        self.assertEqual(self.spelling.stats()['terms'], 0)
+        self.assertEqual(self.spelling.stats()['deletes'], 0)
+
+
+    def test_fresh(self):
+        # Up to date with the writes through this worker only
+        self.assertFalse(self.spelling.fresh(0))
+        self.spelling.version = 3
+        self.assertTrue(self.spelling.fresh(3))
+        self.spelling.sync(3, 4)
+        self.assertTrue(self.spelling.fresh(4))
+        self.spelling.sync(5, 6)
+        self.assertFalse(self.spelling.fresh(6))
+        self.spelling.sync(6, 7)
+        self.assertFalse(self.spelling.fresh(7))
+
+        self.assertEqual(self.spelling.corrections('insalta di riso'), [('insalta', 'insalata'), ('riso', 'riso')])
+        self.assertIsNone(self.spelling.corrections('insalta xyzxyzxyz'))
+
+
+class TestSpellingIndexLoad(unittest.IsolatedAsyncioTestCase):
+
+    async def test_load(self):
+        backend = EmbeddedFood()
+        await backend.add_item({'uuid': 'b', 'description': 'Zuppa inglese', 'ingredients': ['zuppa']}, TEST_INDEX_NAME)
+        spelling = SpellingIndex()
+        await spelling.load(backend)
+        self.assertTrue(spelling.loaded)
+        self.assertEqual(spelling.correct('zupa inglse'), 'zuppa inglese')
+
+        # Exact terms only
+        response = await backend.query('zupa inglse', TEST_INDEX_NAME, fuzzy=False)
+        self.assertEqual(response['hits']['hits'], [])
+        response = await backend.query(spelling.correct('zupa inglse'), TEST_INDEX_NAME, fuzzy=False)
+        self.assertEqual(response['hits']['hits'][0]['_id'], 'b')
+
+        # Loaded up to the given version
+        await spelling.load(backend, version=5)
+        self.assertTrue(spelling.fresh(5))
+
+        # The original terms can be kept as alternatives, not to miss the items a wrong correction would
+        await backend.add_item({'uuid': 'c', 'description': 'Zuppa anglese', 'ingredients': ['zuppa']}, TEST_INDEX_NAME)
+        response = await backend.query('zuppa inglese', TEST_INDEX_NAME, fuzzy=False)
+        self.assertEqual([hit['_id'] for hit in response['hits']['hits']], ['b'])
+        response = await backend.query('zuppa inglese', TEST_INDEX_NAME, fuzzy=False, alternatives={'inglese': ['anglese']})
+        self.assertEqual(sorted(hit['_id'] for hit in response['hits']['hits']), ['b', 'c'])
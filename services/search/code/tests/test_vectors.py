@@ -0,0 +1,94 @@
+import unittest
+from ..embedded import EmbeddedFood
+from ..vectors import VectorIndex, get_ngrams
+from ..benchmarks.concurrency import load_examples
+
+TEST_INDEX_NAME = 'test_food_vectors'
+
+
+class TestVectorIndex(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.backend = EmbeddedFood()
+        await self.backend.bulk_items([{'action': 'index', 'index_name': TEST_INDEX_NAME, 'uuid': example['uuid'],
+                                        'item': dict(example, index_name=TEST_INDEX_NAME)} for example in load_examples()])
+        self.vectors = VectorIndex(capacity=16)
+        await self.vectors.load(self.backend)
+
+    def get_descriptions(self, q, **kwargs):
+        return [hit['_source']['description'] for hit in self.vectors.query(q, TEST_INDEX_NAME, **kwargs)['hits']['hits']]
+
+    def test_ngrams(self):
+        self.assertEqual(get_ngrams("Riso all'uovo"), [' ri', 'ris', 'iso', 'so ', ' uo', 'uov', 'ovo', 'vo '])
+
+    def test_query(self):
+        self.assertEqual(self.vectors.stats()['items'], len(load_examples()))
+        self.assertEqual(self.get_descriptions('tiramisu', size=1), ['Tiramisù'])
+
+        # Partial and reordered descriptions
+        self.assertEqual(self.get_descriptions('insal capr', size=1), ['Insalata caprese'])
+        self.assertEqual(self.get_descriptions('bufala mozzarella caprese', size=1), ['Insalata caprese con mozzarella di bufala'])
+
+        # Scores are cosine similarities, best first
+        hits = self.vectors.query('arancini', TEST_INDEX_NAME, min_score=0.3)['hits']['hits']
+        self.assertTrue(hits)
+        self.assertTrue(all('Arancini' in hit['_source']['description'] for hit in hits))
+        scores = [hit['_score'] for hit in hits]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertTrue(all(0.3 <= score <= 1 for score in scores))
+
+        # Nothing on other indexes
+        self.assertEqual(self.vectors.query('tiramisu', 'test_food_missing')['hits']['hits'], [])
+
+    async def test_add_delete(self):
+        self.vectors.add(TEST_INDEX_NAME, 'a', {'uuid': 'a', 'description': 'Pomodori ripieni di riso', 'ingredients': ['pomodoro'], 'has_pieces': True})
+        self.assertEqual(self.get_descriptions('pomodori ripieni', size=1), ['Pomodori ripieni di riso'])
+        self.assertEqual(self.get_descriptions('pomodori ripieni', size=1, variant='pieces'), ['Pomodori ripieni di riso'])
+        self.vectors.delete(TEST_INDEX_NAME, 'a')
+        self.assertNotIn('Pomodori ripieni di riso', self.get_descriptions('pomodori ripieni'))
+
+        # Rows grow as needed
+        for i in range(100):
+            self.vectors.add(TEST_INDEX_NAME, str(i), {'uuid': str(i), 'description': 'Torta numero {}'.format(i), 'ingredients': ['torta']})
+        self.assertEqual(self.vectors.stats()['items'], len(load_examples()) + 100)
+        self.assertEqual(self.vectors.query('torta numero 42', TEST_INDEX_NAME, size=1)['hits']['hits'][0]['_id'], '42')
+
+        # Entries of the deleted items are dropped by the merges, keeping the others (also the added ones)
+        entries = self.vectors.stats()['entries']
+        for i in range(50):
+            self.vectors.delete(TEST_INDEX_NAME, str(i))
+        self.vectors.merge()
+        capacity = self.vectors.stats()['capacity']
+        self.assertEqual(self.vectors.stats()['garbage'], 0)
+        self.assertLess(self.vectors.stats()['entries'], entries)
+        hits = self.vectors.query('torta numero', TEST_INDEX_NAME, size=200)['hits']['hits']
+        self.assertEqual(sorted(int(hit['_id']) for hit in hits if hit['_id'].isdigit()), list(range(50, 100)))
+        self.assertEqual(self.vectors.query('torta numero 84', TEST_INDEX_NAME, size=1)['hits']['hits'][0]['_id'], '84')
+        self.assertEqual(self.get_descriptions('tiramisu', size=1), ['Tiramisù'])
+
+        # And their rows are reused
+        self.vectors.add(TEST_INDEX_NAME, 'c', {'uuid': 'c', 'description': 'Crostata di frutta', 'ingredients': ['frutta']})
+        self.assertEqual(self.vectors.stats()['capacity'], capacity)
+        self.assertEqual(self.get_descriptions('crostata', size=1), ['Crostata di frutta'])
+        self.vectors.delete_index(TEST_INDEX_NAME)
+        self.assertEqual(self.vectors.stats()['items'], 0)
+        self.assertEqual(self.get_descriptions('torta'), [])
+
+    async def test_fresh(self):
+        # Up to date with the version it was loaded at, and then with the writes through this worker only
+        await self.vectors.load(self.backend, version=3)
+        self.assertTrue(self.vectors.fresh(3))
+        self.vectors.sync(3, 4)
+        self.assertTrue(self.vectors.fresh(4))
+        self.vectors.sync(5, 6)
+        self.assertFalse(self.vectors.fresh(6))
+        self.vectors.sync(6, 7)
+        self.assertFalse(self.vectors.fresh(7))
+
+    async def test_aliases(self):
+        generation = await self.backend.build_generation('test_food_alias')
+        await self.backend.add_item({'uuid': 'b', 'description': 'Pasta alla norma', 'ingredients': ['pasta']}, generation)
+        await self.backend.swap_generation('test_food_alias', generation)
+        await self.vectors.load(self.backend)
+        hits = self.vectors.query('norma', 'test_food_alias')['hits']['hits']
+        self.assertEqual([(hit['_index'], hit['_id']) for hit in hits], [(generation, 'b')])
@@ -0,0 +1,264 @@
+import os
+import time
+import zlib
+import asyncio
+from collections import Counter
+import numpy as np
+from .analysis import tokenize
+from .backend import SOURCE_FIELDS, VARIANT_FIELDS
+
+import logging
+logger = logging.getLogger('uvicorn')
+
+# Conf
+VECTOR_DIMENSIONS = int(os.environ.get('VECTOR_DIMENSIONS', 65536))
+
+# Items and added entries are allocated in blocks, doubling when full
+INITIAL_CAPACITY = 1024
+ENTRIES_PER_ITEM = 32
+NGRAM_SIZE = 3
+
+# Added entries are merged in the postings when more than 1/MERGE_RATIO of them (and
+# deleted ones dropped when more than half of all the entries), and at least as many as
+MERGE_RATIO = 8
+MERGE_MIN_ENTRIES = 4096
+
+# Items added between yields to the other tasks, when loading
+LOAD_YIELD_ITEMS = 1000
+
+
+def get_ngrams(text):
+    # Character n-grams of the (folded) words, with their boundaries
+    ngrams = []
+    for term in tokenize(text):
+        term = ' {} '.format(term)
+        ngrams += [term[i:i+NGRAM_SIZE] for i in range(max(len(term) - NGRAM_SIZE + 1, 1))]
+    return ngrams
+
+
+def get_features(text, dimensions):
+    # Hashed n-grams (with a stable hash, as Python one changes at every run) and their log TF
+    counts = Counter(zlib.crc32(ngram.encode('utf-8')) % dimensions for ngram in get_ngrams(text))
+    features = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    weights = 1 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+    return features, weights
+
+
+def normalize(weights):
+    norm = np.linalg.norm(weights)
+    return weights / norm if norm else weights
+
+
+class VectorIndex():
+    """Hashed character n-grams vectors of the food descriptions, for top-k cosine similarity
+    searches which match reordered and partial descriptions. The weighting is the classic
+    "lnc.ltc" TF-IDF one: log TF and cosine normalization for the items, and also IDF for the
+    queries, which keeps the item vectors valid as the document frequencies change, so that
+    adds and deletes are incremental. The vectors are sparse, so memory goes with the n-grams
+    of the items and not with the dimensions: most of them are in postings by feature (as in a
+    CSC matrix), where searches only read the features of the query, and the recently added ones
+    are appended one item after the other, until they are merged in. The rows of the deleted
+    items are only masked out, until the next merge drops them and they can be reused. Kept up
+    to date on every add and delete, and on all the indexes. With more workers, the writes
+    through the others are only picked up on reloads: the version of all the indexes it is up
+    to date with tells whether it is fresh."""
+
+    def __init__(self, dimensions=None, capacity=INITIAL_CAPACITY):
+        self.dimensions = VECTOR_DIMENSIONS if dimensions is None else dimensions
+        # Items
+        self.capacity = 0
+        self.size = 0
+        self.rows = {}
+        self.free_rows = []
+        self.deleted_rows = []
+        self.sources = []
+        self.index_ids = {}
+        self.index_names = []
+        self.row_index_ids = np.zeros(0, dtype=np.int32)
+        self.variants = {variant: np.zeros(0, dtype=bool) for variant in VARIANT_FIELDS}
+        # Postings by feature (rows and weights, with the start of the ones of each feature)
+        self.postings = np.zeros(self.dimensions + 1, dtype=np.int64)
+        self.posting_rows = np.zeros(0, dtype=np.int32)
+        self.posting_weights = np.zeros(0, dtype=np.float32)
+        # Recently added entries, by item
+        self.added_capacity = 0
+        self.added_count = 0
+        self.added_features = np.zeros(0, dtype=np.int32)
+        self.added_rows = np.zeros(0, dtype=np.int32)
+        self.added_weights = np.zeros(0, dtype=np.float32)
+        # Entries of the deleted items, still to be dropped
+        self.garbage = 0
+        self.document_frequencies = np.zeros(self.dimensions, dtype=np.int64)
+        self.aliases = {}
+        self.loaded = False
+        self.version = None
+        self.searches = 0
+        self.allocate(capacity)
+        self.allocate_added(capacity * ENTRIES_PER_ITEM)
+
+    def allocate(self, capacity):
+        # Larger arrays for the items, with the current ones copied over
+        grow = capacity - self.capacity
+        self.row_index_ids = np.concatenate([self.row_index_ids, np.full(grow, -1, dtype=np.int32)])
+        for variant in self.variants:
+            self.variants[variant] = np.concatenate([self.variants[variant], np.zeros(grow, dtype=bool)])
+        self.sources += [None] * grow
+        self.capacity = capacity
+
+    def allocate_added(self, capacity):
+        # Larger arrays for the added entries, as above
+        grow = capacity - self.added_capacity
+        self.added_features = np.concatenate([self.added_features, np.zeros(grow, dtype=np.int32)])
+        self.added_rows = np.concatenate([self.added_rows, np.zeros(grow, dtype=np.int32)])
+        self.added_weights = np.concatenate([self.added_weights, np.zeros(grow, dtype=np.float32)])
+        self.added_capacity = capacity
+
+    def get_row(self):
+        if self.free_rows:
+            return self.free_rows.pop()
+        if self.size >= self.capacity:
+            self.allocate(self.capacity * 2)
+        self.size += 1
+        return self.size - 1
+
+    def add(self, index_name, uuid, source):
+        self.delete(index_name, uuid)
+        features, weights = get_features(source["description"], self.dimensions)
+        row = self.get_row()
+        start = self.added_count
+        end = start + len(features)
+        if end > self.added_capacity:
+            self.allocate_added(max(self.added_capacity * 2, end))
+        self.added_features[start:end] = features
+        self.added_rows[start:end] = row
+        self.added_weights[start:end] = normalize(weights)
+        self.added_count = end
+        self.document_frequencies[features] += 1
+        self.rows[(index_name, uuid)] = row
+        self.sources[row] = {field: source[field] for field in SOURCE_FIELDS if field in source}
+        if index_name not in self.index_ids:
+            self.index_ids[index_name] = len(self.index_names)
+            self.index_names.append(index_name)
+        self.row_index_ids[row] = self.index_ids[index_name]
+        for variant, field in VARIANT_FIELDS.items():
+            self.variants[variant][row] = bool(source.get(field, False))
+        if self.added_count > max(MERGE_MIN_ENTRIES, len(self.posting_rows) // MERGE_RATIO):
+            self.merge()
+
+    def delete(self, index_name, uuid):
+        row = self.rows.pop((index_name, uuid), None)
+        if row is None:
+            return
+        features, _ = get_features(self.sources[row]["description"], self.dimensions)
+        self.document_frequencies[features] -= 1
+        self.garbage += len(features)
+        self.sources[row] = None
+        self.row_index_ids[row] = -1
+        self.deleted_rows.append(row)
+        if self.garbage > max(MERGE_MIN_ENTRIES, (len(self.posting_rows) + self.added_count) // 2):
+            self.merge()
+
+    def merge(self):
+        # Postings by feature (and row) again, with the added entries and without the deleted ones
+        features = np.concatenate([np.repeat(np.arange(self.dimensions, dtype=np.int32), np.diff(self.postings)),
+                                   self.added_features[0:self.added_count]])
+        rows = np.concatenate([self.posting_rows, self.added_rows[0:self.added_count]])
+        weights = np.concatenate([self.posting_weights, self.added_weights[0:self.added_count]])
+        kept = np.flatnonzero(self.row_index_ids[rows] >= 0)
+        kept = kept[np.lexsort((rows[kept], features[kept]))]
+        self.postings[1:] = np.cumsum(np.bincount(features[kept], minlength=self.dimensions))
+        self.posting_rows = rows[kept]
+        self.posting_weights = weights[kept]
+        self.added_count = 0
+        self.garbage = 0
+        self.free_rows += self.deleted_rows
+        self.deleted_rows = []
+
+    def delete_index(self, index_name):
+        # Also for all its generations
+        prefix = '{}-gen-'.format(index_name)
+        for key in [key for key in self.rows if key[0] == index_name or key[0].startswith(prefix)]:
+            self.delete(*key)
+
+    def query(self, q, index_name=None, variant=None, min_score=None, size=10):
+        # Elasticsearch-like response, with the cosine similarities as scores
+        start = time.perf_counter()
+        self.searches += 1
+        hits = []
+        features, weights = get_features(q, self.dimensions)
+        if len(features) and self.rows:
+            idf = np.log((len(self.rows) + 1) / (self.document_frequencies[features] + 1)) + 1
+            query_vector = np.zeros(self.dimensions, dtype=np.float32)
+            query_vector[features] = normalize(weights * idf)
+
+            # The dot products with all the items at once, from the postings of the query features
+            # and the added entries with some of them (rows of the deleted items are masked below)
+            starts, lengths = self.postings[features], self.postings[features + 1] - self.postings[features]
+            entries = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            added = np.flatnonzero(query_vector[self.added_features[0:self.added_count]])
+            rows = np.concatenate([self.posting_rows[entries], self.added_rows[added]])
+            products = np.concatenate([self.posting_weights[entries] * np.repeat(query_vector[features], lengths),
+                                       self.added_weights[added] * query_vector[self.added_features[added]]])
+            scores = np.bincount(rows, weights=products, minlength=self.size).astype(np.float32)
+
+            # Only on the live rows of the index (or of what its alias points to) and of the variant
+            if index_name:
+                index_ids = [self.index_ids[name] for name in {index_name, self.aliases.get(index_name, index_name)} if name in self.index_ids]
+                mask = np.isin(self.row_index_ids[0:self.size], index_ids)
+            else:
+                mask = self.row_index_ids[0:self.size] >= 0
+            if variant:
+                mask &= self.variants[variant][0:self.size]
+            rows = np.flatnonzero(mask & (scores >= max(min_score or 0, np.finfo(np.float32).tiny)))
+
+            # Top-k, best first
+            if len(rows) > size:
+                rows = rows[np.argpartition(-scores[rows], size - 1)[0:size]]
+            rows = rows[np.lexsort((rows, -scores[rows]))]
+            for row in rows.tolist():
+                hits.append({"_index": self.index_names[self.row_index_ids[row]],
+                             "_type": "_doc",
+                             "_id": self.sources[row]["uuid"],
+                             "_score": float(scores[row]),
+                             "_source": self.sources[row]})
+        return {"took": int((time.perf_counter() - start) * 1000),
+                "hits": {"max_score": hits[0]["_score"] if hits else None, "hits": hits}}
+
+    def sync(self, previous_version, version):
+        # Writes through this worker keep the vectors up to date, if they already were
+        if self.version is not None and self.version == previous_version:
+            self.version = version
+
+    def fresh(self, version):
+        # Up to date with all the writes up to the given version (of all the indexes)
+        return self.version is not None and self.version == version
+
+    async def load(self, backend, version=None):
+        # (Re)build the vectors from all the items in the backend, and then swap them in, letting
+        # the other tasks run every so often (the scan does not wait on the embedded backend).
+        # The version (of all the indexes) is to be taken before, as for the typo correction.
+        vectors = VectorIndex(self.dimensions)
+        async for index_name, uuid, source in backend.scan_items():
+            vectors.add(index_name, uuid, dict(source, uuid=uuid))
+            if not len(vectors.rows) % LOAD_YIELD_ITEMS:
+                await asyncio.sleep(0)
+        vectors.merge()
+        vectors.aliases = await backend.get_aliases()
+        for name, value in vars(vectors).items():
+            if name != 'searches':
+                setattr(self, name, value)
+        self.loaded = True
+        self.version = version
+        logger.info('VectorIndex: loaded {} items'.format(len(self.rows)))
+
+    def stats(self):
+        return {"loaded": self.loaded,
+                "items": len(self.rows),
+                "capacity": self.capacity,
+                "dimensions": self.dimensions,
+                "entries": len(self.posting_rows) + self.added_count,
+                "added": self.added_count,
+                "garbage": self.garbage,
+                "bytes": sum(array.nbytes for array in [self.postings, self.posting_rows, self.posting_weights, self.added_features,
+                                                        self.added_rows, self.added_weights, self.row_index_ids, self.document_frequencies]),
+                "searches": self.searches}
@@ -0,0 +1,45 @@
+#!/bin/bash
+
+DATE=$(date)
+
+echo ""
+echo "==================================================="
+echo "  Starting Search @ $DATE"
+echo "==================================================="
+echo ""
+
+# To Python3 (unbuffered)
+export PYTHONUNBUFFERED=on
+
+# The code is imported as the "code" package, from the root
+cd /
+
+if [[ "x$SEARCH_DEV_SERVER" == "xtrue" ]] ; then
+
+    # Run the (development) server, single process and reloading on code changes
+    echo "Now starting the development server."
+    exec fastapi dev /code/main.py --port 80 --host 0.0.0.0
+
+else
+
+    # The embedded backend keeps the indexes in process, so it can only be served by one worker
+    if [[ "x$SEARCH_BACKEND" == "xembedded" ]] && [[ "x$SEARCH_WORKERS" != "x1" ]] ; then
+        echo "Using a single worker with the embedded backend."
+        SEARCH_WORKERS=1
+    fi
+
+    # Run Uvicorn, with uvloop and httptools. Each worker process has its own
+    # Elasticsearch client, cache and typo correction dictionary, while the index
+    # versions (invalidating the caches, and telling whether the dictionaries are
+    # up to date) are shared by all of them, in files in CACHE_VERSIONS_PATH, as
+    # are their metrics (each with its worker label), in files in METRICS_PATH.
+    echo "Now starting the Uvicorn server with ${SEARCH_WORKERS:-4} workers."
+    exec uvicorn code.main:app \
+         --host 0.0.0.0 \
+         --port 80 \
+         --workers ${SEARCH_WORKERS:-4} \
+         --loop uvloop \
+         --http httptools \
+         --timeout-keep-alive ${SEARCH_KEEP_ALIVE:-5} \
+         --no-access-log
+fi
@@ -1,7 +1,8 @@
 from django.contrib import admin
 
-from .models import Food, FoodObservation, SearchQuery
+from .models import Food, FoodObservation, SearchQuery, LoadJob
 
 admin.site.register(Food)
 admin.site.register(FoodObservation)
 admin.site.register(SearchQuery)
+admin.site.register(LoadJob)
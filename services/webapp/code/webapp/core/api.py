@@ -4,7 +4,11 @@ import logging
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.permissions import IsAuthenticated
+from django.shortcuts import get_object_or_404
 from .bot import Bot
+from .models import LoadJob
+from .utils import SearchService, get_search_client_stats
 
 # Setup logging
 logger = logging.getLogger(__name__)
@@ -33,6 +37,46 @@ class TelegramClient():
                     }
         requests.post(url,json=payload)
 
+    def answer_inline_query(self, inline_query_id, titles):
+        url = 'https://api.telegram.org/bot{}/answerInlineQuery'.format(self.token)
+        payload = {
+                    'inline_query_id': inline_query_id,
+                    'results': [{'type': 'article',
+                                 'id': str(i),
+                                 'title': title,
+                                 'input_message_content': {'message_text': title}} for i, title in enumerate(titles)]
+                    }
+        requests.post(url,json=payload)
+
+
+def get_suggestions(q):
+    # Food names completing what the user is typing
+    if len(q.strip()) < 2:
+        return []
+    return [suggestion['description'] for suggestion in SearchService().suggest(q)]
+
+
+class SuggestAPI(APIView):
+
+    def get(self, request):
+        return ok200(data=get_suggestions(request.query_params.get('q', '')))
+
+
+class SearchClientAPI(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        # Requests, retries and connection pool usage of this worker process
+        return ok200(data=get_search_client_stats())
+
+
+class LoadJobAPI(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_uuid):
+        # Status, rows processed, throughput and, once done, counts and errors of a catalog load
+        return ok200(data=get_object_or_404(LoadJob, uuid=job_uuid).to_dict())
+
 
 class TelegramAPI(APIView):
 
@@ -68,6 +112,12 @@ class TelegramAPI(APIView):
         #     ]
         #   }
         # }
+        # Inline mode (as the user types "@bot_name ..."): answer with the suggestions
+        if 'inline_query' in request.data:
+            inline_query = request.data['inline_query']
+            telegram_client.answer_inline_query(inline_query['id'], get_suggestions(inline_query.get('query', '')))
+            return ok200()
+
         try:
             telegram_chat_id = request.data['message']['chat']['id']
         except:
@@ -47,10 +47,11 @@ class Bot():
         if not foods:
 
             # Query foods on the correct DB (based on variant)
-            foods = Food.query(parsed['food'], variant=variant, debug=debug)
+            searches = [(parsed['food'], variant)]
+            parsed_variants = [parsed]
 
-            # If nothing found and asked for pieces, try servings instead
-            if not foods and variant == 'pieces':
+            # If asked for pieces, try servings as well
+            if variant == 'pieces':
 
                 # Remove the "un", "una", etc and re-parse
                 if message.startswith('un '):
@@ -65,11 +66,18 @@ class Bot():
                 if message_variant != message:
                     message_variant = message_variant.strip()
                     parsed = message_parser(message_variant)
-                    foods = Food.query(parsed['food'], variant='servings', debug=debug)
-
-            # If still no foods found, use no variant at all
-            if not foods:
-                foods = Food.query(parsed['food'], variant=None, debug=debug)
+                    searches.append((parsed['food'], 'servings'))
+                    parsed_variants.append(parsed)
+
+            # ...and lastly use no variant at all
+            if variant is not None:
+                searches.append((parsed['food'], None))
+                parsed_variants.append(parsed)
+
+            # Get all the candidates in one go, and keep the first variant with results
+            position, foods = Food.query_first(searches, debug=debug)
+            if position is not None:
+                parsed = parsed_variants[position]
 
         if not foods:
             return 'Non ho trovato nessun alimento per "{}". Puoi provare ad essere più generale?'.format(message)
@@ -0,0 +1,123 @@
+import os
+import time
+import uuid
+import logging
+import tempfile
+from django.db import close_old_connections
+from django.core.files.move import file_move_safe
+from django.db.models import Max
+from django.utils import timezone
+from .models import Food, LoadJob
+from .utils import SearchService, load_foods_from_csv, reload_foods_from_csv, format_exception
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Seconds between the updates of the rows processed by a running job
+PROGRESS_INTERVAL = 1
+
+# Where the uploaded files wait for their jobs
+JOB_FILES_PATH = tempfile.gettempdir()
+
+
+def save_job_file(uploaded_file):
+    """Save an uploaded file for a load job, as it is (compressed or not), and return its path.
+    Uploads already spooled to disk by Django are moved in place rather than copied again."""
+    file_path = os.path.join(JOB_FILES_PATH, 'load_job_{}'.format(uuid.uuid4()))
+    if hasattr(uploaded_file, 'temporary_file_path'):
+        file_move_safe(uploaded_file.temporary_file_path(), file_path)
+    else:
+        with open(file_path, 'wb') as destination:
+            for chunk in uploaded_file.chunks():
+                destination.write(chunk)
+    return file_path
+
+
+def remove_job_file(job):
+    if job.file_path and os.path.exists(job.file_path):
+        os.remove(job.file_path)
+
+
+def load_catalog(csv_file_path, created_by_user, full_reload=False, search_service=None, progress=None):
+    """Load a catalog CSV file, applying only what changed or, with full_reload, loading it anew
+    and in a new generation of the search index. Returns the counts of the inserted, updated,
+    deleted and unchanged foods, and the errors by line."""
+    if not search_service:
+        search_service = SearchService()
+
+    if not full_reload:
+        return reload_foods_from_csv(csv_file_path, created_by_user, search_service=search_service, progress=progress)
+
+    # Load the new foods next to the current ones, and in a new generation of the search
+    # index, so that the current catalog is still served until the new one is swapped in.
+    last_food_id = Food.objects.aggregate(Max('id'))['id__max'] or 0
+    try:
+        with search_service.reindex():
+            loaded_count, errors = load_foods_from_csv(csv_file_path, created_by_user, search_service=search_service, progress=progress)
+    except:
+        Food.objects.filter(id__gt=last_food_id).delete(search_service=search_service)
+        raise
+
+    # Now remove the old foods (not in the new generation of the search index, so skipped there)
+    _, deleted_counts = Food.objects.filter(id__lte=last_food_id).delete(search_service=search_service)
+    return {'inserted': loaded_count, 'updated': 0, 'deleted': deleted_counts.get('core.Food', 0), 'unchanged': 0}, errors
+
+
+def run_job(job, search_service=None):
+    """Run a queued load job, keeping its rows processed up to date in the database, and then
+    setting its counts and errors (or its failure). Its file is removed once done. Returns
+    False if the job was not queued anymore (as already taken by someone else)."""
+
+    # Claim the job, so that it runs only once
+    if not LoadJob.objects.filter(id=job.id, status='queued').update(status='running', started_at=timezone.now()):
+        return False
+    job.refresh_from_db()
+    logger.info('Running load job "%s" on "%s"', job.uuid, job.file_name)
+
+    last_update = time.monotonic()
+
+    def progress(rows):
+        nonlocal last_update
+        job.rows = rows
+        if time.monotonic() - last_update >= PROGRESS_INTERVAL:
+            LoadJob.objects.filter(id=job.id).update(rows=rows)
+            last_update = time.monotonic()
+
+    try:
+        job.counts, job.errors = load_catalog(job.file_path, job.created_by, full_reload=job.full_reload,
+                                              search_service=search_service, progress=progress)
+        job.status = 'done'
+    except Exception as e:
+        logger.error(format_exception(e))
+        job.status = 'failed'
+        job.failure = str(e)
+    finally:
+        job.finished_at = timezone.now()
+        job.save()
+        remove_job_file(job)
+    logger.info('Load job "%s" %s after %.1f s (%s rows)', job.uuid, job.status, job.elapsed, job.rows)
+    return True
+
+
+def run_jobs(interval=1, once=False):
+    """Run the queued load jobs, oldest first, waiting interval seconds for new ones
+    when there are none (or returning, with once)."""
+
+    # Jobs left running by a worker which went away cannot be resumed (nor their files used)
+    interrupted = list(LoadJob.objects.filter(status='running'))
+    for job in interrupted:
+        remove_job_file(job)
+    LoadJob.objects.filter(id__in=[job.id for job in interrupted]).update(status='failed', finished_at=timezone.now(),
+                                                                          failure='Interrupted (the worker stopped)')
+    if interrupted:
+        logger.warning('Marked %s interrupted load jobs as failed', len(interrupted))
+
+    while True:
+        close_old_connections()
+        job = LoadJob.objects.filter(status='queued').order_by('id').first()
+        if job:
+            run_job(job)
+        elif once:
+            return
+        else:
+            time.sleep(interval)
@@ -0,0 +1,74 @@
+import os
+import csv
+import time
+import random
+import tempfile
+from django.db.models import Max
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from ...models import Food
+from ...utils import SearchService, load_foods_from_csv
+
+HEADER = ['Ignora', 'Nome descrittivo', 'Ingredienti principali', 'Tipo',
+          'Porzione\npiccola\n(g o ml)', 'Porzione\nmedia\n(g o ml)', 'Porzione\ngrande\n(g o ml)',
+          'Pezzo\npiccolo\n(g o ml)', 'Pezzo\nmedio\n(g o ml)', 'Pezzo\ngrande\n(g o ml)',
+          'CHO per 100g o 100ml', 'Grassi per 100g o 100ml', 'Proteine per 100g o 100ml', 'Fibre per 100g o 100ml',
+          'Utente', 'Note']
+
+FOODS = [('Pasta al pomodoro', 'pasta, pomodoro'), ('Insalata di riso', 'riso, verdure'), ('Pizza margherita', 'farina, mozzarella'),
+         ('Arancini di riso', 'riso, carne'), ('Biscotti secchi', 'farina, zucchero'), ('Succo di frutta', 'frutta')]
+QUALIFIERS = ['fatto in casa', 'light', 'integrale', 'al forno', 'della nonna', 'biologico', '(v.m.)']
+
+
+def write_synthetic_csv(path, rows, username, rng):
+    # Foods with servings or pieces, some varying a lot, some liquid and some with errors
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        for i in range(rows):
+            name, ingredients = FOODS[i % len(FOODS)]
+            liquid = name.startswith('Succo')
+            servings = ['', str(rng.randint(100, 300)), ''] if i % 3 else ['', '', '']
+            pieces = ['', '', ''] if i % 3 else [str(rng.randint(10, 50)), '', '']
+            writer.writerow(['x' if i % 50 == 0 else '',
+                             '{} {} {}'.format(name, i, QUALIFIERS[i % len(QUALIFIERS)]),
+                             '' if i % 100 == 1 else ingredients,
+                             'bevanda' if liquid else 'cibo']
+                            + servings + pieces
+                            + ['{:.1f}'.format(rng.uniform(0, 80)), '', '{:.1f}'.format(rng.uniform(0, 20)), '',
+                               '' if i % 100 == 2 else username, ''])
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks loading a synthetic foods CSV file (on a dedicated search index), then removes what was loaded.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=50000)
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Foods saved together, in a transaction')
+        parser.add_argument('--index-prefix', default='bench_')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--keep', action='store_true', help='Keep the loaded foods and the benchmark index')
+
+    def handle(self, *args, **options):
+
+        user, _ = User.objects.get_or_create(username='benchuser')
+        search_service = SearchService(index_prefix=options['index_prefix'])
+        search_service.manage('reset')
+
+        csv_file = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        csv_file.close()
+        last_food_id = Food.objects.aggregate(Max('id'))['id__max'] or 0
+        try:
+            write_synthetic_csv(csv_file.name, options['rows'], user.username, random.Random(options['seed']))
+            start = time.perf_counter()
+            loaded_count, errors = load_foods_from_csv(csv_file.name, user, search_service=search_service,
+                                                       chunk_size=options['chunk_size'])
+            elapsed = time.perf_counter() - start
+        finally:
+            os.remove(csv_file.name)
+            if not options['keep']:
+                Food.objects.filter(id__gt=last_food_id, created_by=user).delete(search_service=search_service)
+                search_service.manage('delete')
+
+        self.stdout.write('Rows: {}, loaded: {}, errors: {}, chunk size: {}'.format(options['rows'], loaded_count, len(errors), options['chunk_size']))
+        self.stdout.write('Loaded in {:.2f} s, {:.1f} rows/s'.format(elapsed, options['rows'] / elapsed))
@@ -0,0 +1,34 @@
+import sys
+from django.core.management.base import BaseCommand
+from ...models import SearchQuery
+
+class Command(BaseCommand):
+    help = 'Exports the search queries, one per line and oldest first (for the search service load benchmark).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=None, help='Output file (standard output by default)')
+        parser.add_argument('--successful', action='store_true', help='Only the queries which found something')
+        parser.add_argument('--limit', type=int, default=None, help='Only the most recent queries, up to this many')
+
+    def handle(self, *args, **options):
+
+        search_queries = SearchQuery.objects.all()
+        if options['successful']:
+            search_queries = search_queries.filter(success=True)
+        if options['limit']:
+            search_queries = search_queries.order_by('-performed_at')[0:options['limit']]
+        contents = list(search_queries.values_list('performed_at', 'content'))
+        contents.sort()
+
+        output = open(options['output'], 'w') if options['output'] else sys.stdout
+        try:
+            exported = 0
+            for _, content in contents:
+                content = ' '.join(content.split())
+                if content:
+                    output.write(content + '\n')
+                    exported += 1
+        finally:
+            if options['output']:
+                output.close()
+        self.stderr.write('Exported {} search queries'.format(exported))
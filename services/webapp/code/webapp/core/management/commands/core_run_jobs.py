@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from ...jobs import run_jobs
+
+class Command(BaseCommand):
+    help = 'Runs the queued load jobs (the catalog uploads), waiting for new ones unless --once.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=1, help='Seconds between checks for new jobs')
+        parser.add_argument('--once', action='store_true', help='Exit once there are no more queued jobs')
+
+    def handle(self, *args, **options):
+        run_jobs(interval=options['interval'], once=options['once'])
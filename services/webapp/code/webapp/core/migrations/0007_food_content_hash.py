@@ -0,0 +1,18 @@
+# Generated by Django 5.0.3 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_searchquery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='food',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=64, null=True, verbose_name='Content hash'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:02
+
+import django.db.models.deletion
+import webapp.core.fileds
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_food_content_hash'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoadJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uuid', models.CharField(blank=True, max_length=36, null=True, verbose_name='UUID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Started at')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Finished at')),
+                ('status', models.CharField(default='queued', max_length=16, verbose_name='Status')),
+                ('file_path', models.CharField(max_length=255, verbose_name='File path')),
+                ('file_name', models.CharField(blank=True, max_length=255, null=True, verbose_name='File name')),
+                ('full_reload', models.BooleanField(default=False, verbose_name='Full reload')),
+                ('rows', models.IntegerField(default=0, verbose_name='Rows processed')),
+                ('counts', webapp.core.fileds.JSONField(blank=True, null=True, verbose_name='Counts')),
+                ('errors', webapp.core.fileds.JSONField(blank=True, null=True, verbose_name='Errors')),
+                ('failure', models.TextField(blank=True, null=True, verbose_name='Failure')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='load_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:13
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_loadjob'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='loadjob',
+            constraint=models.UniqueConstraint(models.Value(True), condition=models.Q(('status__in', ['queued', 'running'])), name='single_active_load_job'),
+        ),
+    ]
@@ -2,6 +2,7 @@ import uuid
 import logging
 from django.db import models
 from django.db.models import SET_NULL
+from django.utils import timezone
 from django.contrib.auth.models import User
 from .fileds import JSONField
 from .utils import SearchService
@@ -13,6 +14,16 @@ logger = logging.getLogger(__name__)
 #  Integration
 #=========================
 
+class FoodQuerySet(models.QuerySet):
+
+    def delete(self, search_service=None):
+        # Also from the search index, all at once (Food.delete is not called for querysets)
+        if not search_service:
+            search_service = SearchService()
+        search_service.delete_many([food_uuid for food_uuid in self.values_list('uuid', flat=True) if food_uuid])
+        return super(FoodQuerySet, self).delete()
+
+
 class Food(models.Model):
     uuid = models.CharField('UUID', max_length=36, blank=True, null=True)
     created_by = models.ForeignKey(User, related_name='foods', null=True, blank=True, on_delete=SET_NULL)
@@ -25,6 +36,9 @@ class Food(models.Model):
     medium_piece = models.IntegerField('Medium piece', blank=True, null=True)
     large_piece = models.IntegerField('Large piece', blank=True, null=True)
     liquid = models.BooleanField('Food is a liquid', default=False)
+    content_hash = models.CharField('Content hash', max_length=64, blank=True, null=True)
+
+    objects = FoodQuerySet.as_manager()
 
     def __str__(self):
         return str('Food "{}"'.format(self.name))
@@ -37,33 +51,26 @@ class Food(models.Model):
             if not search_service:
                 search_service = SearchService()
 
-            item = {"uuid": self.uuid ,
-                    "description": self.name,
-                    "ingredients": self.main_ingredients}
-
-            search_service.add(item, variant=None)
-
-            if self.small_serving or self.medium_serving or self.large_serving:
-                search_service.add(item, variant='servings')
-
-            if self.small_piece or self.medium_piece or self.large_piece:
-                search_service.add(item, variant='pieces')
+            search_service.add(self.get_search_item())
 
         else:
             raise Exception('Cannot edit food yet. Delete and re-create if you need to.')
 
         super(Food, self).save(*args, **kwargs)
 
+    def get_search_item(self):
+        return {"uuid": self.uuid,
+                "description": self.name,
+                "ingredients": self.main_ingredients,
+                "has_servings": bool(self.small_serving or self.medium_serving or self.large_serving),
+                "has_pieces": bool(self.small_piece or self.medium_piece or self.large_piece)}
+
     def delete(self, *args, search_service=None, **kwargs):
         if not search_service:
             search_service = SearchService()
         item = {'uuid':self.uuid, 'description': self.name, 'ingredients': self.main_ingredients}
         search_service.delete(item)
 
-        # Remove variants as well (if none present no harm is done)
-        search_service.delete(item, variant='servings')
-        search_service.delete(item, variant='pieces')
-
         super(Food, self).delete(*args, **kwargs)
 
     @property
@@ -74,15 +81,30 @@ class Food(models.Model):
     def query(cls, q, variant=None, search_service=None, debug=False, min_score=0.1, max_diff=0.3):
         if not search_service:
             search_service = SearchService()
+        return cls.from_entries(search_service.query(q, variant, min_score, max_diff, see_also=True))
+
+    @classmethod
+    def query_first(cls, searches, search_service=None, debug=False, min_score=0.1, max_diff=0.3):
+        # Run all the (q, variant) searches at once, and return the position of the
+        # first one with results together with its foods (or None and no foods).
+        if not search_service:
+            search_service = SearchService()
+        for i, entries in enumerate(search_service.multi_query(searches, min_score, max_diff, see_also=True)):
+            if entries:
+                food_objects = cls.from_entries(entries)
+                if food_objects:
+                    return i, food_objects
+        return None, []
+
+    @classmethod
+    def from_entries(cls, entries):
         food_objects = []
-        for entry in search_service.query(q, variant, min_score, max_diff, see_also=True):
+        for entry in entries:
             try:
                 food_object = Food.objects.get(uuid=entry['_id'])
                 food_object.from_entry = entry
-                if 'see_also' in entry:
-                    food_object.see_also = True
-                else:
-                    food_object.see_also = False
+                # Set to true or false (compact results), or only there if true (full ones)
+                food_object.see_also = bool(entry.get('see_also', False))
                 food_objects.append(food_object)
             except Exception as e:
                 logger.error('{} @ {}'.format(e,entry))
@@ -142,3 +164,66 @@ class SearchQuery(models.Model):
 
     def __str__(self):
         return str('Search query @ {} for "{}" (success={})'.format(str(self.performed_at).split('.')[0], self.content[0:20], self.success))
+
+
+class LoadJob(models.Model):
+    uuid = models.CharField('UUID', max_length=36, blank=True, null=True)
+    created_by = models.ForeignKey(User, related_name='load_jobs', null=True, blank=True, on_delete=SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField('Started at', blank=True, null=True)
+    finished_at = models.DateTimeField('Finished at', blank=True, null=True)
+    # Queued, running, done or failed
+    status = models.CharField('Status', max_length=16, default='queued')
+    file_path = models.CharField('File path', max_length=255)
+    file_name = models.CharField('File name', max_length=255, blank=True, null=True)
+    full_reload = models.BooleanField('Full reload', default=False)
+    rows = models.IntegerField('Rows processed', default=0)
+    counts = JSONField('Counts', blank=True, null=True)
+    errors = JSONField('Errors', blank=True, null=True)
+    failure = models.TextField('Failure', blank=True, null=True)
+
+    class Meta:
+        # One catalog load at a time: at most one job queued or running, enforced by the database
+        constraints = [models.UniqueConstraint(models.Value(True), condition=models.Q(status__in=['queued', 'running']),
+                                               name='single_active_load_job')]
+
+    def __str__(self):
+        return str('Load job @ {} for "{}" ({})'.format(str(self.created_at).split('.')[0], self.file_name, self.status))
+
+    def save(self, *args, **kwargs):
+        if not self.uuid:
+            self.uuid = str(uuid.uuid4())
+        super(LoadJob, self).save(*args, **kwargs)
+
+    @property
+    def finished(self):
+        return self.status in ['done', 'failed']
+
+    @property
+    def elapsed(self):
+        # In seconds, so far if still running
+        if not self.started_at:
+            return None
+        return ((self.finished_at or timezone.now()) - self.started_at).total_seconds()
+
+    @property
+    def throughput(self):
+        # Rows per second
+        if not self.elapsed:
+            return None
+        return round(self.rows / self.elapsed, 1)
+
+    def to_dict(self):
+        return {'uuid': self.uuid,
+                'status': self.status,
+                'file_name': self.file_name,
+                'full_reload': self.full_reload,
+                'created_at': self.created_at.isoformat() if self.created_at else None,
+                'started_at': self.started_at.isoformat() if self.started_at else None,
+                'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+                'rows': self.rows,
+                'elapsed': round(self.elapsed, 3) if self.elapsed is not None else None,
+                'throughput': self.throughput,
+                'counts': self.counts,
+                'errors': self.errors,
+                'failure': self.failure}
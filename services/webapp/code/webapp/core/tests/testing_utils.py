@@ -1,4 +1,3 @@
-import time
 import requests
 from django.contrib.auth.models import User
 
@@ -11,7 +10,7 @@ def get_or_create_user(username='testuser', password='testpass'):
 
 def reset_test_indexes():
     # Reset test search indexes
-    for index_name in ['test_food', 'test_food_servings', 'test_food_pieces']:
+    for index_name in ['test_food']:
         url = 'http://search/api/v1/manage/'
         payload = {
             'command': 'reset',
@@ -26,7 +25,7 @@ def reset_test_indexes():
 
 def delete_test_indexes():
     # Delete test search indexes
-    for index_name in ['test_food', 'test_food_servings', 'test_food_pieces']:
+    for index_name in ['test_food']:
         url = 'http://search/api/v1/manage/'
         payload = {
             'command': 'delete',
@@ -38,11 +37,10 @@ def delete_test_indexes():
 def add_to_test_index(data):
     if not isinstance(data, list):
         data = [data]
-    for item in data:
-        # Add to the test search index
+    for i, item in enumerate(data):
+        # Add to the test search index, waiting for the last one to be searchable (with all the others)
         url = 'http://search/api/v1/add/'
         item['index_name'] = 'test_food'
-        response = requests.post(url, json=item)
-    time.sleep(1) # TODO: meh...
+        response = requests.post(url, json=item, params={'refresh': 'wait_for'} if i == len(data) - 1 else {})
     return response
 
@@ -1,5 +1,4 @@
 import os
-import time
 from unittest.mock import patch
 from django.test import TestCase
 from ..utils import SearchService, load_foods_from_csv
@@ -13,12 +12,15 @@ class TestBot(TestCase):
     @classmethod
     def setUpClass(cls):
         reset_test_indexes()
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        # In the class transaction, so that the foods do not leak into the other tests
         test_user = get_or_create_user('testuser')
         csv_path = os.path.join(os.path.dirname(__file__), 'test_data.csv')
-        search_service = SearchService(index_prefix='test_')
+        search_service = SearchService(index_prefix='test_', refresh='wait_for')
         load_foods_from_csv(csv_path, test_user, search_service=search_service)
-        time.sleep(1)
-        super().setUpClass()
 
     @classmethod
     def tearDownClass(cls):
@@ -61,3 +63,12 @@ class TestBot(TestCase):
             reply = bot.answer('pane integrale fresco')
             self.assertIn('Ho trovato "*pane integrale fresco/*"', reply)
 
+
+    def test_bot_answer_search_variants_fallback(self):
+        bot = Bot()
+        test_search_service = SearchService(index_prefix='test_')
+        with patch('webapp.core.models.SearchService', return_value=test_search_service):
+            # No pasta by the piece: falls back on the no-variant index
+            reply = bot.answer('due pasta integrale condita')
+            self.assertIn('pasta integrale', reply.lower())
+            self.assertIn('carboidrati', reply)
@@ -0,0 +1,139 @@
+import os
+import gzip
+import shutil
+import tempfile
+from unittest.mock import patch
+from django.test import TestCase
+from django.db import transaction, IntegrityError
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from ..models import Food, LoadJob
+from ..utils import SearchService
+from ..jobs import run_job, run_jobs, save_job_file, JOB_FILES_PATH
+from .testing_utils import get_or_create_user, reset_test_indexes, delete_test_indexes
+
+# Note: these are end-to-end tests, using two other services in chain (search and elastic)
+
+class TestJobs(TestCase):
+
+    def setUp(self):
+        reset_test_indexes()
+        self.test_user = get_or_create_user(username='testuser')
+        self.search_service = SearchService(index_prefix='test_', refresh='wait_for')
+        super().setUp()
+
+    def tearDown(self):
+        delete_test_indexes()
+
+    def get_job(self, file_name='test_data.csv', **kwargs):
+        # On a copy of the file, as it is removed once the job is done
+        file_path = tempfile.NamedTemporaryFile(delete=False).name
+        shutil.copy(os.path.join(os.path.dirname(__file__), file_name), file_path)
+        return LoadJob.objects.create(created_by=self.test_user, file_path=file_path, file_name=file_name, **kwargs)
+
+    def test_run_job(self):
+
+        # Jobs reload the whole catalog, so their counts hold only from an empty one
+        self.assertFalse(Food.objects.exists())
+        job = self.get_job()
+        self.assertEqual(job.status, 'queued')
+        self.assertTrue(run_job(job, search_service=self.search_service))
+
+        # Only once
+        self.assertFalse(run_job(job, search_service=self.search_service))
+
+        job = LoadJob.objects.get(uuid=job.uuid)
+        self.assertEqual(job.status, 'done')
+        self.assertTrue(job.finished)
+        self.assertEqual(job.rows, 84)
+        self.assertEqual(job.counts, {'inserted': 74, 'updated': 0, 'deleted': 0, 'unchanged': 0})
+        self.assertEqual(job.errors, {'2': 'Nessun ingrediente principale per "CEREALI"?'})
+        self.assertGreater(job.throughput, 0)
+        self.assertFalse(os.path.exists(job.file_path))
+        self.assertEqual(Food.objects.count(), 74)
+        self.assertEqual(len(self.search_service.query('cornflakes')), 1)
+
+        # Full reload
+        job = self.get_job(full_reload=True)
+        run_job(job, search_service=self.search_service)
+        job = LoadJob.objects.get(uuid=job.uuid)
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.counts, {'inserted': 74, 'updated': 0, 'deleted': 74, 'unchanged': 0})
+        self.assertEqual(Food.objects.count(), 74)
+
+    def test_save_job_file(self):
+
+        with open(os.path.join(os.path.dirname(__file__), 'test_data.csv'), 'rb') as f:
+            content = f.read()
+
+        # In memory uploads are written out
+        file_path = save_job_file(SimpleUploadedFile('test_data.csv', content))
+        with open(file_path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        os.remove(file_path)
+
+        # Uploads on disk are moved, not copied
+        uploaded_file = TemporaryUploadedFile('test_data.csv.gz', 'application/gzip', 0, None)
+        uploaded_file.write(gzip.compress(content))
+        uploaded_file.flush()
+        temporary_file_path = uploaded_file.temporary_file_path()
+        file_path = save_job_file(uploaded_file)
+        uploaded_file.close()
+        self.assertFalse(os.path.exists(temporary_file_path))
+
+        # And compressed files are loaded as they are (from an empty catalog, as above)
+        self.assertFalse(Food.objects.exists())
+        job = LoadJob.objects.create(created_by=self.test_user, file_path=file_path, file_name='test_data.csv.gz')
+        run_job(job, search_service=self.search_service)
+        job = LoadJob.objects.get(uuid=job.uuid)
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.counts, {'inserted': 74, 'updated': 0, 'deleted': 0, 'unchanged': 0})
+        self.assertFalse(os.path.exists(file_path))
+
+    def test_single_active_job(self):
+
+        # At most one job queued or running, also if created concurrently (past the view check)
+        job = LoadJob.objects.create(created_by=self.test_user, file_path='/tmp/missing.csv')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            LoadJob.objects.create(created_by=self.test_user, file_path='/tmp/missing.csv')
+        LoadJob.objects.filter(id=job.id).update(status='running')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            LoadJob.objects.create(created_by=self.test_user, file_path='/tmp/missing.csv')
+
+        # But any number of finished ones
+        LoadJob.objects.filter(id=job.id).update(status='done')
+        LoadJob.objects.create(created_by=self.test_user, file_path='/tmp/missing.csv', status='failed')
+        LoadJob.objects.create(created_by=self.test_user, file_path='/tmp/missing.csv')
+        self.assertEqual(LoadJob.objects.count(), 3)
+
+    def test_food_load_view(self):
+
+        self.client.force_login(self.test_user)
+        response = self.client.post('/food_load/', {'fileinput': SimpleUploadedFile('test_data.csv', b'Nome descrittivo\n')})
+        self.assertEqual(response.status_code, 302)
+        job = LoadJob.objects.get()
+        self.assertEqual(job.status, 'queued')
+        job_files = [name for name in os.listdir(JOB_FILES_PATH) if name.startswith('load_job_')]
+
+        # Concurrent uploads getting past the check are refused as well, and their files removed
+        with patch.object(LoadJob.objects, 'filter') as filter:
+            filter.return_value.exists.return_value = False
+            response = self.client.post('/food_load/', {'fileinput': SimpleUploadedFile('test_data.csv', b'Nome descrittivo\n')})
+        self.assertContains(response, 'Another catalog load is already in progress')
+        self.assertEqual(LoadJob.objects.count(), 1)
+        self.assertEqual([name for name in os.listdir(JOB_FILES_PATH) if name.startswith('load_job_')], job_files)
+        os.remove(job.file_path)
+
+    def test_run_job_failed(self):
+
+        job = LoadJob.objects.create(created_by=self.test_user, file_path='/tmp/missing.csv', file_name='missing.csv')
+        run_job(job, search_service=self.search_service)
+        job = LoadJob.objects.get(uuid=job.uuid)
+        self.assertEqual(job.status, 'failed')
+        self.assertIn('No such file', job.failure)
+        self.assertEqual(job.to_dict()['status'], 'failed')
+
+        # Jobs left running are not resumed, and their files are removed
+        job = self.get_job(status='running')
+        run_jobs(once=True)
+        self.assertEqual(LoadJob.objects.get(uuid=job.uuid).status, 'failed')
+        self.assertFalse(os.path.exists(job.file_path))
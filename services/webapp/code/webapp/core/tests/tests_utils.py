@@ -1,8 +1,13 @@
-import time
+import os
+import gzip
+import shutil
+import zipfile
+import tempfile
 import requests
+from unittest.mock import patch
 from django.test import TestCase
-from ..models import Food
-from ..utils import SearchService, message_parser
+from ..models import Food, FoodObservation
+from ..utils import SearchService, message_parser, get_search_session, get_search_client_stats, load_foods_from_csv, reload_foods_from_csv, read_foods_from_csv
 from .testing_utils import get_or_create_user, reset_test_indexes, delete_test_indexes, add_to_test_index
 
 # Note: these are end-to-end tests, using two other services in chain (search and elastic)
@@ -93,7 +98,7 @@ class TestSearchService(TestCase):
         self.assertTrue('00000000-0000-0000-0000-000000000004' in uuids)
         self.assertEqual(response_json[0]['_relative_score'], 1)
         self.assertEqual(response_json[1]['_relative_score'], 1)
-        self.assertAlmostEqual(response_json[2]['_relative_score'], 0.9200, places=3)
+        self.assertAlmostEqual(response_json[2]['_relative_score'], 0.8800, places=3)
 
         # Add somehting different now but with same main ingredient
         item5 = { "uuid": "00000000-0000-0000-0000-000000000038", "description": "Arancini di riso", "ingredients": ["riso", "carne", "piselli"] }
@@ -111,7 +116,7 @@ class TestSearchService(TestCase):
         self.assertTrue('00000000-0000-0000-0000-000000000004' in uuids)
         self.assertEqual(response_json[0]['_relative_score'], 1)
         self.assertEqual(response_json[1]['_relative_score'], 1)
-        self.assertAlmostEqual(response_json[2]['_relative_score'], 0.9171, places=3)
+        self.assertAlmostEqual(response_json[2]['_relative_score'], 0.8757, places=3)
 
         # Search for "arancina" (sorry, Catania)
         url = 'http://search/api/v1/search?q=arancina&index_name=test_food&min_score=0&max_diff=0.2'
@@ -129,25 +134,25 @@ class TestSearchService(TestCase):
         self.assertEqual(response_json[0]['_id'],'00000000-0000-0000-0000-000000000038')
         self.assertAlmostEqual(response_json[0]['_score'], 0.32575765, places=3)
         self.assertEqual(response_json[1]['_id'],'00000000-0000-0000-0000-000000000002')
-        self.assertAlmostEqual(response_json[1]['_score'], 0.26688576, places=3)
+        self.assertAlmostEqual(response_json[1]['_score'], 0.27951443, places=3)
         self.assertEqual(response_json[2]['_id'],'00000000-0000-0000-0000-000000000003')
-        self.assertAlmostEqual(response_json[2]['_score'], 0.26688576, places=3)
+        self.assertAlmostEqual(response_json[2]['_score'], 0.27951443, places=3)
         self.assertEqual(response_json[3]['_id'],'00000000-0000-0000-0000-000000000004')
         self.assertAlmostEqual(response_json[3]['_score'], 0.24476814, places=3)
 
-        # ..and for "eiso" (a typo), which lowers the score
+        # ..and for "fiso" (a typo), corrected to "riso" before searching: same results and scores
         url = 'http://search/api/v1/search?q=fiso&index_name=test_food&min_score=0&max_diff=1'
         response = requests.get(url)
         self.assertEqual(response.status_code,200)
         response_json = response.json()
         self.assertEqual(response_json[0]['_id'],'00000000-0000-0000-0000-000000000038')
-        self.assertAlmostEqual(response_json[0]['_score'], 0.24431825, places=3)
+        self.assertAlmostEqual(response_json[0]['_score'], 0.32575765, places=3)
         self.assertEqual(response_json[1]['_id'],'00000000-0000-0000-0000-000000000002')
-        self.assertAlmostEqual(response_json[1]['_score'], 0.20016432, places=3)
+        self.assertAlmostEqual(response_json[1]['_score'], 0.27951443, places=3)
         self.assertEqual(response_json[2]['_id'],'00000000-0000-0000-0000-000000000003')
-        self.assertAlmostEqual(response_json[2]['_score'], 0.20016432, places=3)
+        self.assertAlmostEqual(response_json[2]['_score'], 0.27951443, places=3)
         self.assertEqual(response_json[3]['_id'],'00000000-0000-0000-0000-000000000004')
-        self.assertAlmostEqual(response_json[3]['_score'], 0.18357614, places=3)
+        self.assertAlmostEqual(response_json[3]['_score'], 0.24476814, places=3)
 
         # Lastly, search for nonsense: no results at all
         url = 'http://search/api/v1/search?q=girasole&index_name=test_food&min_score=0&max_diff=1'
@@ -156,9 +161,198 @@ class TestSearchService(TestCase):
         self.assertEqual(len(response.json()),0)
 
 
+    def test_search_service_api_cache(self):
+
+        item = { "uuid": "00000000-0000-0000-0000-000000000001", "description": "Insalata caprese", "ingredients": ["mozzarella", "pomodoro", "basilico"] }
+        add_to_test_index(item)
+
+        # Same search twice (modulo case and spaces): the second one is served from the cache (the
+        # add waited for the refresh, so there is no settle time whatever the writes before it).
+        # All on the same (kept alive) connection, so on the same worker, as each has its own cache.
+        session = requests.Session()
+        self.addCleanup(session.close)
+        stats = session.get('http://search/api/v1/cache/').json()
+        response = session.get('http://search/api/v1/search?q=caprese&index_name=test_food&min_score=0&max_diff=1')
+        self.assertEqual(len(response.json()), 1)
+        cached_response = session.get('http://search/api/v1/search?q=%20Caprese&index_name=test_food&min_score=0&max_diff=1')
+        self.assertEqual(cached_response.json(), response.json())
+        new_stats = session.get('http://search/api/v1/cache/').json()
+        self.assertEqual(new_stats['misses'], stats['misses'] + 1)
+        self.assertEqual(new_stats['hits'], stats['hits'] + 1)
+
+        # Adding to the index invalidates the cached results
+        item2 = { "uuid": "00000000-0000-0000-0000-000000000002", "description": "Insalata caprese con basilico", "ingredients": ["mozzarella", "pomodoro", "basilico"] }
+        add_to_test_index(item2)
+        response = session.get('http://search/api/v1/search?q=caprese&index_name=test_food&min_score=0&max_diff=1')
+        self.assertEqual(len(response.json()), 2)
+
+
+    def test_search_service_api_compact(self):
+
+        item = { "uuid": "00000000-0000-0000-0000-000000000001", "description": "Insalata caprese", "ingredients": ["mozzarella", "pomodoro", "basilico"] }
+        item2 = { "uuid": "00000000-0000-0000-0000-000000000002", "description": "Insalata caprese con basilico", "ingredients": ["pomodoro", "mozzarella", "basilico"] }
+        add_to_test_index([item, item2])
+
+        # Only ids, scores and see also flags
+        url = 'http://search/api/v1/search?q=caprese&index_name=test_food&min_score=0&max_diff=1&see_also=true&format=compact'
+        response = requests.get(url)
+        self.assertEqual(response.status_code,200)
+        hits = response.json()
+        self.assertEqual(hits, [{'_id': '00000000-0000-0000-0000-000000000001', '_score': hits[0]['_score'], '_relative_score': 1.0, 'see_also': False},
+                                {'_id': '00000000-0000-0000-0000-000000000002', '_score': hits[1]['_score'], '_relative_score': None, 'see_also': True}])
+
+        # Also for multiple searches
+        payload = {'searches': [{'q': 'caprese', 'index_name': 'test_food', 'min_score': 0}], 'format': 'compact'}
+        response = requests.post('http://search/api/v1/msearch/', json=payload)
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(response.json(), [[hits[0]]])
+
+
+    def test_search_service_api_vectors(self):
+
+        item = { "uuid": "00000000-0000-0000-0000-000000000001", "description": "Insalata caprese con pomodoro", "ingredients": ["mozzarella", "pomodoro", "basilico"] }
+        item2 = { "uuid": "00000000-0000-0000-0000-000000000002", "description": "Insalata di riso con verdure", "ingredients": ["riso", "carote", "piselli"] }
+        add_to_test_index([item, item2])
+
+        # Partial words are not matched by the text search..
+        url = 'http://search/api/v1/search?q=pomod%20insal&index_name=test_food&min_score=0&max_diff=1'
+        response = requests.get(url)
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(response.json(), [])
+
+        # ..but they are by the vectors, in any order (unless they are disabled, as by default)
+        response = requests.get(url + '&retrieval=vectors')
+        if response.status_code == 400:
+            self.assertEqual(response.json(), {'detail': 'Vector retrieval is disabled'})
+            self.skipTest('Vectors disabled in the search service (set VECTORS=true)')
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(response.json()[0]['_id'], '00000000-0000-0000-0000-000000000001')
+
+        # Also when falling back on them
+        response = requests.get(url + '&retrieval=fallback')
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(response.json()[0]['_id'], '00000000-0000-0000-0000-000000000001')
+
+        # Deleted items are gone from the vectors as well
+        requests.post('http://search/api/v1/delete/', json=dict(item, index_name='test_food'))
+        response = requests.get(url + '&retrieval=vectors')
+        self.assertEqual(response.status_code,200)
+        self.assertNotIn('00000000-0000-0000-0000-000000000001', [hit['_id'] for hit in response.json()])
+
+
+    def test_search_service_api_batch(self):
+
+        item = { "uuid": "00000000-0000-0000-0000-000000000001", "description": "Insalata caprese", "ingredients": ["mozzarella", "pomodoro", "basilico"] }
+        item2 = { "uuid": "00000000-0000-0000-0000-000000000038", "description": "Arancini di riso", "ingredients": ["riso", "carne", "piselli"] }
+        add_to_test_index([item, item2])
+
+        # Results in the same order of the queries, and an error for the bad ones only
+        payload = {'queries': ['arancini', 'caprese', 'xy', 'caprese'], 'index_name': 'test_food', 'min_score': 0, 'format': 'compact'}
+        response = requests.post('http://search/api/v1/batch/', json=payload)
+        self.assertEqual(response.status_code,200)
+        entries = response.json()
+        self.assertEqual([entry['q'] for entry in entries], ['arancini', 'caprese', 'xy', 'caprese'])
+        self.assertEqual(entries[0]['hits'][0]['_id'], '00000000-0000-0000-0000-000000000038')
+        self.assertEqual(entries[1]['hits'][0]['_id'], '00000000-0000-0000-0000-000000000001')
+        self.assertNotIn('hits', entries[2])
+        self.assertIn('error', entries[2])
+        self.assertEqual(entries[3]['hits'], entries[1]['hits'])
+
+        # Same results as the single searches
+        response = requests.get('http://search/api/v1/search?q=caprese&index_name=test_food&min_score=0&format=compact')
+        self.assertEqual(response.json(), entries[1]['hits'])
+
+        # Not too many queries at once
+        response = requests.post('http://search/api/v1/batch/', json={'queries': ['caprese'] * 1000, 'index_name': 'test_food'})
+        self.assertEqual(response.status_code,400)
+
+
+    def test_search_service_api_health(self):
+
+        # Live as long as it serves requests
+        response = requests.get('http://search/health/live')
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(response.json(), {'status': 'ok'})
+
+        # Ready only if the backend is reachable and the indexes to be served (here the test one) exist
+        response = requests.get('http://search/health/ready?indexes=test_food')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'backend': True, 'indexes': {'test_food': True}, 'status': 'ready'})
+
+        response = requests.get('http://search/health/ready?indexes=test_food,test_food_missing')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json(), {'backend': True, 'indexes': {'test_food': True, 'test_food_missing': False}, 'status': 'not ready'})
+
+        # The served ones by default (whether they exist or not)
+        response = requests.get('http://search/health/ready')
+        self.assertTrue(response.json()['backend'])
+        self.assertIn('food', response.json()['indexes'])
+        self.assertEqual(response.status_code, 200 if response.json()['status'] == 'ready' else 503)
+
+
+    def test_search_service_api_bulk(self):
+
+        # Index a few items and try to index a broken one
+        operations = [{ "action": "index", "index_name": "test_food", "uuid": "00000000-0000-0000-0000-000000000001", "description": "Insalata caprese", "ingredients": ["mozzarella", "pomodoro", "basilico"] },
+                      { "action": "index", "index_name": "test_food", "uuid": "00000000-0000-0000-0000-000000000002", "description": "Insalata di riso con verdure", "ingredients": ["riso", "carote", "piselli"] },
+                      { "action": "index", "index_name": "test_food", "uuid": "00000000-0000-0000-0000-000000000004", "description": "Insalata di riso con pollo", "ingredients": ["riso", "pollo", "maionese"], "has_servings": True },
+                      { "action": "index", "index_name": "test_food", "uuid": "00000000-0000-0000-0000-000000000003", "description": "Insalata senza ingredienti", "ingredients": [] }]
+        response = requests.post('http://search/api/v1/bulk/', json={'operations': operations}, params={'refresh': 'wait_for'})
+        self.assertEqual(response.status_code,200)
+        response_json = response.json()
+        self.assertEqual(response_json['total'], 4)
+        self.assertEqual(response_json['succeeded'], 3)
+        self.assertEqual(len(response_json['errors']), 1)
+        self.assertEqual(response_json['errors'][0]['position'], 3)
+        self.assertEqual(response_json['errors'][0]['uuid'], '00000000-0000-0000-0000-000000000003')
+
+        url = 'http://search/api/v1/search?q=insalata&index_name=test_food&min_score=0&max_diff=1&see_also=true'
+        response = requests.get(url)
+        self.assertEqual(len(response.json()), 3)
+
+        url_servings = 'http://search/api/v1/search?q=insalata&index_name=test_food&variant=servings&min_score=0&max_diff=1&see_also=true'
+        response = requests.get(url_servings)
+        self.assertEqual(len(response.json()), 1)
+        self.assertEqual(response.json()[0]['_id'], '00000000-0000-0000-0000-000000000004')
+
+        # Delete, including something which is not there
+        operations = [{ "action": "delete", "index_name": "test_food", "uuid": "00000000-0000-0000-0000-000000000001" },
+                      { "action": "delete", "index_name": "test_food", "uuid": "00000000-0000-0000-0000-000000000005" }]
+        response = requests.post('http://search/api/v1/bulk/', json={'operations': operations}, params={'refresh': 'wait_for'})
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(response.json()['errors'], [])
+
+        response = requests.get(url)
+        self.assertEqual(len(response.json()), 2)
+        uuids = [hit['_id'] for hit in response.json()]
+        self.assertTrue('00000000-0000-0000-0000-000000000002' in uuids)
+        self.assertTrue('00000000-0000-0000-0000-000000000004' in uuids)
+
+
+    def test_search_service_class_batching(self):
+
+        search_service = SearchService(index_prefix='test_', batch_size=2, refresh='wait_for')
+
+        # Nothing is sent until the batch fills up or ends
+        with patch.object(search_service, 'request', wraps=search_service.request) as mocked_request:
+            with search_service.batch():
+                for i in range(5):
+                    food = Food(uuid='00000000-0000-0000-0000-00000000010{}'.format(i),
+                                name='My Food {}'.format(i),
+                                main_ingredients = ['Ingredient 1'],
+                                created_by=self.test_user,
+                                small_serving=10)
+                    food.save(search_service=search_service)
+            # Five operations in batches of two
+            self.assertEqual(mocked_request.call_count, 3)
+
+        hits = search_service.query('Food', variant='servings', min_score=0, max_diff=1)
+        self.assertEqual(len(hits),5)
+
+
     def test_search_service_class_with_food_model(self):
 
-        search_service = SearchService(index_prefix='test_')
+        search_service = SearchService(index_prefix='test_', refresh='wait_for')
 
         food1 = Food(uuid='00000000-0000-0000-0000-000000000100',
                      name='My Food',
@@ -170,7 +364,6 @@ class TestSearchService(TestCase):
                      main_ingredients = ['Ingredient 1', 'Ingredient 2', 'Ingredient 3'],
                      created_by=self.test_user )
         food2.save(search_service=search_service)
-        time.sleep(1)
 
         # Can we search them back with the search service?
         hits = search_service.query('Food')
@@ -191,15 +384,39 @@ class TestSearchService(TestCase):
 
         # Check the delete
         food1.delete(search_service=search_service)
-        time.sleep(1)
         results = Food.query('Food', search_service=search_service)
         self.assertEqual(len(results),1)
         self.assertEqual(results[0].uuid,food2.uuid)
 
+    def test_search_service_class_delete_many(self):
+
+        search_service = SearchService(index_prefix='test_', refresh='wait_for', delete_batch_size=2)
+
+        for i in range(5):
+            Food(uuid='00000000-0000-0000-0000-00000000020{}'.format(i), name='My Food {}'.format(i),
+                 main_ingredients=['Ingredient'], created_by=self.test_user).save(search_service=search_service)
+
+        # As all of them match, "Food" scores low (below the default min score)
+        self.assertEqual(len(search_service.query('Food', min_score=0)), 5)
+
+        # Queryset deletes go to the search index too, in batches of uuids (missing ones skipped)
+        with patch.object(search_service, 'request', wraps=search_service.request) as request:
+            deleted_count, _ = Food.objects.exclude(name='My Food 0').delete(search_service=search_service)
+        self.assertEqual(deleted_count, 4)
+        self.assertEqual(request.call_count, 2)
+        self.assertEqual([hit['_id'] for hit in search_service.query('Food', min_score=0)], ['00000000-0000-0000-0000-000000000200'])
+        search_service.delete_many(['00000000-0000-0000-0000-000000000201', '00000000-0000-0000-0000-000000000299'])
+
+        # Also when buffering
+        with search_service.batch():
+            Food.objects.all().delete(search_service=search_service)
+        self.assertEqual(Food.objects.count(), 0)
+        self.assertEqual(search_service.query('Food', min_score=0), [])
+
 
     def test_search_service_class_with_food_model_and_variants(self):
 
-        search_service = SearchService(index_prefix='test_')
+        search_service = SearchService(index_prefix='test_', refresh='wait_for')
 
         food1 = Food(uuid='00000000-0000-0000-0000-000000000100',
                      name='My Food',
@@ -212,7 +429,6 @@ class TestSearchService(TestCase):
                      main_ingredients = ['Ingredient 1', 'Ingredient 2', 'Ingredient 3'],
                      created_by=self.test_user)
         food2.save(search_service=search_service)
-        time.sleep(1)
 
         # Can we search the serving variant back with the search service?
         hits = search_service.query('Food', variant='servings')
@@ -224,15 +440,304 @@ class TestSearchService(TestCase):
         self.assertEqual(len(results),1)
         self.assertEqual(results[0].uuid,food1.uuid)
 
-        # Check the delete that has to remove on both indexes
+        # Check the delete that has to remove the variant as well
         food1.delete(search_service=search_service)
-        time.sleep(1)
         results = Food.query('Food', search_service=search_service)
         self.assertEqual(len(results),1) # Only "My Other Food" left
         self.assertEqual(results[0].uuid,food2.uuid)
         hits = search_service.query('Food', variant='servings')
         self.assertEqual(len(hits),0)
 
+
+    def test_search_service_class_reindex(self):
+
+        search_service = SearchService(index_prefix='test_', refresh='wait_for')
+
+        food1 = Food(uuid='00000000-0000-0000-0000-000000000100',
+                     name='My Food',
+                     main_ingredients = ['Ingredient 1', 'Ingredient 2', 'Ingredient 3'],
+                     created_by=self.test_user)
+        food1.save(search_service=search_service)
+
+        # Reindex: the current index is searched until the new one is swapped in
+        with search_service.reindex():
+            food2 = Food(uuid='00000000-0000-0000-0000-000000000101',
+                         name='My Other Food',
+                         main_ingredients = ['Ingredient 1', 'Ingredient 2', 'Ingredient 3'],
+                         created_by=self.test_user)
+            food2.save(search_service=search_service)
+            search_service.flush()
+            hits = search_service.query('Food')
+            self.assertEqual([hit['_id'] for hit in hits], ['00000000-0000-0000-0000-000000000100'])
+
+        hits = search_service.query('Food')
+        self.assertEqual([hit['_id'] for hit in hits], ['00000000-0000-0000-0000-000000000101'])
+
+        # A failed reindex leaves the current index untouched
+        with self.assertRaises(ValueError):
+            with search_service.reindex():
+                food1.uuid = '00000000-0000-0000-0000-000000000102'
+                food1.id = None
+                food1.save(search_service=search_service)
+                raise ValueError('Something went wrong')
+
+        hits = search_service.query('Food')
+        self.assertEqual([hit['_id'] for hit in hits], ['00000000-0000-0000-0000-000000000101'])
+
+        # Writes outside a reindex go on the current generation
+        food3 = Food(uuid='00000000-0000-0000-0000-000000000103',
+                     name='My Third Food',
+                     main_ingredients = ['Ingredient 1', 'Ingredient 2', 'Ingredient 3'],
+                     created_by=self.test_user)
+        food3.save(search_service=search_service)
+        hits = search_service.query('Food')
+        self.assertEqual(len(hits), 2)
+
+
+    def test_search_service_class_multi_query(self):
+
+        search_service = SearchService(index_prefix='test_', refresh='wait_for')
+
+        food1 = Food(uuid='00000000-0000-0000-0000-000000000100',
+                     name='My Food',
+                     main_ingredients = ['Ingredient 1', 'Ingredient 2', 'Ingredient 3'],
+                     created_by=self.test_user,
+                     small_serving=10)
+        food1.save(search_service=search_service)
+
+        # All the variants in one go, results in the same order
+        results = search_service.multi_query([('Food', 'pieces'), ('Food', 'servings'), ('Food', None)])
+        self.assertEqual(len(results),3)
+        self.assertEqual(results[0],[])
+        self.assertEqual(results[1][0]['_id'],'00000000-0000-0000-0000-000000000100')
+        self.assertEqual(results[2][0]['_id'],'00000000-0000-0000-0000-000000000100')
+
+        # Ok, now test the built-in Food query picking the first variant with results
+        position, results = Food.query_first([('Food', 'pieces'), ('Food', 'servings'), ('Food', None)], search_service=search_service)
+        self.assertEqual(position,1)
+        self.assertEqual(len(results),1)
+        self.assertEqual(results[0].uuid,food1.uuid)
+
+        position, results = Food.query_first([('Girasole', 'pieces'), ('Girasole', None)], search_service=search_service)
+        self.assertEqual(position,None)
+        self.assertEqual(results,[])
+
+    def test_search_service_class_query_many(self):
+
+        search_service = SearchService(index_prefix='test_', refresh='wait_for', query_batch_size=2)
+
+        for i, name in enumerate(['Arancini di riso', 'Insalata caprese']):
+            food = Food(uuid='00000000-0000-0000-0000-00000000010{}'.format(i),
+                        name=name,
+                        main_ingredients = ['Ingredient 1'],
+                        created_by=self.test_user,
+                        small_serving=10)
+            food.save(search_service=search_service)
+
+        # Results in the same order, also across requests, and none for what cannot be searched
+        results = search_service.query_many(['caprese', 'arancini', 'xy', 'girasole', 'arancini'])
+        self.assertEqual(len(results),5)
+        self.assertEqual(results[0][0]['_id'],'00000000-0000-0000-0000-000000000101')
+        self.assertEqual(results[1][0]['_id'],'00000000-0000-0000-0000-000000000100')
+        self.assertEqual(results[2],[])
+        self.assertEqual(results[3],[])
+        self.assertEqual(results[4],results[1])
+
+    def test_search_service_class_suggest(self):
+
+        search_service = SearchService(index_prefix='test_', refresh='wait_for')
+
+        for i, name in enumerate(['Arancini di riso', 'Arancini al burro', 'Insalata di riso']):
+            food = Food(uuid='00000000-0000-0000-0000-00000000010{}'.format(i),
+                        name=name,
+                        main_ingredients = ['Ingredient 1'],
+                        created_by=self.test_user)
+            food.save(search_service=search_service)
+
+        # Prefix on the last word, whole words on the others
+        suggestions = search_service.suggest('aranc')
+        self.assertEqual(sorted(suggestion['description'] for suggestion in suggestions), ['Arancini al burro', 'Arancini di riso'])
+        suggestions = search_service.suggest('di ri')
+        self.assertEqual(sorted(suggestion['description'] for suggestion in suggestions), ['Arancini di riso', 'Insalata di riso'])
+        self.assertEqual(search_service.suggest('arancini al b')[0]['description'], 'Arancini al burro')
+        self.assertEqual(search_service.suggest('zuppa'), [])
+
+    def test_search_service_class_session(self):
+
+        search_service = SearchService(index_prefix='test_', refresh='wait_for')
+        food = Food(uuid='00000000-0000-0000-0000-000000000100',
+                    name='Arancini di riso',
+                    main_ingredients = ['Ingredient 1'],
+                    created_by=self.test_user)
+        food.save(search_service=search_service)
+
+        # All the requests go on the same session, and reuse its connections
+        stats = get_search_client_stats()
+        for _ in range(5):
+            self.assertEqual(search_service.query('arancini')[0]['_id'], '00000000-0000-0000-0000-000000000100')
+        self.assertIs(get_search_session(), get_search_session())
+        new_stats = get_search_client_stats()
+        self.assertEqual(new_stats['requests'] - stats['requests'], 5)
+        self.assertEqual(new_stats['retries'], stats['retries'])
+        self.assertLessEqual(new_stats['pools']['search:80']['connections'], 1 + stats['pools'].get('search:80', {}).get('connections', 0))
+
+        # The counters are available through the API, to authenticated users only
+        self.assertIn(self.client.get('/api/v1/search_client').status_code, [401, 403])
+        self.client.force_login(self.test_user)
+        response = self.client.get('/api/v1/search_client')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('retries', response.json()['data'])
+
+        # Reads are retried before giving up, writes are not
+        unreachable_search_service = SearchService(host='localhost:1', index_prefix='test_')
+        with patch('webapp.core.utils.SEARCH_RETRY_BACKOFF', 0):
+            with self.assertRaises(Exception):
+                unreachable_search_service.query('arancini')
+            self.assertEqual(get_search_client_stats()['retries'] - new_stats['retries'], 2)
+            with self.assertRaises(Exception):
+                unreachable_search_service.add({'uuid': '00000000-0000-0000-0000-000000000101', 'description': 'Riso', 'ingredients': ['riso']})
+            self.assertEqual(get_search_client_stats()['retries'] - new_stats['retries'], 2)
+            self.assertEqual(get_search_client_stats()['failures'] - new_stats['failures'], 2)
+
+
+    def test_load_foods_from_csv(self):
+
+        search_service = SearchService(index_prefix='test_', refresh='wait_for')
+
+        # Chunks of two foods, with all kinds of errors and skipped rows in between
+        csv_file = tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False)
+        csv_file.write('Ignora,Nome descrittivo,Ingredienti principali,Tipo,"Porzione\nmedia",Pezzo piccolo,CHO per 100g,Utente\n'
+                       ',,,,,,,\n'
+                       ',Pasta al pomodoro,"pasta, pomodoro",cibo,200,,30,testuser\n'
+                       'x,Pasta in bianco,pasta,cibo,200,,30,testuser\n'
+                       ',Pasta senza ingredienti,,cibo,200,,30,testuser\n'
+                       ',Pasta di nessuno,pasta,cibo,200,,30,\n'
+                       ',Pasta senza valori,pasta,cibo,200,,,testuser\n'
+                       '\n'
+                       ',Succo di frutta,frutta,bevanda,no,,10,testuser\n'
+                       ',Biscotti (v.m.),farina,cibo,,10,70,testuser\n')
+        csv_file.close()
+        try:
+            loaded_count, errors = load_foods_from_csv(csv_file.name, self.test_user, search_service=search_service, chunk_size=2)
+        finally:
+            os.remove(csv_file.name)
+
+        self.assertEqual(loaded_count, 3)
+        self.assertEqual(errors, {5: 'Nessun ingrediente principale per "Pasta senza ingredienti"?',
+                                  6: 'Nessun utente per "Pasta di nessuno", non aggiunto',
+                                  7: 'Nessun valore nutrizionale per "Pasta senza valori"?'})
+
+        food = Food.objects.get(name='Pasta al pomodoro')
+        self.assertEqual(food.main_ingredients, ['pasta', 'pomodoro'])
+        self.assertEqual(food.medium_serving, 200)
+        self.assertEqual([observation.cho for observation in food.observations.all()], [30])
+        food = Food.objects.get(name='Succo di frutta')
+        self.assertTrue(food.liquid)
+        self.assertIsNone(food.medium_serving)
+        food = Food.objects.get(name='Biscotti')
+        self.assertEqual(food.small_piece, 10)
+        self.assertEqual(sorted(observation.cho for observation in food.observations.all()), [56, 70, 84])
+        self.assertEqual(FoodObservation.objects.count(), 5)
+        self.assertEqual(len(set(FoodObservation.objects.values_list('uuid', flat=True))), 5)
+
+        # And all of them are searchable
+        self.assertEqual(search_service.query('biscotti')[0]['_id'], food.uuid)
+        self.assertEqual(len(search_service.query_many(['pomodoro', 'succo', 'biscotti'])), 3)
+
+
+    def test_load_foods_from_csv_search_error(self):
+
+        search_service = SearchService(index_prefix='test_', refresh='wait_for')
+
+        csv_file = tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False)
+        csv_file.write('Nome descrittivo,Ingredienti principali,Porzione media,CHO per 100g,Utente\n'
+                       'Pasta al pomodoro,pasta,200,30,testuser\n'
+                       'Insalata caprese,mozzarella,150,2,testuser\n'
+                       'Arancini di riso,riso,,35,testuser\n')
+        csv_file.close()
+
+        # The search service fails on the (last) bulk of the second chunk, which is rolled back
+        self.assertFalse(Food.objects.exists())
+        try:
+            with patch.object(search_service, 'bulk', side_effect=[None, Exception('Search service down')]):
+                with self.assertRaises(Exception):
+                    load_foods_from_csv(csv_file.name, self.test_user, search_service=search_service, chunk_size=2)
+        finally:
+            os.remove(csv_file.name)
+        self.assertEqual(sorted(Food.objects.values_list('name', flat=True)), ['Insalata caprese', 'Pasta al pomodoro'])
+
+
+    def test_read_foods_from_compressed_csv(self):
+
+        csv_file_path = os.path.join(os.path.dirname(__file__), 'test_data.csv')
+        errors = {}
+        foods = list(read_foods_from_csv(csv_file_path, errors))
+        self.assertEqual(len(foods), 74)
+
+        with tempfile.TemporaryDirectory() as path:
+
+            # Gzipped and zipped (whatever the file names), read the same
+            with open(csv_file_path, 'rb') as f, gzip.open(os.path.join(path, 'test_data'), 'wb') as gzip_file:
+                shutil.copyfileobj(f, gzip_file)
+            gzip_errors = {}
+            self.assertEqual(list(read_foods_from_csv(os.path.join(path, 'test_data'), gzip_errors)), foods)
+            self.assertEqual(gzip_errors, errors)
+
+            with zipfile.ZipFile(os.path.join(path, 'test_data.zip'), 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+                zip_file.writestr('README.txt', 'Not a catalog')
+                zip_file.write(csv_file_path, 'catalog/test_data.csv')
+            zip_errors = {}
+            self.assertEqual(list(read_foods_from_csv(os.path.join(path, 'test_data.zip'), zip_errors)), foods)
+            self.assertEqual(zip_errors, errors)
+
+            # But a CSV file is still needed in the archive
+            with zipfile.ZipFile(os.path.join(path, 'empty.zip'), 'w') as zip_file:
+                zip_file.writestr('README.txt', 'Not a catalog')
+            with self.assertRaises(Exception):
+                list(read_foods_from_csv(os.path.join(path, 'empty.zip'), {}))
+
+    def test_reload_foods_from_csv(self):
+
+        search_service = SearchService(index_prefix='test_', refresh='wait_for')
+
+        # A reload replaces the whole catalog, so the counts below hold only from an empty one
+        self.assertFalse(Food.objects.exists())
+
+        def reload(rows):
+            csv_file = tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False)
+            csv_file.write('Nome descrittivo,Ingredienti principali,Porzione media,CHO per 100g,Utente\n')
+            for row in rows:
+                csv_file.write('{},{},{},{},testuser\n'.format(*row))
+            csv_file.close()
+            try:
+                return reload_foods_from_csv(csv_file.name, self.test_user, search_service=search_service)
+            finally:
+                os.remove(csv_file.name)
+
+        counts, errors = reload([('Pasta al pomodoro', 'pasta', 200, 30), ('Insalata caprese', 'mozzarella', 150, 2), ('Arancini di riso', 'riso', '', 35)])
+        self.assertEqual(counts, {'inserted': 3, 'updated': 0, 'deleted': 0, 'unchanged': 0})
+        self.assertEqual(errors, {})
+        uuids = dict(Food.objects.values_list('name', 'uuid'))
+
+        # Nothing changed, nothing done
+        counts, _ = reload([('Pasta al pomodoro', 'pasta', 200, 30), ('Insalata caprese', 'mozzarella', 150, 2), ('Arancini di riso', 'riso', '', 35)])
+        self.assertEqual(counts, {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 3})
+
+        # Only what changed is updated (in place), inserted or deleted
+        counts, _ = reload([('Pasta al pomodoro', 'pasta', 200, 30), ('Insalata caprese', 'mozzarella', 150, 3), ('Tiramisu', 'mascarpone', 100, 40)])
+        self.assertEqual(counts, {'inserted': 1, 'updated': 1, 'deleted': 1, 'unchanged': 1})
+        food = Food.objects.get(name='Insalata caprese')
+        self.assertEqual(food.uuid, uuids['Insalata caprese'])
+        self.assertEqual([observation.cho for observation in food.observations.all()], [3])
+        self.assertEqual(sorted(Food.objects.values_list('name', flat=True)), ['Insalata caprese', 'Pasta al pomodoro', 'Tiramisu'])
+        self.assertEqual(FoodObservation.objects.count(), 3)
+
+        # And the search index follows
+        self.assertEqual(search_service.query('caprese')[0]['_id'], uuids['Insalata caprese'])
+        self.assertEqual(search_service.query('tiramisu')[0]['_id'], Food.objects.get(name='Tiramisu').uuid)
+        self.assertEqual(search_service.query('arancini'), [])
+
+
 class TestMessageParser(TestCase):
 
     def test_message_parser_basic(self):
@@ -1,11 +1,46 @@
+import io
+import os
 import csv
+import gzip
+import uuid
+import zipfile
+import hashlib
+import time
+import random
 import traceback
 import logging
 import requests
+import orjson
+from contextlib import contextmanager
 
 # Setup logging
 logger = logging.getLogger(__name__)
 
+# Search service client conf (in seconds). The read timeout depends on the operation,
+# as management commands and bulk writes can take much longer than searches.
+SEARCH_CONNECT_TIMEOUT = float(os.environ.get('SEARCH_CONNECT_TIMEOUT', 2))
+SEARCH_READ_TIMEOUTS = {'read': float(os.environ.get('SEARCH_READ_TIMEOUT', 10)),
+                        'write': float(os.environ.get('SEARCH_WRITE_TIMEOUT', 30)),
+                        'manage': float(os.environ.get('SEARCH_MANAGE_TIMEOUT', 120))}
+SEARCH_RETRIES = int(os.environ.get('SEARCH_RETRIES', 2))
+SEARCH_RETRY_BACKOFF = float(os.environ.get('SEARCH_RETRY_BACKOFF', 0.1))
+SEARCH_POOL_SIZE = int(os.environ.get('SEARCH_POOL_SIZE', 10))
+
+# Worth retrying a read on (the search service restarting or overloaded)
+SEARCH_RETRY_STATUS_CODES = [502, 503, 504]
+
+# One session per process (not shared across forks), and its counters
+search_session = None
+search_session_pid = None
+search_client_stats = {'requests': 0, 'retries': 0, 'failures': 0}
+
+# Rows read between progress reports, when loading foods from CSV files
+PROGRESS_ROWS = 1000
+
+# Leading bytes of the compressed CSV files
+GZIP_MAGIC = b'\x1f\x8b'
+ZIP_MAGIC = b'PK\x03\x04'
+
 
 def booleanize(*args, **kwargs):
     # Handle both single value and kwargs to get arg name
@@ -45,230 +80,556 @@ def format_exception(e):
         return str('Got exception "{}" of type "{}" with traceback "{}"'.format(e.__class__.__name__, type(e), traceback.format_exc().replace('\n', '|')))
 
 
-def get_index_name(prefix=None, variant=None):
+def get_index_name(prefix=None):
     name = 'food'
     if prefix:
         name = '{}{}'.format(prefix, name)
-    if variant:
-        name = '{}_{}'.format(name, variant)
     return name
 
 
+def get_search_session():
+    # A keep-alive session with a pool of connections to the search service, per process
+    global search_session, search_session_pid
+    if search_session is None or search_session_pid != os.getpid():
+        search_session = requests.Session()
+        search_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=SEARCH_POOL_SIZE))
+        search_session_pid = os.getpid()
+    return search_session
+
+
+def get_search_client_stats():
+    # The counters, plus the connections opened and reused for each host
+    stats = dict(search_client_stats, pid=os.getpid(), pools={})
+    if search_session is not None and search_session_pid == os.getpid():
+        adapter = search_session.get_adapter('http://')
+        for key in adapter.poolmanager.pools.keys():
+            pool = adapter.poolmanager.pools[key]
+            stats['pools']['{}:{}'.format(pool.host, pool.port)] = {
+                'connections': pool.num_connections,
+                'requests': pool.num_requests,
+                'idle': len([connection for connection in list(pool.pool.queue) if connection is not None]) if pool.pool else 0,
+                'maxsize': SEARCH_POOL_SIZE}
+    return stats
+
+
 class SearchService():
 
-    def __init__(self, host='search', index_prefix=None):
+    def __init__(self, host='search', index_prefix=None, batch_size=500, refresh=None, compact=True, query_batch_size=100,
+                 delete_batch_size=10000):
         self.host = host
         self.index_prefix = index_prefix
+        self.batch_size = batch_size
+        # Uuids deleted together by delete_many (at most the search service limit)
+        self.delete_batch_size = delete_batch_size
+        # Queries sent together by query_many (at most the search service limit)
+        self.query_batch_size = query_batch_size
+        # Ask for compact search results (only ids, scores and see also flags)
+        self.compact = compact
+        # Refresh policy for the writes ("false", "wait_for" or "true"): with "wait_for" they
+        # are visible to searches once sent, with "true" they are made visible right away.
+        self.refresh = refresh
+        self.buffer = None
+        self.generation = None
+
+    @property
+    def index_name(self):
+        # Writes go on the generation being built, if any
+        if self.generation:
+            return self.generation
+        return get_index_name(self.index_prefix)
+
+    def request(self, method, path, operation='read', retry=False, **kwargs):
+        """Send a request to the search service on the pooled session, with the connect and read
+        timeouts of the operation. Only idempotent requests should be retried: it happens on
+        connection errors, timeouts and unavailable responses, with a jittered exponential backoff."""
+        url = 'http://{}{}'.format(self.host, path)
+        timeout = (SEARCH_CONNECT_TIMEOUT, SEARCH_READ_TIMEOUTS[operation])
+        attempts = SEARCH_RETRIES + 1 if retry else 1
+        for attempt in range(attempts):
+            if attempt:
+                search_client_stats['retries'] += 1
+                time.sleep(random.uniform(0, SEARCH_RETRY_BACKOFF * 2 ** (attempt - 1)))
+            search_client_stats['requests'] += 1
+            try:
+                response = get_search_session().request(method, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt + 1 < attempts:
+                    logger.warning('Retrying %s %s after error: %s', method, path, e)
+                    continue
+                search_client_stats['failures'] += 1
+                raise
+            if response.status_code in SEARCH_RETRY_STATUS_CODES and attempt + 1 < attempts:
+                logger.warning('Retrying %s %s after status code %s', method, path, response.status_code)
+                continue
+            return response
+
+    def manage(self, command, index_name=None, **kwargs):
+        payload = dict({'command': command,
+                        'index_name': index_name if index_name else get_index_name(self.index_prefix),
+                        'confirmation_code': 'DEADBEEF'}, **kwargs)
+        response = self.request('POST', '/api/v1/manage/', operation='manage', json=payload)
+        if not response.status_code == 200:
+            raise Exception(response.content)
+        return response.json()
+
+    @contextmanager
+    def reindex(self):
+        """Build a new generation of the index, with all the adds and deletes in bulk going
+        there, and atomically swap it in on exit. In the meantime, searches keep hitting the
+        current one. If anything goes wrong, the new generation is thrown away."""
+        self.generation = self.manage('build')['generation']
+        logger.debug('Reindexing on generation "%s"', self.generation)
+        try:
+            # No need to refresh, swapping the generation in does it
+            with self.batch(refresh='false'):
+                yield self
+        except Exception:
+            self.manage('delete', index_name=self.generation)
+            raise
+        else:
+            self.manage('swap', generation=self.generation)
+        finally:
+            self.generation = None
+
+    @contextmanager
+    def batch(self, refresh=None):
+        """Buffer adds and deletes and send them to the search service in bulk requests
+        of (at most) batch_size operations. Whatever is left is flushed on exit, with the
+        refresh policy applied (once) to this last bulk request."""
+        if self.buffer is not None:
+            # Already batching, just join the outer batch
+            yield self
+            return
+        self.buffer = []
+        try:
+            yield self
+        finally:
+            try:
+                self.flush(refresh=refresh if refresh else self.refresh)
+            finally:
+                self.buffer = None
+
+    def flush(self, refresh='false'):
+        if not self.buffer:
+            return
+        operations = self.buffer
+        self.buffer = []
+        self.bulk(operations, refresh=refresh)
+
+    def get_refresh_params(self, refresh=None):
+        refresh = refresh if refresh else self.refresh
+        return {'refresh': refresh} if refresh else {}
+
+    def bulk(self, operations, refresh=None):
+        logger.debug('Sending a bulk of %s operations', len(operations))
+        response = self.request('POST', '/api/v1/bulk/', operation='write', json={'operations': operations}, params=self.get_refresh_params(refresh))
+        if not response.status_code == 200:
+            raise Exception(response.content)
+        errors = response.json()['errors']
+        if errors:
+            raise Exception('Got {} errors in bulk: {}'.format(len(errors), errors))
+
+    def _enqueue(self, operation):
+        self.buffer.append(operation)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
 
-    def add(self, item, variant=None):
+    def add(self, item, refresh=None):
 
-        index_name = get_index_name(self.index_prefix, variant)
+        # Variants are set on the item itself by its "has_servings" and "has_pieces" flags
+        index_name = self.index_name
         item['index_name'] = index_name # TODO: this is hack-ish
         logger.debug('Adding using index "%s"', index_name)
 
-        url = 'http://{}/api/v1/add/'.format(self.host)
-        response = requests.post(url, json=item)
+        if self.buffer is not None:
+            self._enqueue(dict(item, action='index'))
+            return
+
+        response = self.request('POST', '/api/v1/add/', operation='write', json=item, params=self.get_refresh_params(refresh))
         if not response.status_code == 200:
             raise Exception(response.content)
 
-    def delete(self, item, variant=None):
+    def delete(self, item, refresh=None):
 
-        index_name = get_index_name(self.index_prefix, variant)
+        index_name = self.index_name
         item['index_name'] = index_name # TODO: this is hack-ish
         logger.debug('Deleting using index "%s"', index_name)
 
-        url = 'http://{}/api/v1/delete/'.format(self.host)
-        response = requests.post(url, json=item)
+        if self.buffer is not None:
+            self._enqueue({'action': 'delete', 'uuid': item['uuid'], 'index_name': index_name})
+            return
+
+        response = self.request('POST', '/api/v1/delete/', operation='write', json=item, params=self.get_refresh_params(refresh))
         if response.status_code not in [200, 404]:
             raise Exception(response.content)
 
+    def delete_many(self, uuids, refresh=None):
+
+        # Delete many items at once, in as few requests as possible (what is not there is skipped)
+        index_name = self.index_name
+        logger.debug('Deleting %s items using index "%s"', len(uuids), index_name)
+
+        if self.buffer is not None:
+            for item_uuid in uuids:
+                self._enqueue({'action': 'delete', 'uuid': item_uuid, 'index_name': index_name})
+            return
+
+        for start in range(0, len(uuids), self.delete_batch_size):
+            payload = {'index_name': index_name, 'uuids': uuids[start:start+self.delete_batch_size]}
+            response = self.request('POST', '/api/v1/delete_many/', operation='write', json=payload, params=self.get_refresh_params(refresh))
+            if not response.status_code == 200:
+                raise Exception(response.content)
+
     def query(self, q, variant=None, min_score=0.1, max_diff=0.3, see_also=False):
 
-        # Remove unnecessary articles
-        q_without_articles = q
-        for article in ['con', 'coi', 'la', 'le', 'gli', 'i', 'alle', 'all\'', 'l\'']:
-            if ' {} '.format(article) in q:
-                q_without_articles = q_without_articles.replace(' {} '.format(article), ' ')
-        for contracted_article in ['all\'', 'l\'']:
-            if ' {}' .format(contracted_article) in q:
-                q_without_articles = q_without_articles.replace(' {}'.format(contracted_article), '')
-
-        q_cleaned = q_without_articles.replace(' ', '%20') # TODO: make it all url-safe
-
-        index_name = get_index_name(self.index_prefix, variant)
-        logger.debug('Querying using index "%s" for "%s" and min_score=%s, max_diff=%s', index_name, q_cleaned, min_score, max_diff)
-
-        url = 'http://{}/api/v1/search?q={}&index_name={}&min_score={}&max_diff={}&see_also={}'.format(self.host,
-                                                                                                       q_cleaned,
-                                                                                                       index_name,
-                                                                                                       min_score,
-                                                                                                       max_diff,
-                                                                                                       see_also)
-        response = requests.get(url)
+        # Articles and such are taken care of by the search service analyzer
+        index_name = get_index_name(self.index_prefix)
+        logger.debug('Querying using index "%s" (variant "%s") for "%s" and min_score=%s, max_diff=%s', index_name, variant, q, min_score, max_diff)
+
+        params = {'q': q, 'index_name': index_name, 'min_score': min_score, 'max_diff': max_diff, 'see_also': see_also}
+        if variant:
+            params['variant'] = variant
+        if self.compact:
+            params['format'] = 'compact'
+        response = self.request('GET', '/api/v1/search', retry=True, params=params)
         if not response.status_code == 200:
             raise Exception(response.content)
         else:
-            return response.json()
+            return orjson.loads(response.content)
 
+    def multi_query(self, searches, min_score=0.1, max_diff=0.3, see_also=False):
 
-def load_foods_from_csv(csv_file_path, created_by_user, search_service=None):
-    from django.contrib.auth.models import User
-    from .models import Food, FoodObservation
+        # Searches are (q, variant) pairs, all sent in a single request
+        payload = {'searches': [{'q': q,
+                                 'index_name': get_index_name(self.index_prefix),
+                                 'variant': variant,
+                                 'min_score': min_score,
+                                 'max_diff': max_diff,
+                                 'see_also': see_also} for q, variant in searches],
+                   'format': 'compact' if self.compact else 'full'}
+        logger.debug('Multi-querying for %s', payload['searches'])
 
-    errors = {}
-    loaded_count = 0
+        response = self.request('POST', '/api/v1/msearch/', retry=True, json=payload)
+        if not response.status_code == 200:
+            raise Exception(response.content)
+        else:
+            return orjson.loads(response.content)
+
+    def query_many(self, queries, variant=None, min_score=0.1, max_diff=0.3, see_also=False):
+
+        # Results for many queries with the same parameters (as the foods of a meal), in order,
+        # in as few requests as possible. A query which cannot be searched gets no results.
+        results = []
+        for start in range(0, len(queries), self.query_batch_size):
+            payload = {'queries': queries[start:start+self.query_batch_size],
+                       'index_name': get_index_name(self.index_prefix),
+                       'variant': variant,
+                       'min_score': min_score,
+                       'max_diff': max_diff,
+                       'see_also': see_also,
+                       'format': 'compact' if self.compact else 'full'}
+            logger.debug('Batch-querying for %s', payload['queries'])
+            response = self.request('POST', '/api/v1/batch/', retry=True, json=payload)
+            if not response.status_code == 200:
+                raise Exception(response.content)
+            for entry in orjson.loads(response.content):
+                if 'error' in entry:
+                    logger.warning('Could not search for "%s": %s', entry['q'], entry['error'])
+                results.append(entry.get('hits', []))
+        return results
+
+    def suggest(self, q, size=5):
+
+        # Completions for what the user is typing, as {"uuid", "description"} dicts
+        params = {'q': q, 'index_name': get_index_name(self.index_prefix), 'size': size}
+        response = self.request('GET', '/api/v1/suggest', retry=True, params=params)
+        if not response.status_code == 200:
+            raise Exception(response.content)
+        else:
+            return orjson.loads(response.content)
+
+
+def get_csv_columns(header):
+    """Resolve which fields the columns of a foods CSV file feed, on what their (lowercase)
+    headers contain, as (position, field, kind) triples in column order. The kind tells how
+    to parse the values: later columns win over earlier ones for the same field."""
+    columns = []
+    for position, key in enumerate(header):
+        key = key.lower()
+
+        # Is this from a specific user? Ignore?
+        if 'utente' in key:
+            columns.append((position, 'user', 'user'))
+        if 'ignora' in key:
+            columns.append((position, 'skip', 'flag'))
+
+        # Servings and pieces
+        if 'porzione' in key:
+            for size, field in [('piccola', 'small_serving'), ('media', 'medium_serving'), ('grande', 'large_serving')]:
+                if size in key:
+                    columns.append((position, field, 'amount'))
+        if 'pezzo' in key:
+            for size, field in [('piccolo', 'small_piece'), ('medio', 'medium_piece'), ('grande', 'large_piece')]:
+                if size in key:
+                    columns.append((position, field, 'amount'))
+
+        # Values (note that fat is set from the "proteine" columns)
+        for name, field in [('cho', 'cho_content'), ('protein', 'protein_content'), ('fibre', 'fiber_content'), ('proteine', 'fat_content')]:
+            if name in key:
+                columns.append((position, field, 'value'))
+
+        # Liquid
+        if 'tipo' in key:
+            columns.append((position, 'liquid', 'type'))
+    return columns
+
+
+@contextmanager
+def open_csv_file(csv_file_path):
+    """Open a CSV file for reading as text, decompressing it on the fly if gzipped or zipped
+    (using the first CSV file in the archive), as told by its first bytes and not by its name."""
+    with open(csv_file_path, mode='rb') as f:
+        magic = f.read(4)
+        f.seek(0)
+        if magic.startswith(GZIP_MAGIC):
+            with gzip.open(f) as binary, io.TextIOWrapper(binary, newline='') as text:
+                yield text
+        elif magic == ZIP_MAGIC:
+            with zipfile.ZipFile(f) as archive:
+                names = [name for name in archive.namelist() if name.lower().endswith('.csv')]
+                if not names:
+                    raise Exception('No CSV file in the zip archive')
+                with archive.open(names[0]) as binary, io.TextIOWrapper(binary, newline='') as text:
+                    yield text
+        else:
+            with io.TextIOWrapper(f, newline='') as text:
+                yield text
 
-    with open(csv_file_path, mode='r') as f:
-        reader = csv.DictReader(f)
-        csv_data = [row for row in reader]
 
-    user_cache = {}
+def read_foods_from_csv(csv_file_path, errors, progress=None):
+    """Stream the foods of a CSV file (possibly compressed, see open_csv_file) as (fields,
+    observations) pairs, the fields of the food and the ratios of each of its observations,
+    skipping the rows with errors and setting them by line (as the row number plus two) in
+    the errors dict. If given, progress is called with the number of rows read every
+    PROGRESS_ROWS rows, and at the end."""
+    from django.contrib.auth.models import User
 
-    for i, entry in enumerate(csv_data):
-        user = None
-        skip = False
-        if not entry['Nome descrittivo']:
-            continue
-        else:
-            name = entry['Nome descrittivo'].strip()
-        if not entry['Ingredienti principali']:
-            errors[i+2] = 'Nessun ingrediente principale per "{}"?'.format(name)
-            continue
-        else:
-            main_ingredients = [ingredient.strip() for ingredient in entry['Ingredienti principali'].split(',')]
-
-        small_serving = None
-        medium_serving = None
-        large_serving = None
-
-        small_piece = None
-        medium_piece = None
-        large_piece = None
-
-        cho_content = None
-        protein_content = None
-        fiber_content = None
-        fat_content = None
-
-        liquid = False
-
-        for key in entry.keys():
-
-            # Is this from a specific user?
-            if 'utente' in key.lower():
-                if entry[key] not in user_cache:
-                    try:
-                        user = User.objects.get(username=entry[key])
-                        user_cache[entry[key]] = user.username
-                    except User.DoesNotExist:
-                        user = None
-                else:
-                    user = user_cache[entry[key]]
-
-            # Ignore?
-            if 'ignora' in key.lower():
-                if entry[key].strip():
-                    skip=True
-
-            # Servings
-            if 'porzione' in key.lower():
-                if 'piccola' in key.lower() and not entry[key].strip().lower().endswith('no'):
-                    if entry[key].strip():
-                        small_serving = int(float(entry[key]))
-                if 'media' in key.lower() and not entry[key].strip().lower().endswith('no'):
-                    if entry[key].strip():
-                        medium_serving = int(float(entry[key]))
-                if 'grande' in key.lower() and not entry[key].strip().lower().endswith('no'):
-                    if entry[key].strip():
-                        large_serving = int(float(entry[key]))
-
-            # Pieces
-            if 'pezzo' in key.lower():
-                if 'piccolo' in key.lower() and not entry[key].strip().lower().endswith('no'):
-                    if entry[key].strip():
-                        small_piece = int(float(entry[key]))
-                if 'medio' in key.lower() and not entry[key].strip().lower().endswith('no'):
-                    if entry[key].strip():
-                        medium_piece = int(float(entry[key]))
-                if 'grande' in key.lower() and not entry[key].strip().lower().endswith('no'):
-                    if entry[key].strip():
-                        large_piece = int(float(entry[key]))
-
-            # Values
-            if 'cho' in key.lower():
-                if entry[key].strip():
-                    cho_content = float(entry[key])
-            if 'protein' in key.lower():
-                if entry[key].strip():
-                    protein_content = float(entry[key])
-            if 'fibre' in key.lower():
-                if entry[key].strip():
-                    fiber_content = float(entry[key])
-            if 'proteine' in key.lower():
-                if entry[key].strip():
-                    fat_content = float(entry[key])
-
-            # Liquid
-            if 'tipo' in key.lower():
-                if entry[key].strip() == 'bevanda':
-                    liquid = True
-
-        if skip:
-            continue
-
-        if not user:
-            errors[i+2] = 'Nessun utente per "{}", non aggiunto'.format(name)
-            continue
-
-        if not cho_content and not protein_content and not fiber_content and not fat_content:
-            errors[i+2] = 'Nessun valore nutrizionale per "{}"?'.format(name)
-            continue
-
-        food = Food(created_by = created_by_user,
-                    name = name.replace('(v.m.)','').strip(),
-                    main_ingredients = main_ingredients,
-                    small_serving = small_serving,
-                    medium_serving = medium_serving,
-                    large_serving = large_serving,
-                    small_piece = small_piece,
-                    medium_piece = medium_piece,
-                    large_piece = large_piece,
-                    liquid = liquid)
-        food.save(search_service=search_service)
-
-        # Assemble food observation
-        cho_ratio = cho_content/100 if cho_content is not None else None
-        protein_ratio = protein_content/100 if protein_content  is not None else None
-        fiber_ratio = fiber_content/100 if fiber_content  is not None else None
-        fat_ratio = fat_content/100 if fat_content is not None else None
-
-        # Handle "v.m." (varia molto)
-        observations = []
-        if 'v.m.' in name:
-            for factor in [0.8,1.0,1.2]:
+    users = {}
+    rows = 0
+
+    with open_csv_file(csv_file_path) as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        for column in ['Nome descrittivo', 'Ingredienti principali']:
+            if column not in header:
+                raise Exception('No "{}" column in the CSV file'.format(column))
+        name_position = header.index('Nome descrittivo')
+        ingredients_position = header.index('Ingredienti principali')
+        columns = get_csv_columns(header)
+
+        for i, row in enumerate(row for row in reader if row):
+            rows = i + 1
+            if progress and not rows % PROGRESS_ROWS:
+                progress(rows)
+            row += [''] * (len(header) - len(row))
+            if not row[name_position]:
+                continue
+            else:
+                name = row[name_position].strip()
+            if not row[ingredients_position]:
+                errors[i+2] = 'Nessun ingrediente principale per "{}"?'.format(name)
+                continue
+            else:
+                main_ingredients = [ingredient.strip() for ingredient in row[ingredients_position].split(',')]
+
+            values = {'user': None, 'skip': False, 'liquid': False}
+            for position, field, kind in columns:
+                value = row[position]
+                if kind == 'user':
+                    if value not in users:
+                        users[value] = User.objects.filter(username=value).first()
+                    values['user'] = users[value]
+                elif kind == 'flag':
+                    if value.strip():
+                        values[field] = True
+                elif kind == 'amount':
+                    if value.strip() and not value.strip().lower().endswith('no'):
+                        values[field] = int(float(value))
+                elif kind == 'value':
+                    if value.strip():
+                        values[field] = float(value)
+                elif kind == 'type':
+                    if value.strip() == 'bevanda':
+                        values[field] = True
+
+            if values['skip']:
+                continue
+
+            if not values['user']:
+                errors[i+2] = 'Nessun utente per "{}", non aggiunto'.format(name)
+                continue
+
+            cho_content = values.get('cho_content')
+            protein_content = values.get('protein_content')
+            fiber_content = values.get('fiber_content')
+            fat_content = values.get('fat_content')
+
+            if not cho_content and not protein_content and not fiber_content and not fat_content:
+                errors[i+2] = 'Nessun valore nutrizionale per "{}"?'.format(name)
+                continue
+
+            fields = {'name': name.replace('(v.m.)','').strip(),
+                      'main_ingredients': main_ingredients,
+                      'small_serving': values.get('small_serving'),
+                      'medium_serving': values.get('medium_serving'),
+                      'large_serving': values.get('large_serving'),
+                      'small_piece': values.get('small_piece'),
+                      'medium_piece': values.get('medium_piece'),
+                      'large_piece': values.get('large_piece'),
+                      'liquid': values['liquid']}
+
+            # Assemble food observation
+            cho_ratio = cho_content/100 if cho_content is not None else None
+            protein_ratio = protein_content/100 if protein_content  is not None else None
+            fiber_ratio = fiber_content/100 if fiber_content  is not None else None
+            fat_ratio = fat_content/100 if fat_content is not None else None
+
+            # Handle "v.m." (varia molto)
+            observations = []
+            for factor in [0.8,1.0,1.2] if 'v.m.' in name else [1.0]:
                 observations.append({'cho_ratio': cho_ratio*factor if cho_ratio is not None else None,
                                      'protein_ratio': protein_ratio*factor if protein_ratio is not None else None,
                                      'fiber_ratio': fiber_ratio*factor if fiber_ratio is not None else None,
                                      'fat_ratio': fat_ratio*factor if fat_ratio is not None else None})
 
-        else:
-            observations.append({'cho_ratio':cho_ratio,
-                                 'protein_ratio':protein_ratio,
-                                 'fiber_ratio':fiber_ratio,
-                                 'fat_ratio':fat_ratio})
-
-        for observation in observations:
-            FoodObservation.objects.create(created_by = created_by_user,
-                                           food = food,
-                                           cho_ratio = observation['cho_ratio'],
-                                           protein_ratio = observation['protein_ratio'],
-                                           fiber_ratio = observation['fiber_ratio'],
-                                           fat_ratio = observation['fat_ratio'])
+            yield fields, observations
+
+    if progress:
+        progress(rows)
+
+
+def get_content_hash(fields, observations):
+    # Of everything a food gets from its row, to tell whether it changed since the last load
+    return hashlib.sha256(orjson.dumps([fields, observations], option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def save_foods(foods, created_by_user, search_service):
+    """Save new and updated foods, as (food, observations) pairs, together with their
+    observations, in bulk. The observations of the updated foods are replaced."""
+    from .models import Food, FoodObservation
+
+    new_foods = [food for food, _ in foods if not food.id]
+    updated_foods = [food for food, _ in foods if food.id]
+    Food.objects.bulk_create(new_foods)
+    if updated_foods:
+        Food.objects.bulk_update(updated_foods, ['created_by', 'name', 'main_ingredients', 'small_serving', 'medium_serving', 'large_serving',
+                                                 'small_piece', 'medium_piece', 'large_piece', 'liquid', 'content_hash'])
+        FoodObservation.objects.filter(food__in=updated_foods).delete()
+    # The observations get the ids of their foods, as just returned by the database
+    FoodObservation.objects.bulk_create([FoodObservation(uuid = str(uuid.uuid4()),
+                                                         created_by = created_by_user,
+                                                         food = food,
+                                                         **observation) for food, observations in foods for observation in observations])
+    # Adds of updated foods replace them, as they keep their uuids
+    for food, _ in foods:
+        search_service.add(food.get_search_item())
+
+
+def save_foods_chunk(foods, created_by_user, search_service):
+    # In a transaction, with the search service writes sent in bulk within it, so that
+    # the chunk is rolled back if any of them fails (even the last, flushed on exit)
+    from django.db import transaction
+    with transaction.atomic():
+        with search_service.batch():
+            save_foods(foods, created_by_user, search_service)
+
+
+def load_foods_from_csv(csv_file_path, created_by_user, search_service=None, chunk_size=1000, progress=None):
+    """Load the foods and their observations from a CSV file, streaming its rows and saving
+    them in chunks of (at most) chunk_size foods, each in bulk and in a transaction. Returns
+    how many foods were loaded and the errors by line (as the row number plus two)."""
+    from .models import Food
+
+    errors = {}
+    loaded_count = 0
+
+    if not search_service:
+        search_service = SearchService()
+
+    foods = []
+
+    for fields, observations in read_foods_from_csv(csv_file_path, errors, progress=progress):
+        foods.append((Food(uuid=str(uuid.uuid4()), created_by=created_by_user, content_hash=get_content_hash(fields, observations), **fields),
+                      observations))
         loaded_count += 1
+        if len(foods) >= chunk_size:
+            save_foods_chunk(foods, created_by_user, search_service)
+            foods = []
+    if foods:
+        save_foods_chunk(foods, created_by_user, search_service)
 
     return loaded_count, errors
 
 
+def reload_foods_from_csv(csv_file_path, created_by_user, search_service=None, chunk_size=1000, progress=None):
+    """Update the catalog to the foods of a CSV file, applying only what changed to the database
+    and to the search index. Foods are matched on their names (and, for the same names, in order),
+    and updated in place, keeping their uuids, if their content hash is different. Foods not in the
+    file anymore are deleted. The whole file is read first, so that the changes are then written
+    in a (short) transaction. Returns the counts of the inserted, updated, deleted and unchanged
+    foods, and the errors by line (as the row number plus two)."""
+    from django.db import transaction
+    from .models import Food
+
+    errors = {}
+    counts = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+
+    if not search_service:
+        search_service = SearchService()
+
+    # The current catalog, by name
+    current_foods = {}
+    for food_id, food_uuid, name, content_hash in Food.objects.order_by('id').values_list('id', 'uuid', 'name', 'content_hash'):
+        current_foods.setdefault(name, []).append((food_id, food_uuid, content_hash))
+    seen_foods = {}
+    kept_ids = set()
+
+    # What changed
+    foods = []
+    for fields, observations in read_foods_from_csv(csv_file_path, errors, progress=progress):
+        content_hash = get_content_hash(fields, observations)
+        position = seen_foods.get(fields['name'], 0)
+        seen_foods[fields['name']] = position + 1
+        matches = current_foods.get(fields['name'], [])
+        if position < len(matches):
+            food_id, food_uuid, current_content_hash = matches[position]
+            kept_ids.add(food_id)
+            if content_hash == current_content_hash:
+                counts['unchanged'] += 1
+                continue
+            foods.append((Food(id=food_id, uuid=food_uuid, created_by=created_by_user, content_hash=content_hash, **fields), observations))
+            counts['updated'] += 1
+        else:
+            foods.append((Food(uuid=str(uuid.uuid4()), created_by=created_by_user, content_hash=content_hash, **fields), observations))
+            counts['inserted'] += 1
+    deleted_foods = [(food_id, food_uuid) for matches in current_foods.values() for food_id, food_uuid, _ in matches if food_id not in kept_ids]
+    counts['deleted'] = len(deleted_foods)
+
+    with transaction.atomic():
+        # Send all the search service writes in bulk (before committing)
+        with search_service.batch():
+            for start in range(0, len(foods), chunk_size):
+                save_foods(foods[start:start+chunk_size], created_by_user, search_service)
+
+            # And remove what is gone
+            for start in range(0, len(deleted_foods), chunk_size):
+                Food.objects.filter(id__in=[food_id for food_id, _ in deleted_foods[start:start+chunk_size]]).delete(search_service=search_service)
+
+    logger.info('Reloaded the catalog: %s inserted, %s updated, %s deleted and %s unchanged foods',
+                counts['inserted'], counts['updated'], counts['deleted'], counts['unchanged'])
+    return counts, errors
+
+
 def message_parser(message):
 
     # Prepare
@@ -5,11 +5,13 @@ from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotFound
 from django.contrib.auth.models import User
 from django.shortcuts import redirect
 from django.core.paginator import Paginator
-from .models import Food, FoodObservation, SearchQuery
+from django.db import transaction, IntegrityError
+from .models import Food, FoodObservation, SearchQuery, LoadJob
+from .jobs import save_job_file
 from .decorators import public_view, private_view
 from .exceptions import ErrorMessage
-from .utils import load_foods_from_csv
 from .bot import Bot
+import os
 import uuid
 
 # Setup logging
@@ -177,8 +179,6 @@ def food_load(request):
     data = {}
     if request.method == 'POST':
 
-        errors = {}
-
         # Get file if any
         fileinput = request.FILES.get('fileinput', None)
         logger.info('Loaded fileinput="{}"'.format(fileinput))
@@ -186,27 +186,39 @@ def food_load(request):
         if not fileinput:
             raise ErrorMessage('No file provided?')
 
-        # Load file content
-        fild_uuid = str(uuid.uuid4())
-        file_content = None
-        if fileinput:
-            with open('/tmp/{}'.format(fild_uuid), 'wb+') as destination:
-                for chunk in fileinput.chunks():
-                    destination.write(chunk)
-            for chunk in fileinput.chunks():
-                if not file_content:
-                    file_content = chunk
-                else:
-                    file_content += chunk
-        #logger.debug(file_content)
-
-        for food in Food.objects.all():
-            food.delete()
-
-        loaded_count, errors = load_foods_from_csv('/tmp/{}'.format(fild_uuid), request.user)
-        data['errors'] = errors
-        data['loaded'] = True
-        logger.info('Deleted all content and loaded database')
+        # One catalog load at a time (checked here not to save the file for nothing, but enforced
+        # by the single active job constraint, in case of concurrent uploads)
+        if LoadJob.objects.filter(status__in=['queued', 'running']).exists():
+            raise ErrorMessage('Another catalog load is already in progress')
+
+        # Save the file for the job, as it is (CSV, gzipped or zipped, read as a stream by the job)
+        file_path = save_job_file(fileinput)
+
+        # The load runs in the background (see the core_run_jobs command), here we just queue it
+        try:
+            with transaction.atomic():
+                job = LoadJob.objects.create(created_by = request.user,
+                                             file_path = file_path,
+                                             file_name = fileinput.name,
+                                             full_reload = bool(request.POST.get('full_reload', False)))
+        except IntegrityError:
+            os.remove(file_path)
+            raise ErrorMessage('Another catalog load is already in progress')
+        except:
+            os.remove(file_path)
+            raise
+        logger.info('Queued load job "{}"'.format(job.uuid))
+        return redirect('/food_load/?job={}'.format(job.uuid))
+
+    # Status of a job, if any
+    job_uuid = request.GET.get('job', None)
+    if job_uuid:
+        try:
+            data['job'] = LoadJob.objects.get(uuid=job_uuid)
+        except LoadJob.DoesNotExist:
+            raise ErrorMessage('No load job with uuid "{}"'.format(job_uuid))
+    else:
+        data['running_job'] = LoadJob.objects.filter(status__in=['queued', 'running']).first()
 
     return render(request, 'food_load.html', {'data': data})
 
@@ -19,4 +19,7 @@ urlpatterns = [
     path('chat/', views.chat, name='chat'),
     path('help/', views.help_page, name='help'),
     path('api/v1/telegram', api.TelegramAPI.as_view(), name='telegram_api'),
+    path('api/v1/suggest', api.SuggestAPI.as_view(), name='suggest_api'),
+    path('api/v1/search_client', api.SearchClientAPI.as_view(), name='search_client_api'),
+    path('api/v1/load_jobs/<str:job_uuid>', api.LoadJobAPI.as_view(), name='load_job_api'),
 ]
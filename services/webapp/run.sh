@@ -28,6 +28,10 @@ python3 manage.py migrate --noinput
 
 if [[ "x$DJANGO_DEV_SERVER" == "xtrue" ]] ; then
 
+    # Run the jobs worker (catalog uploads) in the background
+    echo "Starting the jobs worker."
+    python3 manage.py core_run_jobs &
+
     # Run the (development) server
     echo "Now starting the development server."
     exec python3 manage.py runserver 0.0.0.0:8080
@@ -52,6 +56,7 @@ else
           --static-map /media=/data/media \
           --http :8080 \
           --harakiri 180 \
+          --attach-daemon "python3 /code/manage.py core_run_jobs" \
           --http-timeout 180 \
           --http-timeout 180 \
           --disable-logging